@@ -3,11 +3,13 @@ import pandas as pd
 import os
 import struct
 from io import BytesIO
-import xlwt
 import tempfile
-from pdf2image import convert_from_bytes
-from PIL import Image
-from processor import process_pdf, split_pdf_to_pages, count_pdf_pages, iter_pdf_pages, group_pages_by_invoice, merge_pages_to_pdf, process_fiscal_pdf, process_kuf_pdf, KIF_HEADERS, KUF_HEADERS, DNEVNI_HEADERS
+import shutil
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from validation import validate_results_df, STATUS_OK
+from processor import process_pdf, count_pdf_pages, iter_page_groups, run_pipeline, prepare_invoice, prepare_fiscal, classify_pages, group_pages_by_invoice, PageStore, process_fiscal_pdf, process_kuf_pdf, hedging, hedge_stats, routing_stats, stage, stage_stats, STAGES, get_customer_master, get_partner_registry, DuplicateIndex, get_duplicate_index, KIF_HEADERS, KUF_HEADERS, DNEVNI_HEADERS, PAGE_BLANK, PAGE_FISCAL
 #
 def get_app_password():
     try:
@@ -29,11 +31,18 @@ if "page" not in st.session_state:
 
 # ── Page config (must be first Streamlit command) ──
 _layout = "wide" if st.session_state.page in ("kif", "kuf", "dnevni", "herbavital") else "centered"
-_logo_path = os.path.join(os.path.dirname(__file__), "images", "logo.png")
-_icon = Image.open(_logo_path) if os.path.exists(_logo_path) else "📄"
-st.set_page_config(page_title="BS BIRO BOT", page_icon=_icon, layout=_layout)
+@st.cache_resource(show_spinner=False)
+def load_page_icon():
+    logo_path = os.path.join(os.path.dirname(__file__), "images", "logo.png")
+    if os.path.exists(logo_path):
+        from PIL import Image
+        return Image.open(logo_path)
+    return "📄"
+
+st.set_page_config(page_title="BS BIRO BOT", page_icon=load_page_icon(), layout=_layout)
 
 # ── Helpers ──
+@st.cache_resource(show_spinner=False)
 def get_logo_b64():
     logo_path = os.path.join(os.path.dirname(__file__), "images", "logo.png")
     if os.path.exists(logo_path):
@@ -41,6 +50,15 @@ def get_logo_b64():
         return base64.b64encode(open(logo_path, "rb").read()).decode()
     return None
 
+@st.cache_resource(show_spinner=False)
+def customer_master():
+    """Dijeljeni CustomerMaster — sam se osvježava kad se kupci.xlsx promijeni."""
+    return get_customer_master()
+
+def load_customer_names():
+    with st.spinner("Učitavam listu kupaca..."):
+        return customer_master().names()
+
 def get_api_key(provider="openai"):
     secret_name = "ANTHROPIC_API_KEY" if provider.startswith("claude") else "OPENAI_API_KEY"
     try:
@@ -51,6 +69,232 @@ def get_api_key(provider="openai"):
         pass
     return os.environ.get(secret_name, "")
 
+def hedging_context(prefix, provider):
+    """Checkbox za hedging/failover na drugi provider — vraća context manager za obradu."""
+    secondary = "openai" if provider.startswith("claude") else "claude-sonnet"
+    enabled = st.checkbox(
+        f"Hedging i failover na {secondary}", key=f"{prefix}_hedge",
+        help="Ako odabrani provider kasni ili pada, isti zahtjev se šalje i na drugi provider. Brže na repu, ali skuplje.",
+    )
+    if not enabled:
+        return nullcontext()
+    secondary_key = get_api_key(secondary)
+    if not secondary_key:
+        st.warning(f"Hedging isključen — nema API ključa za {secondary}")
+        return nullcontext()
+    return hedging(secondary, secondary_key)
+
+def hedge_summary(before):
+    """Kratak opis hedginga za batch (razlika brojača prije/poslije)."""
+    after = hedge_stats()
+    d = {k: after[k] - before[k] for k in after}
+    if not d["calls"]:
+        return ""
+    return (f"Hedging: {d['hedges_sent']} duplikata, {d['hedge_wins']} pobjeda sekundarnog, "
+            f"ušteđeno ~{d['tail_saved_s']:.1f}s, dodatno ~{d['extra_input_tokens_est']} input tokena, "
+            f"{d['failovers']} failover poziva")
+
+def routing_checkbox(prefix):
+    return st.checkbox(
+        "Rutiranje modela po složenosti", key=f"{prefix}_routing",
+        help="Čisti digitalni računi idu na brzi, jeftiniji model; teški skenovi i računi koji ne prođu validaciju na najjači model.",
+    )
+
+def routing_summary(before):
+    """Kratak opis rutiranja za batch (razlika brojača prije/poslije)."""
+    after = routing_stats()
+    docs = after["docs"] - before["docs"]
+    if not docs:
+        return ""
+    by_provider = {p: n - before["docs_by_provider"].get(p, 0) for p, n in after["docs_by_provider"].items()}
+    by_provider = ", ".join(f"{p}: {n}" for p, n in by_provider.items() if n)
+    routed = after["cost_routed_usd"] - before["cost_routed_usd"]
+    baseline = after["cost_baseline_usd"] - before["cost_baseline_usd"]
+    return (f"Rutiranje: {docs} dok. (lako {after['easy'] - before['easy']}, srednje {after['normal'] - before['normal']}, "
+            f"teško {after['hard'] - before['hard']}), eskalacija {after['escalations'] - before['escalations']} — {by_provider} — "
+            f"procjena input troška ${routed:.3f} umjesto ${baseline:.3f}")
+
+def duplicates_checkbox(prefix):
+    return st.checkbox(
+        "Preskoči skoro identične dokumente", value=True, key=f"{prefix}_skip_dups",
+        help="Dokument sa istim tekstom ili skoro istim skenom (isti papir skeniran ponovo) kao već obrađen — u ovom batchu ili ranijim obradama — ne šalje se AI-ju. Isključi za namjernu ponovnu obradu; mogući duplikati se tada samo označe.",
+    )
+
+def find_duplicate(batch_index, history, prints):
+    """Labela ranijeg dokumenta sa istim otiskom (ovaj batch ili ranije obrade), ili None."""
+    dup = batch_index.find(prints)
+    if dup:
+        return dup
+    dup = history.find(prints)
+    if dup:
+        return f"{dup}, ranija obrada"
+    return None
+
+def show_possible_duplicates(dups):
+    """Upozorenje za redove označene kao mogući duplikati — ekstrakcija je urađena, korisnik odlučuje."""
+    if dups:
+        lines = "\n".join(f"- Red {idx + 1}: isti otisak kao {dup}" for idx, dup in sorted(dups.items()))
+        st.warning(f"Mogući duplikati ({len(dups)}) — provjeri prije izvoza:\n\n{lines}", icon="⚠️")
+
+def show_validation(edited_df, mode, key_col):
+    """Validira tabelu nakon edita i prikazuje probleme — vraća normalizovan DataFrame za izvoz."""
+    checked, status = validate_results_df(edited_df, mode)
+    bad = status != STATUS_OK
+    if bad.any():
+        st.warning(f"Validacija: {int(bad.sum())} od {len(status)} redova ima problem", icon="⚠️")
+        st.dataframe(
+            pd.DataFrame({"Red": status.index[bad] + 1, key_col: checked.loc[bad, key_col], "Problem": status[bad]}),
+            hide_index=True, use_container_width=True,
+        )
+    elif len(status):
+        st.caption(f"Validacija: svih {len(status)} redova OK")
+    return checked
+
+def learn_partners(mode, dataframe):
+    """on_click za izvoz: redovi bez problema pune registar partnera po JIB-u.
+
+    Uči se tek kad korisnik preuzme tabelu — ne na svakom rerunu, dok redovi
+    još nisu pregledani ili su napola editovani."""
+    checked, status = validate_results_df(dataframe, mode)
+    registry = get_partner_registry(mode)
+    for record in checked[status == STATUS_OK].to_dict("records"):
+        registry.learn(record)
+    registry.save()
+
+@contextmanager
+def spooled_uploads(files):
+    """Upload-ovani fajlovi snimljeni na disk jednom: [(ime, putanja)].
+
+    fitz ih otvara po putanji i čita stranicu po stranicu; fajlovi se brišu na izlazu.
+    """
+    spooled = []
+    try:
+        for file in files:
+            file.seek(0)
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+                shutil.copyfileobj(file, tmp, 1 << 20)
+            spooled.append((file.name, tmp.name))
+        yield spooled
+    finally:
+        for _, path in spooled:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+# ── Protok i vremena faza ──
+STAGE_LABELS = {
+    "text": "tekst",
+    "rasterize": "renderovanje",
+    "encode": "kodiranje slika",
+    "ai": "AI poziv",
+    "post": "naknadna obrada",
+    "export": "izvoz",
+}
+
+def _fmt_duration(seconds):
+    seconds = int(round(seconds))
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+class BatchClock:
+    """Klizni protok (str/min, zadnjih `window` sekundi) i procjena preostalog vremena."""
+
+    def __init__(self, total, window=60.0):
+        self.total = total
+        self.window = window
+        self.started = time.monotonic()
+        self._samples = deque([(self.started, 0)])
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def text(self, done, label):
+        """Tekst za progress bar: labela + protok i ETA (kad ima dovoljno podataka)."""
+        now = time.monotonic()
+        self._samples.append((now, done))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+        t0, done0 = self._samples[0]
+        if done <= done0 or now <= t0:
+            return label
+        per_min = (done - done0) / (now - t0) * 60
+        eta = (self.total - done) / per_min * 60
+        return f"{label} — {per_min:.1f} str/min, još ~{_fmt_duration(eta)}"
+
+def stage_breakdown(before):
+    """Razlika brojača faza prije/poslije: {faza: {"calls", "seconds"}}."""
+    after = stage_stats()
+    return {
+        name: {
+            "calls": after[name]["calls"] - before[name]["calls"],
+            "seconds": after[name]["seconds"] - before[name]["seconds"],
+        }
+        for name in STAGES
+    }
+
+def batch_timings(before, clock, pages):
+    """Vremena batcha za session_state (prikaz i CSV uz rezultate)."""
+    return {"stages": stage_breakdown(before), "elapsed": clock.elapsed(), "pages": pages}
+
+def timings_summary(timings):
+    """Kratak opis: protok batcha i sekunde po fazi."""
+    elapsed = timings["elapsed"]
+    per_min = timings["pages"] / elapsed * 60 if elapsed else 0
+    parts = ", ".join(
+        f"{STAGE_LABELS[name]} {v['seconds']:.1f}s"
+        for name, v in timings["stages"].items() if v["calls"]
+    )
+    return f"Vrijeme: {_fmt_duration(elapsed)} ({per_min:.1f} str/min) — {parts}"
+
+def timings_download(timings, export_before, file_name, key):
+    """Dugme za CSV sa vremenima faza batcha; izvoz se mjeri u ovom prikazu."""
+    if not timings:
+        return
+    stages = dict(timings["stages"])
+    stages["export"] = stage_breakdown(export_before)["export"]
+    rows = [
+        {"FAZA": name, "OPIS": STAGE_LABELS[name], "POZIVA": v["calls"],
+         "SEKUNDI": round(v["seconds"], 3),
+         "UDIO": round(v["seconds"] / timings["elapsed"], 3) if timings["elapsed"] else 0}
+        for name, v in stages.items()
+    ]
+    rows.append({"FAZA": "ukupno", "OPIS": f"{timings['pages']} stranica", "POZIVA": "",
+                 "SEKUNDI": round(timings["elapsed"], 3), "UDIO": 1})
+    csv = pd.DataFrame(rows).to_csv(index=False, sep=";", encoding="utf-8-sig")
+    st.download_button("Preuzmi vremena obrade (CSV)", csv, file_name, use_container_width=True, key=key)
+
+SKIP_REASONS = {
+    PAGE_BLANK: "prazna stranica",
+    PAGE_FISCAL: "fiskalni račun (ne pripada ovom modulu)",
+}
+
+def page_group_label(file_name, file_pages, pages):
+    """Labela za grupu stranica (0-based indeksi) iz jednog fajla."""
+    if file_pages <= 1:
+        return file_name
+    if len(pages) > 1:
+        return f"{file_name} (str. {pages[0] + 1}-{pages[-1] + 1})"
+    return f"{file_name} (str. {pages[0] + 1})"
+
+def page_group_jobs(spooled, page_counts, find_dup=None, **group_kw):
+    """Reader faza za run_pipeline: ((labela, stranice, otisci, razlog_preskoka), page_bytes).
+
+    Radi u niti pipeline-a, pa ne dira st.*. find_dup(otisci) → labela ranije
+    uspješno obrađenog dokumenta: takva grupa se preskače prije AI poziva.
+    Indeksi se pune tek u petlji rezultata, pa ponavljanje dokumenta koji je
+    još u obradi tamo samo dobija oznaku mogućeg duplikata."""
+    for (file_name, path), file_pages in zip(spooled, page_counts):
+        for pages, kind, page_bytes, prints in iter_page_groups(path, **group_kw):
+            label = page_group_label(file_name, file_pages, pages)
+            if page_bytes is None:
+                yield (label, pages, prints, SKIP_REASONS[kind]), None
+                continue
+            dup = find_dup(prints) if find_dup else None
+            if dup:
+                yield (label, pages, prints, f"skoro identičan dokumentu {dup}"), None
+                continue
+            yield (label, pages, prints, None), page_bytes
+
 logo_b64 = get_logo_b64()
 
 
@@ -262,9 +506,14 @@ elif st.session_state.page == "kif":
         st.session_state.logs = []
     if "pdf_map" not in st.session_state:
         st.session_state.pdf_map = {}
+    if "dups" not in st.session_state:
+        st.session_state.dups = {}
 
     with top_left:
         provider = st.selectbox("AI Provider", ["claude-sonnet", "claude-opus", "openai"], key="kif_provider")
+        hedge_ctx = hedging_context("kif", provider)
+        routing = routing_checkbox("kif")
+        skip_dups = duplicates_checkbox("kif")
         process_clicked = st.button("Obradi račune", type="primary", use_container_width=True)
 
     if process_clicked:
@@ -274,48 +523,64 @@ elif st.session_state.page == "kif":
                 key_name = "ANTHROPIC_API_KEY" if provider.startswith("claude") else "OPENAI_API_KEY"
                 st.error(f"{key_name} nije pronađen. Dodaj ga u .streamlit/secrets.toml ili .env")
                 st.stop()
+            load_customer_names()
 
         st.session_state.results = []
         st.session_state.logs = []
+        st.session_state.timings = None
         st.session_state.pdf_map = {}
+        st.session_state.dups = {}
         st.session_state.labels = {}
         seen = set()
 
-        # Prebrojaj ukupno stranica
-        total = 0
-        for file in uploaded_files:
-            pdf_bytes = file.read()
-            total += count_pdf_pages(pdf_bytes)
-            file.seek(0)
-
         with top_left:
-            with st.spinner("AI obrađuje račune, molimo sačekajte..."):
+            with st.spinner("AI obrađuje račune, molimo sačekajte..."), hedge_ctx, spooled_uploads(uploaded_files) as spooled:
+                page_counts = [count_pdf_pages(path) for _, path in spooled]
+                total = sum(page_counts)
+                hedge_before = hedge_stats()
+                routing_before = routing_stats()
                 progress = st.progress(0, text="Pokrećem obradu...")
+                batch_index = DuplicateIndex()
+                history = get_duplicate_index("kif")
+                stage_before = stage_stats()
+                clock = BatchClock(total)
                 i = 0
-                for file in uploaded_files:
-                    pdf_bytes = file.read()
-                    file_pages = count_pdf_pages(pdf_bytes)
-                    for page_num, page_bytes in iter_pdf_pages(pdf_bytes):
-                        label = f"{file.name} (str. {page_num})" if file_pages > 1 else file.name
-                        progress.progress(i / total, text=f"Obrađujem {i+1}/{total}: {label}")
-                        try:
-                            data = process_pdf(page_bytes, filename=label, api_key=api_key, provider=provider)
-                            broj = data.get("BRDOKFAKT", "")
-                            if broj and broj in seen:
-                                st.session_state.logs.append(("warn", f"{label} — duplikat računa {broj}"))
-                            else:
-                                seen.add(broj)
-                                idx = len(st.session_state.results)
-                                st.session_state.results.append(data)
-                                st.session_state.pdf_map[idx] = page_bytes
-                                st.session_state.labels[idx] = label
-                                st.session_state.logs.append(("ok", f"{label} — {data.get('NAZIVPP','?')} — {data.get('IZNAKFT','?')} KM"))
-                        except Exception as e:
-                            st.session_state.logs.append(("err", f"{label} — {str(e)}"))
-                        i += 1
-                        progress.progress(i / total)
-                    del pdf_bytes
+                find_dup = (lambda prints: find_duplicate(batch_index, history, prints)) if skip_dups else None
+                jobs = page_group_jobs(spooled, page_counts, find_dup, skip=(PAGE_BLANK, PAGE_FISCAL))
+                process = lambda meta, pdf: process_pdf(pdf, filename=meta[0], api_key=api_key, provider=provider, routing=routing)
+                prepare = lambda pdf: prepare_invoice(pdf, routing=routing)
+                for (label, pages, prints, skipped), page_bytes, data, error in run_pipeline(jobs, process, prepare):
+                    i += len(pages)
+                    progress.progress(i / total, text=clock.text(i, f"Obrađeno {i}/{total}: {label}"))
+                    if skipped:
+                        st.session_state.logs.append(("warn", f"{label} — preskočeno: {skipped}"))
+                        continue
+                    if error is not None:
+                        st.session_state.logs.append(("err", f"{label} — {str(error)}"))
+                        continue
+                    dup = find_duplicate(batch_index, history, prints)
+                    broj = data.get("BRDOKFAKT", "")
+                    if broj and broj in seen:
+                        st.session_state.logs.append(("warn", f"{label} — duplikat računa {broj}"))
+                    else:
+                        seen.add(broj)
+                        idx = len(st.session_state.results)
+                        st.session_state.results.append(data)
+                        st.session_state.pdf_map[idx] = page_bytes
+                        st.session_state.labels[idx] = label
+                        st.session_state.logs.append(("ok", f"{label} — {data.get('NAZIVPP','?')} — {data.get('IZNAKFT','?')} KM"))
+                        if dup:
+                            st.session_state.dups[idx] = dup
+                            st.session_state.logs.append(("warn", f"{label} — mogući duplikat: isti otisak kao {dup}"))
+                    batch_index.add(prints, label)
+                    history.add(prints, label)
+                history.save()
                 progress.progress(1.0, text=f"Gotovo! Obrađeno {len(st.session_state.results)} račun(a)")
+                st.session_state.timings = batch_timings(stage_before, clock, total)
+                for summary in (hedge_summary(hedge_before), routing_summary(routing_before)):
+                    if summary:
+                        st.caption(summary)
+                st.caption(timings_summary(st.session_state.timings))
 
     # Results
     if st.session_state.results:
@@ -330,8 +595,11 @@ elif st.session_state.page == "kif":
                     df[col] = ""
 
             edited_df = st.data_editor(df[KIF_HEADERS], use_container_width=True, hide_index=True, num_rows="dynamic", key="data_editor")
+            edited_df = show_validation(edited_df, "kif", "BRDOKFAKT")
+            show_possible_duplicates(st.session_state.dups)
 
             def create_xls(dataframe):
+                import xlwt
                 wb = xlwt.Workbook(encoding="utf-8")
                 ws = wb.add_sheet("Racuni")
                 for c, h in enumerate(KIF_HEADERS):
@@ -346,14 +614,21 @@ elif st.session_state.page == "kif":
             def create_dbf(dataframe):
                 return _write_dbf(dataframe, KIF_HEADERS)
 
+            export_before = stage_stats()
+            with stage("export"):
+                dbf_bytes = create_dbf(edited_df)
+                xls_bytes = create_xls(edited_df)
+                csv_text = edited_df.to_csv(index=False, sep=";", encoding="utf-8-sig")
+
             st.divider()
             e1, e2, e3 = st.columns(3)
             with e1:
-                st.download_button("Preuzmi DBF", create_dbf(edited_df), "racuni.dbf", type="primary", use_container_width=True)
+                st.download_button("Preuzmi DBF", dbf_bytes, "racuni.dbf", type="primary", use_container_width=True, on_click=learn_partners, args=("kif", edited_df))
             with e2:
-                st.download_button("Preuzmi XLS", create_xls(edited_df), "racuni.xls", use_container_width=True)
+                st.download_button("Preuzmi XLS", xls_bytes, "racuni.xls", use_container_width=True, on_click=learn_partners, args=("kif", edited_df))
             with e3:
-                st.download_button("Preuzmi CSV", edited_df.to_csv(index=False, sep=";", encoding="utf-8-sig"), "racuni.csv", use_container_width=True)
+                st.download_button("Preuzmi CSV", csv_text, "racuni.csv", use_container_width=True, on_click=learn_partners, args=("kif", edited_df))
+            timings_download(st.session_state.get("timings"), export_before, "racuni_vremena.csv", key="timings_download")
 
         with top_right:
             st.subheader("PDF pregled")
@@ -378,6 +653,7 @@ elif st.session_state.page == "kif":
             pdf_bytes = st.session_state.pdf_map.get(selected)
             if pdf_bytes:
                 st.download_button("Preuzmi ovaj PDF", pdf_bytes, "racun.pdf", use_container_width=True, key="pdf_download")
+                from pdf2image import convert_from_bytes
                 pages = convert_from_bytes(pdf_bytes, dpi=150)
                 for page in pages:
                     st.image(page, use_container_width=True)
@@ -457,9 +733,14 @@ elif st.session_state.page == "dnevni":
         st.session_state.d_logs = []
     if "d_pdf_map" not in st.session_state:
         st.session_state.d_pdf_map = {}
+    if "d_dups" not in st.session_state:
+        st.session_state.d_dups = {}
 
     with top_left:
         provider = st.selectbox("AI Provider", ["claude-sonnet", "claude-opus", "openai"], key="dnevni_provider")
+        hedge_ctx = hedging_context("dnevni", provider)
+        routing = routing_checkbox("dnevni")
+        skip_dups = duplicates_checkbox("dnevni")
         process_clicked_d = st.button("Obradi fiskalne račune", type="primary", use_container_width=True)
 
     if process_clicked_d:
@@ -472,38 +753,54 @@ elif st.session_state.page == "dnevni":
 
         st.session_state.d_results = []
         st.session_state.d_logs = []
+        st.session_state.d_timings = None
         st.session_state.d_pdf_map = {}
-
-        # Prebrojaj ukupno stranica bez čuvanja svih bajtova u memoriji
-        total = 0
-        for file in uploaded_files_d:
-            pdf_bytes = file.read()
-            total += count_pdf_pages(pdf_bytes)
-            file.seek(0)
+        st.session_state.d_dups = {}
 
         with top_left:
-            with st.spinner("AI obrađuje fiskalne račune, molimo sačekajte..."):
+            with st.spinner("AI obrađuje fiskalne račune, molimo sačekajte..."), hedge_ctx, spooled_uploads(uploaded_files_d) as spooled:
+                page_counts = [count_pdf_pages(path) for _, path in spooled]
+                total = sum(page_counts)
+                hedge_before = hedge_stats()
+                routing_before = routing_stats()
                 progress = st.progress(0, text="Pokrećem obradu...")
+                batch_index = DuplicateIndex()
+                history = get_duplicate_index("dnevni")
+                stage_before = stage_stats()
+                clock = BatchClock(total)
                 i = 0
-                for file in uploaded_files_d:
-                    pdf_bytes = file.read()
-                    file_pages = count_pdf_pages(pdf_bytes)
-                    for page_num, page_bytes in iter_pdf_pages(pdf_bytes):
-                        label = f"{file.name} (str. {page_num})" if file_pages > 1 else file.name
-                        progress.progress(i / total, text=f"Obrađujem {i+1}/{total}: {label}")
-                        try:
-                            fiscal_items = process_fiscal_pdf(page_bytes, filename=label, api_key=api_key, provider=provider)
-                            for item in fiscal_items:
-                                idx = len(st.session_state.d_results)
-                                st.session_state.d_results.append(item)
-                                st.session_state.d_pdf_map[idx] = page_bytes
-                                st.session_state.d_logs.append(("ok", f"{label} — DI: {item.get('SADRZAJ','?')} — Datum: {item.get('DATUMDOK','?')}"))
-                        except Exception as e:
-                            st.session_state.d_logs.append(("err", f"{label} — {str(e)}"))
-                        i += 1
-                        progress.progress(i / total)
-                    del pdf_bytes
+                find_dup = (lambda prints: find_duplicate(batch_index, history, prints)) if skip_dups else None
+                jobs = page_group_jobs(spooled, page_counts, find_dup, skip=(PAGE_BLANK,), merge_continuations=False)
+                process = lambda meta, pdf: process_fiscal_pdf(pdf, filename=meta[0], api_key=api_key, provider=provider, routing=routing)
+                prepare = lambda pdf: prepare_fiscal(pdf, routing=routing)
+                for (label, pages, prints, skipped), page_bytes, fiscal_items, error in run_pipeline(jobs, process, prepare):
+                    i += len(pages)
+                    progress.progress(i / total, text=clock.text(i, f"Obrađeno {i}/{total}: {label}"))
+                    if skipped:
+                        st.session_state.d_logs.append(("warn", f"{label} — preskočeno: {skipped}"))
+                        continue
+                    if error is not None:
+                        st.session_state.d_logs.append(("err", f"{label} — {str(error)}"))
+                        continue
+                    dup = find_duplicate(batch_index, history, prints)
+                    for item in fiscal_items:
+                        idx = len(st.session_state.d_results)
+                        st.session_state.d_results.append(item)
+                        st.session_state.d_pdf_map[idx] = page_bytes
+                        st.session_state.d_logs.append(("ok", f"{label} — DI: {item.get('SADRZAJ','?')} — Datum: {item.get('DATUMDOK','?')}"))
+                        if dup:
+                            st.session_state.d_dups[idx] = dup
+                    if dup and fiscal_items:
+                        st.session_state.d_logs.append(("warn", f"{label} — mogući duplikat: isti otisak kao {dup}"))
+                    batch_index.add(prints, label)
+                    history.add(prints, label)
+                history.save()
                 progress.progress(1.0, text=f"Gotovo! Pronađeno {len(st.session_state.d_results)} fiskalnih računa")
+                st.session_state.d_timings = batch_timings(stage_before, clock, total)
+                for summary in (hedge_summary(hedge_before), routing_summary(routing_before)):
+                    if summary:
+                        st.caption(summary)
+                st.caption(timings_summary(st.session_state.d_timings))
 
     if st.session_state.d_results:
         with top_left:
@@ -517,8 +814,11 @@ elif st.session_state.page == "dnevni":
                     df[col] = ""
 
             edited_df = st.data_editor(df[DNEVNI_HEADERS], use_container_width=True, hide_index=True, num_rows="dynamic", key="data_editor_d")
+            edited_df = show_validation(edited_df, "dnevni", "SADRZAJ")
+            show_possible_duplicates(st.session_state.d_dups)
 
             def create_xls_d(dataframe):
+                import xlwt
                 wb = xlwt.Workbook(encoding="utf-8")
                 ws = wb.add_sheet("dp")
                 for c, h in enumerate(DNEVNI_HEADERS):
@@ -533,14 +833,21 @@ elif st.session_state.page == "dnevni":
             def create_dbf_d(dataframe):
                 return _write_dbf(dataframe, DNEVNI_HEADERS)
 
+            export_before = stage_stats()
+            with stage("export"):
+                dbf_bytes = create_dbf_d(edited_df)
+                xls_bytes = create_xls_d(edited_df)
+                csv_text = edited_df.to_csv(index=False, sep=";", encoding="utf-8-sig")
+
             st.divider()
             e1, e2, e3 = st.columns(3)
             with e1:
-                st.download_button("Preuzmi DBF", create_dbf_d(edited_df), "dnevni_prihod.dbf", type="primary", use_container_width=True)
+                st.download_button("Preuzmi DBF", dbf_bytes, "dnevni_prihod.dbf", type="primary", use_container_width=True)
             with e2:
-                st.download_button("Preuzmi XLS", create_xls_d(edited_df), "dnevni_prihod.xls", use_container_width=True)
+                st.download_button("Preuzmi XLS", xls_bytes, "dnevni_prihod.xls", use_container_width=True)
             with e3:
-                st.download_button("Preuzmi CSV", edited_df.to_csv(index=False, sep=";", encoding="utf-8-sig"), "dnevni_prihod.csv", use_container_width=True)
+                st.download_button("Preuzmi CSV", csv_text, "dnevni_prihod.csv", use_container_width=True)
+            timings_download(st.session_state.get("d_timings"), export_before, "dnevni_prihod_vremena.csv", key="d_timings_download")
 
         with top_right:
             st.subheader("PDF pregled")
@@ -560,6 +867,7 @@ elif st.session_state.page == "dnevni":
             pdf_bytes = st.session_state.d_pdf_map.get(selected)
             if pdf_bytes:
                 st.download_button("Preuzmi ovaj PDF", pdf_bytes, "fiskalni.pdf", use_container_width=True, key="pdf_download_d")
+                from pdf2image import convert_from_bytes
                 pages = convert_from_bytes(pdf_bytes, dpi=150)
                 for page in pages:
                     st.image(page, use_container_width=True)
@@ -640,11 +948,16 @@ elif st.session_state.page == "kuf":
         st.session_state.k_logs = []
     if "k_pdf_map" not in st.session_state:
         st.session_state.k_pdf_map = {}
+    if "k_dups" not in st.session_state:
+        st.session_state.k_dups = {}
     if "k_labels" not in st.session_state:
         st.session_state.k_labels = {}
 
     with top_left:
         provider = st.selectbox("AI Provider", ["claude-sonnet", "claude-opus", "openai"], key="kuf_provider")
+        hedge_ctx = hedging_context("kuf", provider)
+        routing = routing_checkbox("kuf")
+        skip_dups = duplicates_checkbox("kuf")
         process_clicked_k = st.button("Obradi račune", type="primary", use_container_width=True, key="process_kuf")
 
     if process_clicked_k:
@@ -657,45 +970,60 @@ elif st.session_state.page == "kuf":
 
         st.session_state.k_results = []
         st.session_state.k_logs = []
+        st.session_state.k_timings = None
         st.session_state.k_pdf_map = {}
+        st.session_state.k_dups = {}
         st.session_state.k_labels = {}
         seen = set()
 
-        # Prebrojaj ukupno stranica bez čuvanja svih bajtova u memoriji
-        total = 0
-        for file in uploaded_files_k:
-            pdf_bytes = file.read()
-            total += count_pdf_pages(pdf_bytes)
-            file.seek(0)
-
         with top_left:
-            with st.spinner("AI obrađuje ulazne račune, molimo sačekajte..."):
+            with st.spinner("AI obrađuje ulazne račune, molimo sačekajte..."), hedge_ctx, spooled_uploads(uploaded_files_k) as spooled:
+                page_counts = [count_pdf_pages(path) for _, path in spooled]
+                total = sum(page_counts)
+                hedge_before = hedge_stats()
+                routing_before = routing_stats()
                 progress = st.progress(0, text="Pokrećem obradu...")
+                batch_index = DuplicateIndex()
+                history = get_duplicate_index("kuf")
+                stage_before = stage_stats()
+                clock = BatchClock(total)
                 i = 0
-                for file in uploaded_files_k:
-                    pdf_bytes = file.read()
-                    file_pages = count_pdf_pages(pdf_bytes)
-                    for page_num, page_bytes in iter_pdf_pages(pdf_bytes):
-                        label = f"{file.name} (str. {page_num})" if file_pages > 1 else file.name
-                        progress.progress(i / total, text=f"Obrađujem {i+1}/{total}: {label}")
-                        try:
-                            data = process_kuf_pdf(page_bytes, filename=label, api_key=api_key, provider=provider)
-                            broj = data.get("BROJFAKT", "")
-                            if broj and broj in seen:
-                                st.session_state.k_logs.append(("warn", f"{label} — duplikat računa {broj}"))
-                            else:
-                                seen.add(broj)
-                                idx = len(st.session_state.k_results)
-                                st.session_state.k_results.append(data)
-                                st.session_state.k_pdf_map[idx] = page_bytes
-                                st.session_state.k_labels[idx] = label
-                                st.session_state.k_logs.append(("ok", f"{label} — {data.get('NAZIVPP','?')} — {data.get('IZNSAPDV','?')} KM"))
-                        except Exception as e:
-                            st.session_state.k_logs.append(("err", f"{label} — {str(e)}"))
-                        i += 1
-                        progress.progress(i / total)
-                    del pdf_bytes
+                find_dup = (lambda prints: find_duplicate(batch_index, history, prints)) if skip_dups else None
+                jobs = page_group_jobs(spooled, page_counts, find_dup, skip=(PAGE_BLANK, PAGE_FISCAL))
+                process = lambda meta, pdf: process_kuf_pdf(pdf, filename=meta[0], api_key=api_key, provider=provider, routing=routing)
+                prepare = lambda pdf: prepare_invoice(pdf, routing=routing)
+                for (label, pages, prints, skipped), page_bytes, data, error in run_pipeline(jobs, process, prepare):
+                    i += len(pages)
+                    progress.progress(i / total, text=clock.text(i, f"Obrađeno {i}/{total}: {label}"))
+                    if skipped:
+                        st.session_state.k_logs.append(("warn", f"{label} — preskočeno: {skipped}"))
+                        continue
+                    if error is not None:
+                        st.session_state.k_logs.append(("err", f"{label} — {str(error)}"))
+                        continue
+                    dup = find_duplicate(batch_index, history, prints)
+                    broj = data.get("BROJFAKT", "")
+                    if broj and broj in seen:
+                        st.session_state.k_logs.append(("warn", f"{label} — duplikat računa {broj}"))
+                    else:
+                        seen.add(broj)
+                        idx = len(st.session_state.k_results)
+                        st.session_state.k_results.append(data)
+                        st.session_state.k_pdf_map[idx] = page_bytes
+                        st.session_state.k_labels[idx] = label
+                        st.session_state.k_logs.append(("ok", f"{label} — {data.get('NAZIVPP','?')} — {data.get('IZNSAPDV','?')} KM"))
+                        if dup:
+                            st.session_state.k_dups[idx] = dup
+                            st.session_state.k_logs.append(("warn", f"{label} — mogući duplikat: isti otisak kao {dup}"))
+                    batch_index.add(prints, label)
+                    history.add(prints, label)
+                history.save()
                 progress.progress(1.0, text=f"Gotovo! Obrađeno {len(st.session_state.k_results)} račun(a)")
+                st.session_state.k_timings = batch_timings(stage_before, clock, total)
+                for summary in (hedge_summary(hedge_before), routing_summary(routing_before)):
+                    if summary:
+                        st.caption(summary)
+                st.caption(timings_summary(st.session_state.k_timings))
 
     # Results
     if st.session_state.k_results:
@@ -710,8 +1038,11 @@ elif st.session_state.page == "kuf":
                     df[col] = ""
 
             edited_df = st.data_editor(df[KUF_HEADERS], use_container_width=True, hide_index=True, num_rows="dynamic", key="data_editor_k")
+            edited_df = show_validation(edited_df, "kuf", "BROJFAKT")
+            show_possible_duplicates(st.session_state.k_dups)
 
             def create_xls_k(dataframe):
+                import xlwt
                 wb = xlwt.Workbook(encoding="utf-8")
                 ws = wb.add_sheet("UlazniRacuni")
                 for c, h in enumerate(KUF_HEADERS):
@@ -726,14 +1057,21 @@ elif st.session_state.page == "kuf":
             def create_dbf_k(dataframe):
                 return _write_dbf(dataframe, KUF_HEADERS)
 
+            export_before = stage_stats()
+            with stage("export"):
+                dbf_bytes = create_dbf_k(edited_df)
+                xls_bytes = create_xls_k(edited_df)
+                csv_text = edited_df.to_csv(index=False, sep=";", encoding="utf-8-sig")
+
             st.divider()
             e1, e2, e3 = st.columns(3)
             with e1:
-                st.download_button("Preuzmi DBF", create_dbf_k(edited_df), "kuf.dbf", type="primary", use_container_width=True)
+                st.download_button("Preuzmi DBF", dbf_bytes, "kuf.dbf", type="primary", use_container_width=True, on_click=learn_partners, args=("kuf", edited_df))
             with e2:
-                st.download_button("Preuzmi XLS", create_xls_k(edited_df), "kuf.xls", use_container_width=True)
+                st.download_button("Preuzmi XLS", xls_bytes, "kuf.xls", use_container_width=True, on_click=learn_partners, args=("kuf", edited_df))
             with e3:
-                st.download_button("Preuzmi CSV", edited_df.to_csv(index=False, sep=";", encoding="utf-8-sig"), "kuf.csv", use_container_width=True)
+                st.download_button("Preuzmi CSV", csv_text, "kuf.csv", use_container_width=True, on_click=learn_partners, args=("kuf", edited_df))
+            timings_download(st.session_state.get("k_timings"), export_before, "kuf_vremena.csv", key="k_timings_download")
 
         with top_right:
             st.subheader("PDF pregled")
@@ -759,6 +1097,7 @@ elif st.session_state.page == "kuf":
             pdf_bytes = st.session_state.k_pdf_map.get(selected)
             if pdf_bytes:
                 st.download_button("Preuzmi ovaj PDF", pdf_bytes, "ulazni_racun.pdf", use_container_width=True, key="pdf_download_k")
+                from pdf2image import convert_from_bytes
                 pages = convert_from_bytes(pdf_bytes, dpi=150)
                 for page in pages:
                     st.image(page, use_container_width=True)
@@ -837,11 +1176,16 @@ elif st.session_state.page == "herbavital":
         st.session_state.h_logs = []
     if "h_pdf_map" not in st.session_state:
         st.session_state.h_pdf_map = {}
+    if "h_dups" not in st.session_state:
+        st.session_state.h_dups = {}
     if "h_labels" not in st.session_state:
         st.session_state.h_labels = {}
 
     with top_left:
         provider = st.selectbox("AI Provider", ["claude-sonnet", "claude-opus", "openai"], key="herbavital_provider")
+        hedge_ctx = hedging_context("herbavital", provider)
+        routing = routing_checkbox("herbavital")
+        skip_dups = duplicates_checkbox("herbavital")
         process_clicked_h = st.button("Obradi račune", type="primary", use_container_width=True, key="process_herbavital")
 
     if process_clicked_h:
@@ -851,57 +1195,79 @@ elif st.session_state.page == "herbavital":
                 key_name = "ANTHROPIC_API_KEY" if provider.startswith("claude") else "OPENAI_API_KEY"
                 st.error(f"{key_name} nije pronađen. Dodaj ga u .streamlit/secrets.toml ili .env")
                 st.stop()
+            load_customer_names()
 
         st.session_state.h_results = []
         st.session_state.h_logs = []
+        st.session_state.h_timings = None
         st.session_state.h_pdf_map = {}
+        st.session_state.h_dups = {}
         st.session_state.h_labels = {}
         seen = set()
 
-        # Faza 1: razdvoji sve fajlove na stranice
-        all_pages = []  # (file_name, page_num, page_bytes)
-        for file in uploaded_files_h:
-            pdf_bytes = file.read()
-            for page_num, page_bytes in split_pdf_to_pages(pdf_bytes):
-                all_pages.append((file.name, page_num, page_bytes))
-            del pdf_bytes
-        total_pages = len(all_pages)
-
-        with top_left:
-            with st.spinner("AI obrađuje Herbavital račune..."):
-                # Faza 2: pre-scan — izvuci broj računa sa svake stranice
-                progress = st.progress(0, text="Faza 1/2: Skeniram brojeve računa...")
-                page_list = [(pn, pb) for _, pn, pb in all_pages]
-                file_names = [fn for fn, _, _ in all_pages]
-
-                def prescan_progress(i, total, label):
-                    progress.progress(i / total / 2, text=f"Faza 1/2: {label} ({i+1}/{total})")
-
-                invoice_groups = group_pages_by_invoice(page_list, api_key=api_key, provider=provider, progress_cb=prescan_progress)
-                progress.progress(0.5, text=f"Faza 1/2 gotova! Pronađeno {len(invoice_groups)} računa u {total_pages} stranica")
-
-                # Faza 3: obradi svaku grupu (spojene stranice → jedan AI poziv)
-                total_invoices = len(invoice_groups)
-                for i, (inv_num, pages) in enumerate(invoice_groups):
-                    n_pages = len(pages)
-                    first_page = pages[0][0]
-                    # Nađi ime fajla za prvu stranicu ove grupe
-                    fname = file_names[0]
-                    for fi, (fn, pn, _) in enumerate(all_pages):
-                        if pn == first_page:
-                            fname = fn
-                            break
-                    label = f"{fname} (račun {inv_num}, {n_pages} str.)" if n_pages > 1 else f"{fname} (str. {first_page})"
-                    progress.progress(0.5 + (i / total_invoices) * 0.5, text=f"Faza 2/2: Obrađujem {i+1}/{total_invoices}: {label}")
-
-                    try:
-                        # Spoji stranice u jedan PDF ako ih ima više
-                        if n_pages > 1:
-                            invoice_bytes = merge_pages_to_pdf(pages)
-                        else:
-                            invoice_bytes = pages[0][1]
-
-                        data = process_pdf(invoice_bytes, filename=label, api_key=api_key, provider=provider)
+        # Faza 1: klasifikuj stranice svih fajlova; stranica skoro identična
+        # nekoj iz ranijih obrada se preskače (ponavljanja u ovom batchu se
+        # označe po stranici, nakon uspješne ekstrakcije računa).
+        # Stranice se dalje vode kao reference (file_id, page_index) — bajtovi
+        # spojenog računa prave se tek u fazi 3.
+        page_refs = []  # (file_id, page_index)
+        page_info = {}  # (file_id, page_index) → (ime fajla, otisak stranice)
+        batch_index = DuplicateIndex()
+        history = get_duplicate_index("herbavital")
+        with spooled_uploads(uploaded_files_h) as spooled, PageStore(path for _, path in spooled) as store:
+            for file_id, (file_name, path) in enumerate(spooled):
+                for page_index, f in enumerate(classify_pages(path)):
+                    page_label = f"{file_name} (str. {page_index + 1})"
+                    if f["label"] in (PAGE_BLANK, PAGE_FISCAL):
+                        st.session_state.h_logs.append(("warn", f"{page_label} — preskočeno: {SKIP_REASONS[f['label']]}"))
+                        continue
+                    dup = history.find([f["print"]]) if skip_dups else None
+                    if dup:
+                        st.session_state.h_logs.append(("warn", f"{page_label} — preskočeno: skoro identična stranici {dup}, ranija obrada"))
+                        continue
+                    ref = (file_id, page_index)
+                    page_info[ref] = (file_name, f["print"])
+                    page_refs.append(ref)
+            total_pages = len(page_refs)
+
+            with top_left:
+                with st.spinner("AI obrađuje Herbavital račune..."), hedge_ctx:
+                    hedge_before = hedge_stats()
+                    routing_before = routing_stats()
+                    stage_before = stage_stats()
+                    # Faza 2: pre-scan — izvuci broj računa sa svake stranice
+                    progress = st.progress(0, text="Faza 1/2: Skeniram brojeve računa...")
+                    clock = BatchClock(total_pages)
+
+                    def prescan_progress(i, total, label):
+                        progress.progress(i / total / 2, text=clock.text(i, f"Faza 1/2: {label} ({i+1}/{total})"))
+
+                    invoice_groups = group_pages_by_invoice(page_refs, store, api_key=api_key, provider=provider, progress_cb=prescan_progress)
+                    progress.progress(0.5, text=f"Faza 1/2 gotova! Pronađeno {len(invoice_groups)} računa u {total_pages} stranica")
+
+                    # Faza 3: obradi svaku grupu (spojene stranice → jedan AI poziv)
+                    total_invoices = len(invoice_groups)
+                    extract_clock = BatchClock(total_pages)
+                    done_pages = 0
+
+                    def invoice_jobs():
+                        # Reader nit pipeline-a: jedini korisnik store-a dok traje faza 3
+                        for inv_num, refs in invoice_groups:
+                            n_pages = len(refs)
+                            fname = page_info[refs[0]][0]
+                            first_page = refs[0][1] + 1
+                            label = f"{fname} (račun {inv_num}, {n_pages} str.)" if n_pages > 1 else f"{fname} (str. {first_page})"
+                            yield (label, refs), store.merged_pdf(refs)
+
+                    process = lambda meta, pdf: process_pdf(pdf, filename=meta[0], api_key=api_key, provider=provider, routing=routing)
+                    prepare = lambda pdf: prepare_invoice(pdf, routing=routing)
+                    for i, ((label, refs), invoice_bytes, data, error) in enumerate(run_pipeline(invoice_jobs(), process, prepare), 1):
+                        done_pages += len(refs)
+                        progress.progress(0.5 + (i / total_invoices) * 0.5, text=extract_clock.text(done_pages, f"Faza 2/2: Obrađeno {i}/{total_invoices}: {label}"))
+                        if error is not None:
+                            st.session_state.h_logs.append(("err", f"{label} — {str(error)}"))
+                            continue
+                        dups = [dup for dup in (find_duplicate(batch_index, history, [page_info[ref][1]]) for ref in refs) if dup]
                         broj = data.get("BRDOKFAKT", "")
                         if broj and broj in seen:
                             st.session_state.h_logs.append(("warn", f"{label} — duplikat računa {broj}"))
@@ -912,10 +1278,21 @@ elif st.session_state.page == "herbavital":
                             st.session_state.h_pdf_map[idx] = invoice_bytes
                             st.session_state.h_labels[idx] = label
                             st.session_state.h_logs.append(("ok", f"{label} — {data.get('NAZIVPP','?')} — {data.get('IZNAKFT','?')} KM"))
-                    except Exception as e:
-                        st.session_state.h_logs.append(("err", f"{label} — {str(e)}"))
-
-                progress.progress(1.0, text=f"Gotovo! Obrađeno {len(st.session_state.h_results)} račun(a) iz {total_pages} stranica")
+                            if dups:
+                                st.session_state.h_dups[idx] = ", ".join(dups)
+                                st.session_state.h_logs.append(("warn", f"{label} — mogući duplikat: isti otisak kao {', '.join(dups)}"))
+                        for ref in refs:
+                            batch_index.add([page_info[ref][1]], f"{label}, str. {ref[1] + 1}")
+                            history.add([page_info[ref][1]], f"{label}, str. {ref[1] + 1}")
+
+                    history.save()
+
+                    progress.progress(1.0, text=f"Gotovo! Obrađeno {len(st.session_state.h_results)} račun(a) iz {total_pages} stranica")
+                    st.session_state.h_timings = batch_timings(stage_before, clock, total_pages)
+                    for summary in (hedge_summary(hedge_before), routing_summary(routing_before)):
+                        if summary:
+                            st.caption(summary)
+                    st.caption(timings_summary(st.session_state.h_timings))
 
     if st.session_state.h_results:
         with top_left:
@@ -929,8 +1306,11 @@ elif st.session_state.page == "herbavital":
                     df[col] = ""
 
             edited_df = st.data_editor(df[KIF_HEADERS], use_container_width=True, hide_index=True, num_rows="dynamic", key="data_editor_h")
+            edited_df = show_validation(edited_df, "kif", "BRDOKFAKT")
+            show_possible_duplicates(st.session_state.h_dups)
 
             def create_xls_h(dataframe):
+                import xlwt
                 wb = xlwt.Workbook(encoding="utf-8")
                 ws = wb.add_sheet("Racuni")
                 for c, h in enumerate(KIF_HEADERS):
@@ -945,14 +1325,21 @@ elif st.session_state.page == "herbavital":
             def create_dbf_h(dataframe):
                 return _write_dbf(dataframe, KIF_HEADERS)
 
+            export_before = stage_stats()
+            with stage("export"):
+                dbf_bytes = create_dbf_h(edited_df)
+                xls_bytes = create_xls_h(edited_df)
+                csv_text = edited_df.to_csv(index=False, sep=";", encoding="utf-8-sig")
+
             st.divider()
             e1, e2, e3 = st.columns(3)
             with e1:
-                st.download_button("Preuzmi DBF", create_dbf_h(edited_df), "herbavital.dbf", type="primary", use_container_width=True)
+                st.download_button("Preuzmi DBF", dbf_bytes, "herbavital.dbf", type="primary", use_container_width=True, on_click=learn_partners, args=("kif", edited_df))
             with e2:
-                st.download_button("Preuzmi XLS", create_xls_h(edited_df), "herbavital.xls", use_container_width=True)
+                st.download_button("Preuzmi XLS", xls_bytes, "herbavital.xls", use_container_width=True, on_click=learn_partners, args=("kif", edited_df))
             with e3:
-                st.download_button("Preuzmi CSV", edited_df.to_csv(index=False, sep=";", encoding="utf-8-sig"), "herbavital.csv", use_container_width=True)
+                st.download_button("Preuzmi CSV", csv_text, "herbavital.csv", use_container_width=True, on_click=learn_partners, args=("kif", edited_df))
+            timings_download(st.session_state.get("h_timings"), export_before, "herbavital_vremena.csv", key="h_timings_download")
 
         with top_right:
             st.subheader("PDF pregled")
@@ -978,6 +1365,7 @@ elif st.session_state.page == "herbavital":
             pdf_bytes = st.session_state.h_pdf_map.get(selected)
             if pdf_bytes:
                 st.download_button("Preuzmi ovaj PDF", pdf_bytes, "herbavital_racun.pdf", use_container_width=True, key="pdf_download_h")
+                from pdf2image import convert_from_bytes
                 pages = convert_from_bytes(pdf_bytes, dpi=150)
                 for page in pages:
                     st.image(page, use_container_width=True)
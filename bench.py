@@ -0,0 +1,202 @@
+"""Benchmarkovi pipeline-a nad lokalnim korpusom PDF-ova (bez AI poziva).
+
+Primjeri:
+    python bench.py text --corpus bench_corpus/
+    python bench.py ocr --corpus bench_corpus/skenovi/
+    python bench.py import --repeat 5
+    python bench.py render --corpus bench_corpus/ --workers 0 1 2 4
+"""
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def _corpus_files(corpus):
+    files = sorted(glob.glob(os.path.join(corpus, "**", "*.pdf"), recursive=True))
+    if not files:
+        raise SystemExit(f"Nema PDF fajlova u {corpus}")
+    return files
+
+
+def _tokens(text):
+    # Ista procjena kao processor._estimate_tokens (~4 znaka po tokenu)
+    return len(text) // 4
+
+
+def bench_text(args):
+    """Input tokeni za pdf_text u promptu: puni tekst vs condense_pdf_text."""
+    from processor import extract_text_from_bytes, condense_pdf_text
+
+    total_full = total_condensed = 0
+    t_condense = 0.0
+    print(f"{'fajl':50} {'puni':>8} {'sažet':>8} {'ušteda':>8}")
+    for path in _corpus_files(args.corpus):
+        with open(path, "rb") as f:
+            pdf_bytes = f.read()
+        full = _tokens(extract_text_from_bytes(pdf_bytes))
+        t0 = time.perf_counter()
+        condensed = _tokens(condense_pdf_text(pdf_bytes, max_tokens=args.budget))
+        t_condense += time.perf_counter() - t0
+        total_full += full
+        total_condensed += condensed
+        saved = 100 * (full - condensed) / full if full else 0
+        print(f"{os.path.basename(path)[:50]:50} {full:8} {condensed:8} {saved:7.1f}%")
+    saved = 100 * (total_full - total_condensed) / total_full if total_full else 0
+    print(f"{'UKUPNO':50} {total_full:8} {total_condensed:8} {saved:7.1f}%")
+    print(f"condense_pdf_text: {t_condense * 1000:.1f} ms ukupno")
+
+
+def _image_tokens(pdf_bytes, dpi):
+    """Procjena image tokena po stranici: ~w*h/750, model smanjuje sliku na ~1600 tokena."""
+    import fitz
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        total = 0
+        for page in doc:
+            w, h = page.rect.width / 72 * dpi, page.rect.height / 72 * dpi
+            total += min(int(w * h / 750), 1600)
+        return total
+    finally:
+        doc.close()
+
+
+def bench_ocr(args):
+    """OCR pre-pass: trajanje, dobijeni tekst i ušteda na slici niže rezolucije."""
+    import processor
+    from processor import ocr_prepass, extract_text_from_bytes, pdf_bytes_to_images
+
+    if not processor.OCR_ENABLED:
+        raise SystemExit("tesseract nije instaliran (vidi packages.txt)")
+
+    t_ocr = 0.0
+    totals = {"text": 0, "tok_before": 0, "tok_after": 0, "kb_before": 0, "kb_after": 0}
+    print(f"{'fajl':40} {'OCR ms':>8} {'znakova':>8} {'img tok':>12} {'payload KB':>14}")
+    for path in _corpus_files(args.corpus):
+        with open(path, "rb") as f:
+            pdf_bytes = f.read()
+        t0 = time.perf_counter()
+        ocr_bytes, used = ocr_prepass(pdf_bytes)
+        elapsed = time.perf_counter() - t0
+        t_ocr += elapsed
+        text = len(extract_text_from_bytes(ocr_bytes)) if used else 0
+        dpi_after = processor.OCR_IMAGE_DPI if used else 150
+        tok_before, tok_after = _image_tokens(pdf_bytes, 150), _image_tokens(pdf_bytes, dpi_after)
+        kb_before = sum(len(i) for i in pdf_bytes_to_images(pdf_bytes, dpi=150)[0]) // 1024
+        kb_after = sum(len(i) for i in pdf_bytes_to_images(ocr_bytes, dpi=dpi_after)[0]) // 1024
+        for key, val in zip(totals, (text, tok_before, tok_after, kb_before, kb_after)):
+            totals[key] += val
+        print(f"{os.path.basename(path)[:40]:40} {elapsed * 1000:8.0f} {text:8} "
+              f"{tok_before:5}→{tok_after:<6} {kb_before:6}→{kb_after:<7}")
+    print(f"{'UKUPNO':40} {t_ocr * 1000:8.0f} {totals['text']:8} "
+          f"{totals['tok_before']:5}→{totals['tok_after']:<6} {totals['kb_before']:6}→{totals['kb_after']:<7}")
+    print("Latencija AI poziva nije uključena — mjeri se u aplikaciji (hedge/routing statistika).")
+
+
+_IMPORT_SNIPPET = (
+    "import time, sys; t = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - t); "
+    "print(','.join(m for m in {heavy!r} if m in sys.modules))"
+)
+_HEAVY_MODULES = ("openai", "anthropic", "fitz", "numpy", "pdf2image", "openpyxl", "xlwt")
+
+
+def bench_import(args):
+    """Hladni import processor i app modula u svježem interpreteru (kao start kontejnera)."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in args.modules:
+        times, loaded = [], ""
+        for _ in range(args.repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", _IMPORT_SNIPPET.format(module=module, heavy=_HEAVY_MODULES)],
+                cwd=here, capture_output=True, text=True,
+            )
+            if out.returncode != 0:
+                raise SystemExit(f"import {module} nije uspio:\n{out.stderr}")
+            lines = out.stdout.splitlines()
+            times.append(float(lines[-2]))
+            loaded = lines[-1]
+        print(f"import {module:10} medijan {statistics.median(times) * 1000:7.1f} ms "
+              f"(min {min(times) * 1000:.1f}, n={args.repeat}) — učitano: {loaded or 'ništa od teških modula'}")
+
+        if args.top:
+            out = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                cwd=here, capture_output=True, text=True,
+            )
+            rows = []
+            for line in out.stderr.splitlines():
+                parts = line.split("|")
+                if len(parts) == 3 and parts[1].strip().isdigit():
+                    rows.append((int(parts[1]), parts[2].strip()))
+            for cumulative, name in sorted(rows, reverse=True)[:args.top]:
+                print(f"    {cumulative / 1000:8.1f} ms  {name}")
+
+
+def bench_render(args):
+    """Renderovanje + kodiranje cijelog korpusa sa 0 (u procesu), 1..N worker procesa.
+
+    Fajlovi se šalju iz `--threads` niti istovremeno, kao paralelni AI pozivi u aplikaciji.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import processor
+
+    files = _corpus_files(args.corpus)
+    pages = {path: processor.count_pdf_pages(path) for path in files}
+    total = sum(pages.values())
+    jobs = {path: [(i, args.format, 80) for i in range(n)] for path, n in pages.items()}
+    workers = args.workers or sorted({0, 1, 2, 4, processor.RENDER_WORKERS})
+
+    print(f"{len(files)} fajlova, {total} stranica, {args.dpi} dpi, {args.format}, {args.threads} niti")
+    print(f"{'procesa':>8} {'sekundi':>9} {'str/s':>8} {'ubrzanje':>9}")
+    baseline = None
+    for n in workers:
+        processor.configure_render_pool(n)
+        processor.render_pages(files[0], jobs[files[0]][:1], dpi=args.dpi)  # zagrijavanje (spawn workera)
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            list(pool.map(lambda path: processor.render_pages(path, jobs[path], dpi=args.dpi), files))
+        elapsed = time.perf_counter() - t0
+        baseline = baseline or elapsed
+        label = str(n) if n else "0 (niti)"
+        print(f"{label:>8} {elapsed:9.2f} {total / elapsed:8.1f} {baseline / elapsed:8.2f}x")
+    processor.configure_render_pool(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BS BIRO benchmarkovi")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("text", help="uštede input tokena od sažimanja pdf_text")
+    p.add_argument("--corpus", default="bench_corpus")
+    p.add_argument("--budget", type=int, default=1500, help="budžet tokena (PROMPT_TEXT_TOKENS)")
+    p.set_defaults(func=bench_text)
+
+    p = sub.add_parser("ocr", help="OCR pre-pass: trajanje i ušteda na slikama skenova")
+    p.add_argument("--corpus", default="bench_corpus")
+    p.set_defaults(func=bench_ocr)
+
+    p = sub.add_parser("import", help="vrijeme hladnog importa processor/app")
+    p.add_argument("--modules", nargs="+", default=["processor", "app"])
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--top", type=int, default=10, help="najsporijih modula iz -X importtime (0 = bez)")
+    p.set_defaults(func=bench_import)
+
+    p = sub.add_parser("render", help="skaliranje renderovanja/kodiranja po broju worker procesa")
+    p.add_argument("--corpus", default="bench_corpus")
+    p.add_argument("--workers", type=int, nargs="+", help="broj procesa za test (default 0 1 2 4 i broj jezgara)")
+    p.add_argument("--threads", type=int, default=4, help="istovremenih fajlova (kao paralelni AI pozivi)")
+    p.add_argument("--dpi", type=int, default=150)
+    p.add_argument("--format", choices=["PNG", "JPEG"], default="PNG")
+    p.set_defaults(func=bench_render)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,51 @@
-import openai
-import anthropic
 import base64
+import functools
+import hashlib
+import importlib
 import json
+import multiprocessing
 import random
 import re
-import fitz
-from openpyxl import load_workbook
-from pdf2image import convert_from_path
-from io import BytesIO
+import shutil
+import sqlite3
 import tempfile
 import os
+import queue
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import uuid
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FutureTimeout
+
+
+class _LazyModule:
+    """Modul koji se uvozi tek pri prvom pristupu atributu.
+
+    openai, anthropic, fitz i numpy zajedno nose većinu vremena
+    importa; početna stranica aplikacije i CLI ih često uopće ne trebaju.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+openai = _LazyModule("openai")
+anthropic = _LazyModule("anthropic")
+fitz = _LazyModule("fitz")
+np = _LazyModule("numpy")
 
 MIN_TEXT_LENGTH = 100
+PROMPT_TEXT_TOKENS = 1500   # budžet za pdf_text u promptu (procjena ~4 znaka po tokenu)
 
 KIF_HEADERS = [
     "REDBR", "TIPDOK", "BRDOKFAKT", "DATUMF",
@@ -39,17 +71,36 @@ def _fix_cp1250(s):
     return s
 
 
+# Kolone kupci.xlsx: A naziv (obavezno), B JIB (13 cifara), C PDV broj, D sjedište, E šifra
+CUSTOMER_COLUMNS = ("naziv", "jib", "pdv", "adresa", "sifra")
+
+
+def _read_customer_rows(xlsx_path):
+    """Redovi kupci.xlsx kao liste stringova dužine len(CUSTOMER_COLUMNS)."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(xlsx_path, read_only=True)
+    try:
+        rows = []
+        for row in wb.active.iter_rows(min_row=1, max_col=len(CUSTOMER_COLUMNS), values_only=True):
+            if not row or not row[0]:
+                continue
+            cells = []
+            for v in row:
+                if isinstance(v, float) and v.is_integer():
+                    v = int(v)  # JIB upisan kao broj
+                cells.append(_fix_cp1250(str(v).strip()) if v is not None else "")
+            cells += [""] * (len(CUSTOMER_COLUMNS) - len(cells))
+            rows.append(cells)
+        return rows
+    finally:
+        wb.close()
+
+
 def load_kupci_names(xlsx_path="kupci.xlsx"):
     """Učitava listu pravilnih naziva kupaca iz xlsx fajla."""
     try:
-        wb = load_workbook(xlsx_path, read_only=True)
-        ws = wb.active
-        names = []
-        for row in ws.iter_rows(min_row=1, max_col=1, values_only=True):
-            if row[0]:
-                names.append(_fix_cp1250(str(row[0]).strip()))
-        wb.close()
-        return names
+        return [row[0] for row in _read_customer_rows(xlsx_path)]
     except Exception:
         return []
 
@@ -76,30 +127,56 @@ def _strip_diacritics(name):
     return name.translate(_DIACRITICS_FULL).upper()
 
 
+_NAME_SUFFIXES = {'DOO', 'STR', 'SZR', 'TR', 'UR', 'DD', 'JP', 'JU'}
+
+
+def _name_forms(name):
+    """(normalizovan, bez dijakritika, ključne riječi bez DOO/STR/...) za poređenje naziva."""
+    norm = _normalize_name(name)
+    ascii_name = _strip_diacritics(norm)
+    words = frozenset(w for w in ascii_name.split() if w not in _NAME_SUFFIXES)
+    return norm, ascii_name, words
+
+
+class _NameIndex:
+    """Nazivi sa unaprijed izračunatim oblicima + dict-ovi za tačne pogotke."""
+
+    def __init__(self, entries):
+        self.entries = entries  # (naziv, norm, ascii, words)
+        self.by_norm = {}
+        self.by_ascii = {}
+        for name, norm, ascii_name, _ in entries:
+            self.by_norm.setdefault(norm, name)
+            self.by_ascii.setdefault(ascii_name, name)
+
+    @classmethod
+    def from_names(cls, names):
+        return cls([(name,) + _name_forms(name) for name in names])
+
+
 def match_kupac_name(extracted_name, known_names):
     """Pronalazi najbolje poklapanje iz liste poznatih kupaca.
-    Vraća pravilno ime ako nađe match, inače vraća original."""
+    Vraća pravilno ime ako nađe match, inače vraća original.
+
+    known_names je lista naziva ili CustomerMaster (sa unaprijed izračunatim oblicima)."""
     if not extracted_name or not known_names:
         return extracted_name
 
-    norm_extracted = _normalize_name(extracted_name)
+    norm_extracted, ascii_ext, words_ext = _name_forms(extracted_name)
     if not norm_extracted:
         return extracted_name
 
-    best_match = None
-    best_score = 0
-
-    for known in known_names:
-        norm_known = _normalize_name(known)
+    index = known_names.name_index() if isinstance(known_names, CustomerMaster) else _NameIndex.from_names(known_names)
 
-        # Tačan match nakon normalizacije
-        if norm_extracted == norm_known:
-            return known
+    # Tačan match nakon normalizacije, pa bez dijakritika (CEVABDZINICA == ĆEVABDŽINICA)
+    exact = index.by_norm.get(norm_extracted) or index.by_ascii.get(ascii_ext)
+    if exact:
+        return exact
 
-        # Tačan match bez dijakritika (CEVABDZINICA == ĆEVABDŽINICA)
-        if _strip_diacritics(norm_extracted) == _strip_diacritics(norm_known):
-            return known
+    best_match = None
+    best_score = 0
 
+    for known, norm_known, ascii_known, words_known in index.entries:
         # Jedan sadrži drugi (npr. "ZE TRANS" ⊂ "ZE TRANS DOO")
         if norm_extracted in norm_known or norm_known in norm_extracted:
             overlap = min(len(norm_extracted), len(norm_known))
@@ -111,8 +188,6 @@ def match_kupac_name(extracted_name, known_names):
                 continue
 
         # Substring match bez dijakritika
-        ascii_ext = _strip_diacritics(norm_extracted)
-        ascii_known = _strip_diacritics(norm_known)
         if ascii_ext in ascii_known or ascii_known in ascii_ext:
             overlap = min(len(ascii_ext), len(ascii_known))
             max_len = max(len(ascii_ext), len(ascii_known))
@@ -123,12 +198,9 @@ def match_kupac_name(extracted_name, known_names):
                 continue
 
         # Poređenje ključnih riječi (bez DOO, STR, SZR, TR, UR, DD, JP, JU)
-        suffixes = {'DOO', 'STR', 'SZR', 'TR', 'UR', 'DD', 'JP', 'JU'}
-        words_ext = [w for w in _strip_diacritics(norm_extracted).split() if w not in suffixes]
-        words_known = [w for w in _strip_diacritics(norm_known).split() if w not in suffixes]
         if words_ext and words_known:
-            common = set(words_ext) & set(words_known)
-            total = set(words_ext) | set(words_known)
+            common = words_ext & words_known
+            total = words_ext | words_known
             score = len(common) / len(total) if total else 0
             if score > best_score and score >= 0.6:
                 best_score = score
@@ -137,9 +209,304 @@ def match_kupac_name(extracted_name, known_names):
     return best_match if best_match else extracted_name
 
 
-# Učitaj listu kupaca pri importu
+# ── Matični podaci kupaca (kupci.xlsx → SQLite keš) ──
+# xlsx se parsira samo kad se promijeni; inače se redovi sa već izračunatim
+# normalizovanim oblicima čitaju iz .cache/kupci.sqlite. Kolone B–E su opcione.
+
 _SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-KUPCI_NAMES = load_kupci_names(os.path.join(_SCRIPT_DIR, "kupci.xlsx"))
+CACHE_DIR = os.path.join(_SCRIPT_DIR, ".cache")
+KUPCI_RELOAD_INTERVAL = 5.0   # sekundi između provjera da li se kupci.xlsx promijenio
+_CUSTOMER_CACHE_VERSION = "1"
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CustomerMaster:
+    """Kupci iz kupci.xlsx sa hot reloadom.
+
+    Keš se invalidira po mtime/veličini xlsx fajla, a ako se samo mtime
+    promijeni (kopiranje, touch), SHA-256 sadržaja odlučuje da li treba
+    ponovo parsirati. Provjera mtime-a se radi najviše svakih
+    KUPCI_RELOAD_INTERVAL sekundi.
+    """
+
+    def __init__(self, xlsx_path, cache_path):
+        self.xlsx_path = xlsx_path
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._stamp = None      # (mtime_ns, size) učitanog xlsx-a
+        self._checked = 0.0
+        self._names = []
+        self._index = _NameIndex([])
+        self._by_jib = {}
+
+    def __len__(self):
+        return len(self.names())
+
+    def names(self):
+        self._refresh()
+        return self._names
+
+    def name_index(self):
+        self._refresh()
+        return self._index
+
+    def lookup_jib(self, jib):
+        """Red kupca (dict po CUSTOMER_COLUMNS) za 13-cifreni JIB, ili None."""
+        self._refresh()
+        return self._by_jib.get(jib)
+
+    def _refresh(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._stamp is not None and now - self._checked < KUPCI_RELOAD_INTERVAL:
+                return
+            self._checked = now
+            try:
+                st = os.stat(self.xlsx_path)
+            except OSError:
+                if self._stamp is None:
+                    self._stamp = (0, 0)
+                return
+            stamp = (st.st_mtime_ns, st.st_size)
+            if stamp == self._stamp:
+                return
+            if self._stamp is not None:
+                print(f"  [KUPCI] {os.path.basename(self.xlsx_path)} promijenjen, ponovo učitavam")
+            rows = self._load_cache(stamp)
+            if rows is None:
+                rows = self._build_cache(stamp)
+            self._set_rows(rows)
+            self._stamp = stamp
+
+    def _set_rows(self, rows):
+        # row: naziv, norm, ascii, words, jib, pdv, adresa, sifra
+        self._names = [r[0] for r in rows]
+        self._index = _NameIndex([(r[0], r[1], r[2], frozenset(r[3].split())) for r in rows])
+        by_jib = {}
+        for r in rows:
+            if r[4]:
+                by_jib.setdefault(r[4], dict(zip(CUSTOMER_COLUMNS, (r[0],) + tuple(r[4:]))))
+        self._by_jib = by_jib
+
+    def _load_cache(self, stamp):
+        if not os.path.exists(self.cache_path):
+            return None
+        try:
+            con = sqlite3.connect(self.cache_path)
+            try:
+                meta = dict(con.execute("SELECT key, value FROM meta"))
+                if meta.get("version") != _CUSTOMER_CACHE_VERSION:
+                    return None
+                if (int(meta["mtime_ns"]), int(meta["size"])) != stamp:
+                    if meta.get("sha256") != _file_sha256(self.xlsx_path):
+                        return None
+                    with con:
+                        con.executemany("UPDATE meta SET value = ? WHERE key = ?",
+                                        [(str(stamp[0]), "mtime_ns"), (str(stamp[1]), "size")])
+                return con.execute(
+                    "SELECT naziv, norm, ascii, words, jib, pdv, adresa, sifra FROM kupci ORDER BY id"
+                ).fetchall()
+            finally:
+                con.close()
+        except (sqlite3.Error, KeyError, ValueError, OSError):
+            return None
+
+    def _build_cache(self, stamp):
+        try:
+            raw = _read_customer_rows(self.xlsx_path)
+        except Exception as e:
+            print(f"  [KUPCI] Ne mogu učitati {self.xlsx_path}: {e}")
+            return []
+        rows = []
+        for cells in raw:
+            norm, ascii_name, words = _name_forms(cells[0])
+            jib = re.sub(r'\s', '', cells[1])
+            rows.append((cells[0], norm, ascii_name, " ".join(sorted(words)), jib, *cells[2:]))
+
+        tmp = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            con = sqlite3.connect(tmp)
+            try:
+                with con:
+                    con.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+                    con.execute("CREATE TABLE kupci (id INTEGER PRIMARY KEY, naziv TEXT, norm TEXT, ascii TEXT, "
+                                "words TEXT, jib TEXT, pdv TEXT, adresa TEXT, sifra TEXT)")
+                    con.execute("CREATE INDEX kupci_jib ON kupci (jib)")
+                    con.executemany("INSERT INTO kupci (naziv, norm, ascii, words, jib, pdv, adresa, sifra) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                    con.executemany("INSERT INTO meta VALUES (?, ?)", [
+                        ("version", _CUSTOMER_CACHE_VERSION),
+                        ("mtime_ns", str(stamp[0])),
+                        ("size", str(stamp[1])),
+                        ("sha256", _file_sha256(self.xlsx_path)),
+                    ])
+            finally:
+                con.close()
+            os.replace(tmp, self.cache_path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"  [KUPCI] Keš nije snimljen: {e}")
+        return rows
+
+
+_CUSTOMER_MASTER = CustomerMaster(os.path.join(_SCRIPT_DIR, "kupci.xlsx"), os.path.join(CACHE_DIR, "kupci.sqlite"))
+
+
+def get_customer_master():
+    """Dijeljeni CustomerMaster za kupci.xlsx (učitava se pri prvoj upotrebi)."""
+    return _CUSTOMER_MASTER
+
+
+def get_kupci_names():
+    """Lista naziva kupaca — iz keša, ponovo učitana ako se kupci.xlsx promijenio."""
+    return _CUSTOMER_MASTER.names()
+
+
+# ── Registar partnera po JIB-u ──
+# Partner (kupac za KIF, dobavljač za KUF) se prepoznaje po 13-cifrenom JIB-u.
+# Kad je JIB iz tekstualnog sloja poznat, podaci o partneru se popunjavaju
+# deterministički i prompt ih uopće ne traži.
+
+_JIB_RE = re.compile(r'(?<!\d)4\d{12}(?!\d)')
+
+# Polja partnera po modulu: naziv, sjedište, JIB (13 cifara), PDV broj (12 cifara)
+PARTY_KEYS = {
+    "kif": ("NAZIVPP", "SJEDISTEPP", "IDDVPP", "JIBPUPP"),
+    "kuf": ("NAZIVPP", "SJEDISTEPP", "IDPDVPP", "JIBPUPP"),
+}
+
+
+def _without_party(prompt, keys):
+    """Prompt bez ključeva partnera i pravila za JIB/PDV broj."""
+    key_re = re.compile(r'^\s*"(?:' + "|".join(keys) + r')":')
+    lines = [line for line in prompt.splitlines()
+             if not key_re.match(line) and not line.startswith(("- ID broj (JIB)", "- PDV broj"))]
+    return "\n".join(lines) + "\n"
+
+
+class PartnerRegistry:
+    """Partneri po JIB-u → naziv, sjedište, PDV broj (O(1) lookup).
+
+    Izvori: potvrđeni rezultati (learn, trajno u .cache/), POZNATI_PARTNERI
+    i — za KIF — kolone JIB/adresa iz kupci.xlsx (CustomerMaster).
+    """
+
+    def __init__(self, mode, path=None, master=None):
+        self.mode = mode
+        self.path = path
+        self.master = master
+        self._partners = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        for p in POZNATI_PARTNERI:
+            if _JIB_RE.fullmatch(str(p.get("id", ""))):
+                self._partners[p["id"]] = {"naziv": p["naziv"], "adresa": p.get("adresa", ""), "pdv": p.get("pdv", "")}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._partners.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+
+    def lookup(self, jib):
+        with self._lock:
+            partner = self._partners.get(jib)
+        if partner:
+            return partner
+        if self.master is not None:
+            row = self.master.lookup_jib(jib)
+            if row:
+                return {"naziv": row["naziv"], "adresa": row["adresa"], "pdv": row["pdv"]}
+        return None
+
+    def find_in_text(self, text):
+        """(jib, partner) ako se u tekstu nalazi tačno jedan poznati JIB, inače None."""
+        found = {}
+        for jib in set(_JIB_RE.findall(text)):
+            partner = self.lookup(jib)
+            if partner:
+                found[jib] = partner
+        if len(found) != 1:
+            return None
+        return next(iter(found.items()))
+
+    def apply(self, data, jib, partner, only_empty=False):
+        """Upisuje podatke partnera u rezultat."""
+        naziv_key, adresa_key, jib_key, pdv_key = PARTY_KEYS[self.mode]
+        values = {
+            naziv_key: partner["naziv"],
+            adresa_key: partner["adresa"],
+            jib_key: jib,
+            pdv_key: partner["pdv"] or jib[1:],
+        }
+        for key, val in values.items():
+            if val and not (only_empty and data.get(key)):
+                data[key] = val
+
+    def learn(self, record):
+        """Pamti partnera iz potvrđenog rezultata (validan JIB i naziv)."""
+        naziv_key, adresa_key, jib_key, pdv_key = PARTY_KEYS[self.mode]
+        jib = str(record.get(jib_key, "")).strip()
+        naziv = str(record.get(naziv_key, "")).strip()
+        if not naziv or not _JIB_RE.fullmatch(jib):
+            return
+        entry = {
+            "naziv": naziv,
+            "adresa": str(record.get(adresa_key, "")).strip(),
+            "pdv": str(record.get(pdv_key, "")).strip(),
+        }
+        with self._lock:
+            if self._partners.get(jib) != entry:
+                self._partners[jib] = entry
+                self._dirty = True
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = dict(self._partners)
+            self._dirty = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+_PARTNER_REGISTRIES = {}
+_PARTNER_REGISTRIES_LOCK = threading.Lock()
+
+
+def get_partner_registry(mode):
+    """Dijeljeni PartnerRegistry za "kif" (kupci) ili "kuf" (dobavljači)."""
+    with _PARTNER_REGISTRIES_LOCK:
+        registry = _PARTNER_REGISTRIES.get(mode)
+        if registry is None:
+            registry = PartnerRegistry(
+                mode, os.path.join(CACHE_DIR, f"partneri_{mode}.json"),
+                master=_CUSTOMER_MASTER if mode == "kif" else None,
+            )
+            _PARTNER_REGISTRIES[mode] = registry
+        return registry
+
+
+def __getattr__(name):
+    # processor.KUPCI_NAMES ostaje dostupan spolja, ali bez učitavanja pri importu
+    if name == "KUPCI_NAMES":
+        return get_kupci_names()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 EXTRACTION_PROMPT = """Ovo je račun/faktura. Izvuci polja i vrati kao JSON objekat.
 
@@ -250,100 +617,1219 @@ VAŽNO:
 """
 
 
-def _chat_completion_with_retry(client, max_retries=5, **kwargs):
-    """Poziva chat.completions.create sa retry logikom za 429 rate limit."""
-    for attempt in range(max_retries):
+# ── Tracing (spanovi) ──
+# Po defaultu isključeno — span() tada vraća no-op objekat bez ikakvog rada.
+# configure_tracing(JsonLinesExporter(putanja)) ili env TRACE_JSONL=putanja
+# upisuje svaki završen span kao jedan JSON red (za offline analizu sporih
+# batcheva); TRACE_OTEL=1 prosljeđuje spanove OpenTelemetry traceru.
+
+_CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+_TRACER = None  # aktivni SpanExporter, ili None (tracing isključen)
+
+
+class Span:
+    """Jedan mjereni korak: ime, roditelj, atributi, početak/kraj (epoch sekunde)."""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start = time.time()
+        self.end = None
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, key, amount=1):
+        """Brojač u atributima (npr. retries), siguran i iz više niti."""
+        with self._lock:
+            self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def finish(self):
+        self.end = self.start + (time.perf_counter() - self._t0)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_s": round(self.end - self.start, 6) if self.end else None,
+            "status": self.status,
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class SpanExporter:
+    """Bazni exporter — ne radi ništa. on_start/on_end se zovu iz niti koja mjeri."""
+
+    def on_start(self, span):
+        pass
+
+    def on_end(self, span):
+        pass
+
+
+class JsonLinesExporter(SpanExporter):
+    """Dopisuje završene spanove u fajl, jedan JSON objekat po redu."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def on_end(self, span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class OpenTelemetryExporter(SpanExporter):
+    """Prosljeđuje spanove OpenTelemetry traceru (potreban paket opentelemetry-api).
+
+    Provider i izvoz (OTLP, konzola...) podešava aplikacija kroz OpenTelemetry SDK.
+    """
+
+    def __init__(self, tracer=None):
+        from opentelemetry import trace
+        self._trace = trace
+        self._tracer = tracer or trace.get_tracer("bsbiro.processor")
+        self._live = {}  # naš span_id → OpenTelemetry span
+        self._lock = threading.Lock()
+
+    def on_start(self, span):
+        with self._lock:
+            parent = self._live.get(span.parent_id)
+        ctx = self._trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self._tracer.start_span(span.name, context=ctx, start_time=int(span.start * 1e9))
+        with self._lock:
+            self._live[span.span_id] = otel_span
+
+    def on_end(self, span):
+        with self._lock:
+            otel_span = self._live.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        otel_span.set_attributes({
+            k: v for k, v in span.attributes.items() if isinstance(v, (str, bool, int, float))
+        })
+        if span.status != "ok":
+            otel_span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, span.status))
+        otel_span.end(end_time=int(span.end * 1e9))
+
+
+def configure_tracing(exporter):
+    """Postavlja exporter za cijeli proces (None = isključeno). Vraća prethodni."""
+    global _TRACER
+    previous, _TRACER = _TRACER, exporter
+    return previous
+
+
+def current_span():
+    """Aktivni span u ovom kontekstu (za dodavanje atributa), ili no-op."""
+    return _CURRENT_SPAN.get() or _NOOP_SPAN
+
+
+@contextmanager
+def span(name, **attributes):
+    """Otvara span kao dijete aktivnog spana; atributi se mogu dodati i kroz .set()."""
+    tracer = _TRACER
+    if tracer is None:
+        yield _NOOP_SPAN
+        return
+    sp = Span(name, _CURRENT_SPAN.get(), attributes)
+    tracer.on_start(sp)
+    token = _CURRENT_SPAN.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.status = f"error: {type(e).__name__}: {e}"
+        raise
+    finally:
+        _CURRENT_SPAN.reset(token)
+        sp.finish()
         try:
-            return client.chat.completions.create(**kwargs)
-        except openai.RateLimitError:
-            if attempt == max_retries - 1:
+            tracer.on_end(sp)
+        except Exception as e:  # exporter ne smije srušiti obradu
+            print(f"  [TRACE] Greška exportera: {e}")
+
+
+if os.environ.get("TRACE_JSONL"):
+    configure_tracing(JsonLinesExporter(os.environ["TRACE_JSONL"]))
+elif os.environ.get("TRACE_OTEL") in ("1", "true"):
+    configure_tracing(OpenTelemetryExporter())
+
+
+# ── Mjerenje faza obrade ──
+# Ukupno vrijeme i broj poziva po fazi, za cijeli proces. UI uzima kopiju
+# prije i poslije batcha (kao hedge_stats / routing_stats) i prikazuje razliku.
+# stage(...) radi i kao dekorator, a kad je tracing uključen otvara i span.
+
+STAGES = ("text", "rasterize", "encode", "ai", "post", "export")
+_STAGE_LOCK = threading.Lock()
+STAGE_STATS = {name: {"calls": 0, "seconds": 0.0} for name in STAGES}
+
+
+@contextmanager
+def stage(name):
+    """Mjeri trajanje bloka i dodaje ga u STAGE_STATS[name]; vraća span faze."""
+    t0 = time.perf_counter()
+    try:
+        with span(name) as sp:
+            yield sp
+    finally:
+        record_stage(name, time.perf_counter() - t0)
+
+
+def record_stage(name, seconds):
+    """Dodaje izmjereno vrijeme fazi (za dijelove koji nisu jedan blok)."""
+    with _STAGE_LOCK:
+        STAGE_STATS[name]["calls"] += 1
+        STAGE_STATS[name]["seconds"] += seconds
+
+
+def stage_stats():
+    """Kopija brojača faza: {faza: {"calls", "seconds"}}."""
+    with _STAGE_LOCK:
+        return {name: dict(v) for name, v in STAGE_STATS.items()}
+
+
+# ── Priprema dokumenta unaprijed (keš po dokumentu za pipeline) ──
+# Unutar run_pipeline svaki dokument ima svoj keš: prepare faza unaprijed
+# izračuna OCR, tekst i slike, a process_* ih u AI fazi samo preuzme. Van
+# pipeline-a keš nije postavljen i funkcije rade kao i prije.
+
+_PREPARED = contextvars.ContextVar("prepared", default=None)
+
+
+def _per_document(fn):
+    """Pamti rezultat za iste PDF bajtove (isti objekat) u kešu tekućeg dokumenta."""
+    @functools.wraps(fn)
+    def wrapper(pdf_bytes, *args, **kwargs):
+        memo = _PREPARED.get()
+        if memo is None:
+            return fn(pdf_bytes, *args, **kwargs)
+        key = (fn.__name__, id(pdf_bytes), args, tuple(sorted(kwargs.items())))
+        hit = memo.get(key)
+        if hit is not None and hit[0] is pdf_bytes:
+            return hit[1]
+        result = fn(pdf_bytes, *args, **kwargs)
+        memo[key] = (pdf_bytes, result)
+        return result
+    return wrapper
+
+
+# ── Rate limiting — jedan zajednički scheduler po provideru/ključu za cijeli proces ──
+# Svi workeri (Streamlit, server.py) dijele isti limiter, pa nakon 429 ne udaraju
+# ponovo svi u isto vrijeme. Limiti se uče iz rate-limit headera odgovora.
+
+_MAX_RETRIES = 5
+_MAX_BACKOFF = 30
+_DECREASE_WINDOW = 1.0   # min. sekundi između dva prepolovljavanja konkurentnosti
+_DEFAULT_LIMITS = {
+    # provider prefiks → (zahtjeva/min, input tokena/min, početna konkurentnost)
+    "claude": (50, 30000, 2),
+    "openai": (500, 30000, 2),
+}
+
+
+class _TokenBucket:
+    """Token bucket koji se puni brzinom `per_minute` do kapaciteta `per_minute`."""
+
+    def __init__(self, per_minute):
+        self.per_minute = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        rate = self.per_minute / 60.0
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Koliko sekundi treba čekati da `amount` bude dostupan (0 ako je odmah)."""
+        self._refill(now)
+        amount = min(amount, self.per_minute)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.per_minute
+
+    def take(self, amount):
+        self.tokens -= amount
+
+    def update_from_server(self, limit=None, remaining=None, now=None):
+        """Usklađuje bucket sa limitom/preostalim iznosom iz headera."""
+        if limit:
+            self.per_minute = float(limit)
+        if remaining is not None:
+            self._refill(now or time.monotonic())
+            self.tokens = min(self.tokens, float(remaining))
+
+
+def _parse_duration(value):
+    """Parsira trajanje iz headera: '1.5', '20ms', '6m0s', '1h2m3s' ili HTTP/ISO datum → sekunde."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    m = re.fullmatch(r'(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m(?!s))?(?:(\d+(?:\.\d+)?)s)?(?:(\d+(?:\.\d+)?)ms)?', value)
+    if m and any(m.groups()):
+        h, mi, s, ms = (float(g) if g else 0.0 for g in m.groups())
+        return h * 3600 + mi * 60 + s + ms / 1000
+    try:
+        from datetime import datetime, timezone
+        from email.utils import parsedate_to_datetime
+        if re.match(r'\d{4}-\d{2}-\d{2}T', value):
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        else:
+            dt = parsedate_to_datetime(value)
+        return max(0.0, (dt - datetime.now(timezone.utc)).total_seconds())
+    except (ValueError, TypeError):
+        return None
+
+
+def _retry_after(headers):
+    """Vraća Retry-After iz headera u sekundama, ili None."""
+    if not headers:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000
+        except ValueError:
+            pass
+    return _parse_duration(headers.get("retry-after"))
+
+
+class RateLimiter:
+    """Scheduler za jedan provider/ključ: request bucket, token bucket i AIMD konkurentnost.
+
+    Konkurentnost raste za ~1 po "prozoru" uspješnih poziva (additive increase),
+    a na 429 se prepolovi (multiplicative decrease) — najviše jednom po prozoru,
+    jer niz 429 od zahtjeva koji su već bili u letu javlja isto zagušenje. Kad
+    latencija naglo skoči (> 2x prosjek), rast se zaustavlja.
+    """
+
+    def __init__(self, rpm, tpm, concurrency=2, max_concurrency=16):
+        self._cond = threading.Condition()
+        self.requests = _TokenBucket(rpm)
+        self.tokens = _TokenBucket(tpm)
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.decrease_until = 0.0
+        self.latency_avg = None
+        self.stats = {"requests": 0, "rate_limited": 0, "tokens": 0, "waited_s": 0.0}
+
+    def acquire(self, est_tokens=0):
+        """Blokira dok ne bude slobodan slot, zahtjev i dovoljno tokena."""
+        t0 = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    self.blocked_until - now,
+                    self.requests.wait_time(1, now),
+                    self.tokens.wait_time(est_tokens, now),
+                )
+                if wait <= 0 and self.in_flight < max(1, int(self.limit)):
+                    self.requests.take(1)
+                    self.tokens.take(est_tokens)
+                    self.in_flight += 1
+                    self.stats["requests"] += 1
+                    self.stats["waited_s"] += now - t0
+                    return
+                # Mali jitter da workeri ne krenu svi u istoj milisekundi
+                self._cond.wait(timeout=wait + random.uniform(0, 0.05) if wait > 0 else 1.0)
+
+    def release(self, latency=None, headers=None, used_tokens=None, est_tokens=0,
+                rate_limited=False, attempt=0):
+        """Oslobađa slot i prilagođava limite. Vraća koliko sekundi čekati prije retry-a."""
+        delay = 0.0
+        with self._cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            self._update_from_headers(headers, now)
+            if used_tokens is not None:
+                # Ispravi procjenu stvarnom potrošnjom
+                self.tokens.take(used_tokens - est_tokens)
+                self.stats["tokens"] += used_tokens
+            if rate_limited:
+                self.stats["rate_limited"] += 1
+                retry_after = _retry_after(headers)
+                if retry_after is None:
+                    # Full jitter eksponencijalni backoff
+                    retry_after = random.uniform(0, min(2 ** attempt, _MAX_BACKOFF))
+                if now >= self.decrease_until:
+                    # Ostali 429 do isteka prozora (blokada ili jedna prosječna
+                    # latencija) dolaze od zahtjeva poslanih prije smanjenja
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decrease_until = now + max(retry_after, self.latency_avg or 0.0, _DECREASE_WINDOW)
+                delay = retry_after
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                self.requests.tokens = min(self.requests.tokens, 0.0)
+            elif latency is not None:
+                if self.latency_avg is None:
+                    self.latency_avg = latency
+                slow = latency > 2 * self.latency_avg
+                self.latency_avg = 0.8 * self.latency_avg + 0.2 * latency
+                if not slow:
+                    self.limit = min(self.max_concurrency, self.limit + 1.0 / max(1.0, self.limit))
+            self._cond.notify_all()
+        return delay
+
+    def _update_from_headers(self, headers, now):
+        if not headers:
+            return
+
+        def _num(name):
+            try:
+                return float(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        for prefix in ("x-ratelimit-", "anthropic-ratelimit-"):
+            req_limit, req_left = _num(prefix + "limit-requests"), _num(prefix + "remaining-requests")
+            if prefix == "anthropic-ratelimit-":
+                req_limit = _num(prefix + "requests-limit")
+                req_left = _num(prefix + "requests-remaining")
+                tok_limit = _num(prefix + "input-tokens-limit") or _num(prefix + "tokens-limit")
+                tok_left = _num(prefix + "input-tokens-remaining")
+                if tok_left is None:
+                    tok_left = _num(prefix + "tokens-remaining")
+            else:
+                tok_limit = _num(prefix + "limit-tokens")
+                tok_left = _num(prefix + "remaining-tokens")
+            if req_limit or req_left is not None:
+                self.requests.update_from_server(req_limit, req_left, now)
+            if tok_limit or tok_left is not None:
+                self.tokens.update_from_server(tok_limit, tok_left, now)
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "concurrency": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "rpm": self.requests.per_minute,
+                "tpm": self.tokens.per_minute,
+                "latency_avg_s": round(self.latency_avg, 2) if self.latency_avg else None,
+                **self.stats,
+            }
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def _limiter_key(provider, api_key):
+    digest = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+    return provider, digest
+
+
+def get_rate_limiter(provider, api_key):
+    """Vraća zajednički RateLimiter za provider + API ključ (kreira ga ako ne postoji)."""
+    key = _limiter_key(provider, api_key)
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(key)
+        if limiter is None:
+            family = "claude" if provider.startswith("claude") else "openai"
+            rpm, tpm, concurrency = _DEFAULT_LIMITS.get(family, _DEFAULT_LIMITS["openai"])
+            limiter = RateLimiter(rpm, tpm, concurrency=concurrency)
+            _LIMITERS[key] = limiter
+        return limiter
+
+
+def configure_rate_limit(provider, api_key, rpm=None, tpm=None, concurrency=None, max_concurrency=None):
+    """Ručno postavlja limite naloga (npr. za viši tier) prije prvog poziva."""
+    limiter = get_rate_limiter(provider, api_key)
+    with limiter._cond:
+        if rpm:
+            limiter.requests.update_from_server(limit=rpm)
+        if tpm:
+            limiter.tokens.update_from_server(limit=tpm)
+        if concurrency:
+            limiter.limit = float(concurrency)
+        if max_concurrency:
+            limiter.max_concurrency = max_concurrency
+    return limiter
+
+
+def rate_limit_stats():
+    """Stanje svih limitera: {(provider, hash ključa): snapshot}."""
+    with _LIMITERS_LOCK:
+        items = list(_LIMITERS.items())
+    return {f"{p}:{h}": lim.snapshot() for (p, h), lim in items}
+
+
+def _estimate_tokens(content_parts):
+    """Gruba procjena input tokena: ~4 znaka po tokenu, ~1600 tokena po slici."""
+    n = 0
+    for part in content_parts:
+        if part["type"] == "text":
+            n += len(part["text"]) // 4
+        else:
+            n += 1600
+    return n
+
+
+def _is_transient(exc):
+    """Greška koju vrijedi ponoviti: 429, 5xx (uklj. 529 overloaded), prekid veze ili timeout."""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # APITimeoutError je podklasa APIConnectionError u oba SDK-a; po imenu da
+    # se ne uvozi SDK drugog providera
+    return any(cls.__name__ == "APIConnectionError" for cls in type(exc).__mro__)
+
+
+def _call_with_limiter(limiter, create_fn, est_tokens, usage_fn):
+    """Poziva create_fn() (with_raw_response) kroz limiter, sa retry-em na prolazne greške.
+
+    SDK klijenti imaju max_retries=0, pa svaki ponovljeni pokušaj prolazi kroz
+    scheduler. 429 i 529 (zagušenje) smanjuju konkurentnost i čekaju
+    Retry-After iz headera; 5xx, prekid veze i timeout samo čekaju
+    full-jitter backoff. Ako headera nema, i 429/529 čekaju backoff.
+    """
+    for attempt in range(_MAX_RETRIES):
+        limiter.acquire(est_tokens)
+        t0 = time.monotonic()
+        try:
+            raw = create_fn()
+        except Exception as e:
+            if not _is_transient(e):
+                limiter.release()
+                raise
+            response = getattr(e, "response", None)
+            congested = getattr(e, "status_code", None) in (429, 529)
+            delay = limiter.release(
+                headers=getattr(response, "headers", None),
+                rate_limited=congested, attempt=attempt,
+            )
+            if attempt == _MAX_RETRIES - 1:
                 raise
-            wait = min(2 ** attempt, 30)
-            time.sleep(wait)
+            if not congested:
+                delay = random.uniform(0, min(2 ** attempt, _MAX_BACKOFF))
+            current_span().add("retries")
+            current_span().add("retry_wait_s", round(delay, 3))
+            time.sleep(delay)
+            continue
+        parsed = raw.parse()
+        limiter.release(
+            latency=time.monotonic() - t0, headers=raw.headers,
+            used_tokens=usage_fn(parsed), est_tokens=est_tokens,
+        )
+        return parsed
+
+
+def _openai_usage(response):
+    usage = getattr(response, "usage", None)
+    return usage.prompt_tokens if usage else None
+
+
+def _anthropic_usage(response):
+    usage = getattr(response, "usage", None)
+    return usage.input_tokens if usage else None
 
 
 _CLAUDE_MODELS = {
+    "claude-haiku": "claude-haiku-4-5",
     "claude-sonnet": "claude-sonnet-4-6",
     "claude-opus": "claude-opus-4-6",
 }
 
+_OPENAI_MODELS = {
+    "openai-mini": "gpt-4o-mini",
+    "openai": "gpt-4o",
+}
+
+# Dodatni provideri (npr. lažni provider za end-to-end testove servisa)
+_PROVIDERS = {}
 
-def _ai_call(content_parts, api_key, provider="openai", max_tokens=2000):
+
+# ── Poruke neutralne na providera ──
+# Interno se slika nosi kao sirovi PNG/JPEG bajtovi + mime tip. Adapter
+# providera je base64-kodira tačno jednom, direktno u oblik koji ide u tijelo
+# zahtjeva — bez data: URL-a koji se poslije ponovo raščlanjuje.
+
+def text_part(text):
+    return {"type": "text", "text": text}
+
+
+def image_part(data, mime="image/png"):
+    """Slika kao sirovi bajtovi (PNG/JPEG) za content_parts."""
+    return {"type": "image", "data": data, "mime": mime}
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def _openai_content(content_parts):
+    """content_parts → OpenAI chat content (slika kao data: URL)."""
+    return [
+        {"type": "image_url", "image_url": {"url": f"data:{p['mime']};base64,{_b64(p['data'])}"}}
+        if p["type"] == "image" else p
+        for p in content_parts
+    ]
+
+
+def _claude_content(content_parts):
+    """content_parts → Anthropic content blokovi (slika kao base64 source)."""
+    return [
+        {"type": "image", "source": {"type": "base64", "media_type": p["mime"], "data": _b64(p["data"])}}
+        if p["type"] == "image" else p
+        for p in content_parts
+    ]
+
+
+def register_provider(name, call_fn):
+    """Registruje dodatni provider pod imenom `name`.
+
+    call_fn(content_parts, api_key, max_tokens=...) mora vratiti response text,
+    isto kao _ai_call. Dobija content u OpenAI formatu (slike kao data: URL).
+    """
+    _PROVIDERS[name] = call_fn
+
+
+def unregister_provider(name):
+    """Uklanja provider registrovan sa register_provider."""
+    _PROVIDERS.pop(name, None)
+
+
+def _ai_call_single(content_parts, api_key, provider="openai", max_tokens=2000, schema=None):
+    """Jedan AI poziv na tačno jedan provider (bez hedginga i failovera).
+
+    Svi pozivi idu kroz zajednički RateLimiter za provider + ključ. SDK-ov
+    ugrađeni retry je isključen da ponovljeni pokušaji ne bi zaobišli
+    scheduler — 429, 5xx, prekid veze i timeout ponavlja _call_with_limiter.
+
+    Sa `schema` (vidi _schema) odgovor je JSON po šemi: OpenAI response_format
+    json_schema, Claude tool use sa input_schema.
+    """
+    if provider in _PROVIDERS:
+        content = _openai_content(content_parts)
+        if schema is not None:
+            return _PROVIDERS[provider](content, api_key, max_tokens=max_tokens, schema=schema)
+        return _PROVIDERS[provider](content, api_key, max_tokens=max_tokens)
+    limiter = get_rate_limiter(provider, api_key)
+    est = _estimate_tokens(content_parts)
+    if provider.startswith("claude"):
+        client = anthropic.Anthropic(api_key=api_key, max_retries=0)
+        model = _CLAUDE_MODELS.get(provider, _CLAUDE_MODELS["claude-sonnet"])
+        claude_content = _claude_content(content_parts)
+
+        extra = {}
+        if schema is not None:
+            extra["tools"] = [{
+                "name": schema["name"],
+                "description": "Vrati izvučena polja.",
+                "input_schema": schema["schema"],
+            }]
+            extra["tool_choice"] = {"type": "tool", "name": schema["name"]}
+        response = _call_with_limiter(
+            limiter,
+            lambda: client.messages.with_raw_response.create(
+                model=model,
+                max_tokens=max_tokens,
+                messages=[{"role": "user", "content": claude_content}],
+                **extra,
+            ),
+            est, _anthropic_usage,
+        )
+        for block in response.content:
+            if block.type == "tool_use":
+                return json.dumps(block.input, ensure_ascii=False)
+        return response.content[0].text
+    else:
+        # OpenAI
+        client = openai.OpenAI(api_key=api_key, max_retries=0)
+        model = _OPENAI_MODELS.get(provider, _OPENAI_MODELS["openai"])
+        openai_content = _openai_content(content_parts)
+        extra = {}
+        if schema is not None:
+            extra["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": schema["name"], "strict": True, "schema": schema["schema"]},
+            }
+        response = _call_with_limiter(
+            limiter,
+            lambda: client.chat.completions.with_raw_response.create(
+                model=model,
+                temperature=0,
+                max_tokens=max_tokens,
+                messages=[{"role": "user", "content": openai_content}],
+                **extra,
+            ),
+            est, _openai_usage,
+        )
+        return response.choices[0].message.content.strip()
+
+
+# ── Strukturirani izlaz ──
+# Kompaktne šeme: samo ključevi, bez opisa (opisi su već u promptu), pa model
+# ne troši output tokene na ponavljanje opisa. Svi odgovori idu kroz jedan
+# parser (_parse_json_reply); ako ni lokalni popravak ne uspije, jeftin
+# tekstualni poziv popravlja JSON umjesto da se stranica izgubi.
+
+def _schema(name, keys, array_key=None):
+    """Kompaktna JSON šema: objekat sa string poljima (ili {array_key: [objekat]})."""
+    obj = {
+        "type": "object",
+        "properties": {k: {"type": "string"} for k in keys},
+        "required": list(keys),
+        "additionalProperties": False,
+    }
+    if array_key:
+        obj = {
+            "type": "object",
+            "properties": {array_key: {"type": "array", "items": obj}},
+            "required": [array_key],
+            "additionalProperties": False,
+        }
+    return {"name": name, "schema": obj}
+
+
+KIF_SCHEMA = _schema("kif_racun", [
+    "BRDOKFAKT", "DATUMF", "NAZIVPP", "SJEDISTEPP", "IDDVPP", "JIBPUPP",
+    "IZNOSNOV", "IZNPDV", "IZNAKFT", "REF", "OSL",
+    "NAZIV_IZDAVACA", "KUPAC_SIFRA", "NAZIV_USLUGE",
+])
+KUF_SCHEMA = _schema("kuf_racun", [
+    "BROJFAKT", "DATUMF", "DATUMPF", "NAZIVPP", "SJEDISTEPP", "IDPDVPP", "JIBPUPP",
+    "IZNBEZPDV", "IZNSAPDV", "IZNPDV", "Moze",
+])
+FISCAL_SCHEMA = _schema("fiskalni_racuni", [
+    "DATUMDOK", "BROJKIFA", "SADRZAJ", "PRESCAN_LINES", "GOTOVINA", "KARTICNO", "DEPOZIT",
+], array_key="racuni")
+TOTALS_SCHEMA = _schema("ukupni_iznosi", ["IZNAKFT", "IZNOSNOV", "IZNPDV"])
+# Kad je partner poznat po JIB-u (PartnerRegistry), njegova polja se ne traže
+KIF_SCHEMA_KNOWN_PARTY = _schema("kif_racun", [k for k in KIF_SCHEMA["schema"]["required"] if k not in PARTY_KEYS["kif"]])
+KUF_SCHEMA_KNOWN_PARTY = _schema("kuf_racun", [k for k in KUF_SCHEMA["schema"]["required"] if k not in PARTY_KEYS["kuf"]])
+KIF_PROMPT_KNOWN_PARTY = _without_party(EXTRACTION_PROMPT, PARTY_KEYS["kif"])
+KUF_PROMPT_KNOWN_PARTY = _without_party(KUF_EXTRACTION_PROMPT, PARTY_KEYS["kuf"])
+
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+
+
+def _repair_json_local(s):
+    """Lokalni popravak čestih grešaka: zarezi na kraju, pametni navodnici, nezatvorene zagrade."""
+    s = s.replace("\u201c", '"').replace("\u201d", '"').replace("\u201e", '"')
+    s = _TRAILING_COMMA_RE.sub(r'\1', s)
+    stack = []
+    in_str = False
+    escaped = False
+    for ch in s:
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    if in_str:
+        s += '"'
+    return _TRAILING_COMMA_RE.sub(r'\1', s + "".join(reversed(stack)))
+
+
+def _parse_json_reply(raw, expect="object"):
+    """Jedini parser AI odgovora: skida markdown, izdvaja JSON i (ako treba) ga popravlja.
+
+    Args:
+        raw: tekst odgovora
+        expect: "object" → dict, "array" → lista dict-ova
+    Raises:
+        ValueError: ako se JSON ne može izvući ni nakon lokalnog popravka
+    """
+    s = (raw or "").strip()
+    if s.startswith("```"):
+        s = s.split("\n", 1)[-1]
+        s = s.rsplit("```", 1)[0]
+    starts = [i for i in (s.find("{"), s.find("[")) if i >= 0]
+    if not starts:
+        raise ValueError("Odgovor ne sadrži JSON")
+    s = s[min(starts):]
+    end = max(s.rfind("}"), s.rfind("]")) + 1
+    try:
+        data = json.loads(s[:end] if end > 0 else s)
+    except ValueError:
+        data = json.loads(_repair_json_local(s))
+
+    if expect == "any":
+        return data
+    if expect == "array":
+        if isinstance(data, dict):
+            lists = [v for v in data.values() if isinstance(v, list)]
+            data = lists[0] if len(data) == 1 and lists else [data]
+        return [d for d in data if isinstance(d, dict)]
+    if isinstance(data, list):
+        if not data or not isinstance(data[0], dict):
+            raise ValueError("Očekivan JSON objekat")
+        data = data[0]
+    return data
+
+
+def _extract_json(content_parts, api_key, provider, schema, max_tokens, expect="object"):
+    """AI poziv sa strukturiranim izlazom + jedan parse path + jeftin popravak."""
+    raw = _ai_call(content_parts, api_key, provider=provider, max_tokens=max_tokens, schema=schema)
+    try:
+        return _parse_json_reply(raw, expect)
+    except ValueError:
+        pass
+    # Popravak: samo tekst (bez slika), brzi model iste porodice
+    repair_provider = provider if provider in _PROVIDERS else _FAST_PROVIDER.get(provider, provider)
+    print(f"  [JSON] Neispravan odgovor, popravljam sa {repair_provider}")
+    repair = [{"type": "text", "text": (
+        "Sljedeći odgovor je trebao biti JSON ali nije ispravan. Popravi ga tako da "
+        "bude ispravan JSON sa istim ključevima i vrijednostima. Ne izmišljaj vrijednosti.\n\n"
+        f"---\n{raw}\n---"
+    )}]
+    fixed = _ai_call(repair, api_key, provider=repair_provider, max_tokens=max_tokens, schema=schema)
+    return _parse_json_reply(fixed, expect)
+
+
+# ── Hedging i failover ──
+# Uključuje se po batchu sa `with hedging(...)`. Ako primarni provider ne odgovori
+# do zadatog percentila nedavne latencije, isti zahtjev ide i na sekundarni, a
+# pobjeđuje prvi validan odgovor. Uzastopne greške koje nisu 429 (npr. 529
+# overloaded, timeout) privremeno prebacuju sve pozive na sekundarni provider.
+
+_HEDGE_CONFIG = contextvars.ContextVar("hedge_config", default=None)
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+_LATENCY_WINDOW = 50
+_LATENCIES = {}         # provider → deque nedavnih latencija (s)
+_HEALTH = {}            # provider → {"failures": n, "down_until": monotonic}
+_HEDGE_LOCK = threading.Lock()
+HEDGE_STATS = {
+    "calls": 0,
+    "hedges_sent": 0,
+    "hedge_wins": 0,
+    "tail_saved_s": 0.0,
+    "extra_input_tokens_est": 0,
+    "failovers": 0,
+}
+
+
+@contextmanager
+def hedging(secondary_provider, secondary_api_key, percentile=0.9, min_delay=3.0,
+            default_delay=30.0, hedge=True, failover_after=3, failover_cooldown=120):
+    """Uključuje hedging/failover za sve _ai_call pozive unutar bloka.
+
+    Args:
+        secondary_provider: provider za duplikat zahtjeva / failover
+        secondary_api_key: API ključ sekundarnog providera
+        percentile: percentil nedavne latencije primarnog nakon kojeg se šalje duplikat
+        min_delay: najkraće čekanje prije duplikata (s)
+        default_delay: čekanje dok još nema dovoljno izmjerenih latencija (s)
+        hedge: False = samo failover, bez duplikata
+        failover_after: broj uzastopnih grešaka (ne-429) nakon kojih se primarni preskače
+        failover_cooldown: koliko sekundi se primarni preskače
+    """
+    token = _HEDGE_CONFIG.set({
+        "provider": secondary_provider,
+        "api_key": secondary_api_key,
+        "percentile": percentile,
+        "min_delay": min_delay,
+        "default_delay": default_delay,
+        "hedge": hedge,
+        "failover_after": failover_after,
+        "failover_cooldown": failover_cooldown,
+    })
+    try:
+        yield
+    finally:
+        _HEDGE_CONFIG.reset(token)
+
+
+def hedge_stats():
+    """Kopija brojača hedginga: poslani duplikati, pobjede, ušteđeno vrijeme, dodatni tokeni."""
+    with _HEDGE_LOCK:
+        return dict(HEDGE_STATS)
+
+
+def _is_rate_limit(exc):
+    return type(exc).__name__ == "RateLimitError" or getattr(exc, "status_code", None) == 429
+
+
+def _is_valid_reply(raw, expect_json):
+    """Da li je odgovor upotrebljiv — za JSON pozive mora se parsirati."""
+    if not raw or not raw.strip():
+        return False
+    if not expect_json:
+        return True
+    try:
+        _parse_json_reply(raw, expect="any")
+        return True
+    except ValueError:
+        return False
+
+
+def _provider_down(provider):
+    with _HEDGE_LOCK:
+        h = _HEALTH.get(provider)
+        return bool(h and h["down_until"] > time.monotonic())
+
+
+def _timed_call(content_parts, api_key, provider, max_tokens, cfg=None, schema=None):
+    """_ai_call_single + evidencija latencije i uzastopnih grešaka providera."""
+    t0 = time.monotonic()
+    try:
+        raw = _ai_call_single(content_parts, api_key, provider=provider, max_tokens=max_tokens, schema=schema)
+    except Exception as e:
+        if not _is_rate_limit(e):
+            with _HEDGE_LOCK:
+                h = _HEALTH.setdefault(provider, {"failures": 0, "down_until": 0.0})
+                h["failures"] += 1
+                if cfg and h["failures"] >= cfg["failover_after"]:
+                    h["down_until"] = time.monotonic() + cfg["failover_cooldown"]
+                    h["failures"] = 0
+                    print(f"  [FAILOVER] {provider} → {cfg['provider']} na {cfg['failover_cooldown']}s")
+        raise
+    with _HEDGE_LOCK:
+        _LATENCIES.setdefault(provider, deque(maxlen=_LATENCY_WINDOW)).append(time.monotonic() - t0)
+        h = _HEALTH.get(provider)
+        if h:
+            h["failures"] = 0
+    return raw
+
+
+def _hedge_delay(provider, cfg):
+    with _HEDGE_LOCK:
+        samples = sorted(_LATENCIES.get(provider, ()))
+    if len(samples) < 5:
+        return cfg["default_delay"]
+    idx = min(len(samples) - 1, int(len(samples) * cfg["percentile"]))
+    return max(cfg["min_delay"], samples[idx])
+
+
+def _hedged_call(content_parts, api_key, provider, max_tokens, cfg, expect_json, schema=None):
+    """Šalje primarni zahtjev; ako kasni ili ne valja, šalje duplikat na sekundarni."""
+    t0 = time.monotonic()
+    # copy_context: span poziva (retries) vidljiv i u hedge niti
+    primary = _HEDGE_POOL.submit(contextvars.copy_context().run, _timed_call, content_parts, api_key, provider, max_tokens, cfg, schema)
+    fallback_raw = None
+    last_error = None
+    try:
+        raw = primary.result(timeout=_hedge_delay(provider, cfg))
+        if _is_valid_reply(raw, expect_json):
+            return raw
+        fallback_raw = raw
+    except FutureTimeout:
+        pass
+    except Exception as e:
+        if _is_rate_limit(e):
+            raise
+        last_error = e
+
+    secondary = _HEDGE_POOL.submit(
+        contextvars.copy_context().run,
+        _timed_call, content_parts, cfg["api_key"], cfg["provider"], max_tokens, cfg, schema,
+    )
+    with _HEDGE_LOCK:
+        HEDGE_STATS["hedges_sent"] += 1
+        HEDGE_STATS["extra_input_tokens_est"] += _estimate_tokens(content_parts)
+
+    pending = {secondary} if primary.done() else {primary, secondary}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            try:
+                raw = f.result()
+            except Exception as e:
+                last_error = e
+                continue
+            if not _is_valid_reply(raw, expect_json):
+                fallback_raw = fallback_raw or raw
+                continue
+            if f is secondary:
+                won_at = time.monotonic() - t0
+                with _HEDGE_LOCK:
+                    HEDGE_STATS["hedge_wins"] += 1
+
+                def _record_saved(p, won_at=won_at):
+                    saved = time.monotonic() - t0 - won_at
+                    with _HEDGE_LOCK:
+                        HEDGE_STATS["tail_saved_s"] += saved
+
+                if not primary.done():
+                    primary.add_done_callback(_record_saved)
+            return raw
+    if fallback_raw is not None:
+        return fallback_raw
+    raise last_error
+
+
+@stage("ai")
+def _ai_call(content_parts, api_key, provider="openai", max_tokens=2000, expect_json=True, schema=None):
     """Unified AI poziv — radi sa OpenAI, Claude Sonnet i Claude Opus.
 
+    Unutar `with hedging(...)` bloka primjenjuje hedging i failover na sekundarni provider.
+
     Args:
-        content_parts: lista OpenAI-format content dijelova
+        content_parts: lista dijelova iz text_part / image_part
         api_key: API ključ za odabrani provider
-        provider: "openai", "claude-sonnet" ili "claude-opus"
+        provider: "openai", "claude-sonnet", "claude-opus" ili registrovani provider
         max_tokens: max output tokena
+        expect_json: da li je validan odgovor JSON (za hedging — ko prvi vrati validan)
+        schema: opciona šema za strukturirani izlaz (KIF_SCHEMA, KUF_SCHEMA...)
     Returns:
         str: response text
     """
-    if provider.startswith("claude"):
-        client = anthropic.Anthropic(api_key=api_key)
-        model = _CLAUDE_MODELS.get(provider, _CLAUDE_MODELS["claude-sonnet"])
-        # Konvertuj OpenAI content format u Anthropic format
-        claude_content = []
-        for part in content_parts:
-            if part["type"] == "image_url":
-                url = part["image_url"]["url"]
-                header, b64data = url.split(",", 1)
-                media_type = header.split(":")[1].split(";")[0]
-                claude_content.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": media_type,
-                        "data": b64data,
-                    },
-                })
-            elif part["type"] == "text":
-                claude_content.append({"type": "text", "text": part["text"]})
-
-        for attempt in range(5):
-            try:
-                response = client.messages.create(
-                    model=model,
-                    max_tokens=max_tokens,
-                    messages=[{"role": "user", "content": claude_content}],
-                )
-                return response.content[0].text
-            except anthropic.RateLimitError:
-                if attempt == 4:
-                    raise
-                time.sleep(min(2 ** attempt, 30))
+    current_span().set(
+        provider=provider, max_tokens=max_tokens,
+        images=sum(1 for p in content_parts if p["type"] == "image"),
+        image_bytes=sum(len(p["data"]) for p in content_parts if p["type"] == "image"),
+    )
+    cfg = _HEDGE_CONFIG.get()
+    if not cfg or cfg["provider"] == provider:
+        return _timed_call(content_parts, api_key, provider, max_tokens, schema=schema)
+
+    with _HEDGE_LOCK:
+        HEDGE_STATS["calls"] += 1
+    if _provider_down(provider):
+        with _HEDGE_LOCK:
+            HEDGE_STATS["failovers"] += 1
+        current_span().set(failover=cfg["provider"])
+        return _timed_call(content_parts, cfg["api_key"], cfg["provider"], max_tokens, cfg, schema)
+    if cfg["hedge"]:
+        return _hedged_call(content_parts, api_key, provider, max_tokens, cfg, expect_json, schema)
+
+    try:
+        return _timed_call(content_parts, api_key, provider, max_tokens, cfg, schema)
+    except Exception as e:
+        if _is_rate_limit(e):
+            raise
+        with _HEDGE_LOCK:
+            HEDGE_STATS["failovers"] += 1
+        return _timed_call(content_parts, cfg["api_key"], cfg["provider"], max_tokens, cfg, schema)
+
+
+# ── Rutiranje modela po složenosti stranice ──
+# Jeftini lokalni signali (dužina text layera, entropija slike, broj stranica)
+# odlučuju da li dokument ide na brzi model, odabrani model ili najjači model.
+# Ako rezultat brzog modela ne prođe validaciju, dokument se ponovo obrađuje
+# najjačim modelom iste porodice (isti API ključ).
+
+_FAST_PROVIDER = {"claude-sonnet": "claude-haiku", "claude-opus": "claude-haiku", "openai": "openai-mini"}
+_STRONG_PROVIDER = {"claude-haiku": "claude-opus", "claude-sonnet": "claude-opus", "claude-opus": "claude-opus",
+                    "openai-mini": "openai", "openai": "openai"}
+# USD po 1M input tokena — samo za procjenu uštede u izvještaju
+_MODEL_PRICE_IN = {"claude-haiku": 1.0, "claude-sonnet": 3.0, "claude-opus": 5.0,
+                   "openai-mini": 0.15, "openai": 2.5}
+
+EASY_MAX_ENTROPY = 3.0   # čist born-digital dokument: bijela pozadina, crn tekst
+HARD_MIN_ENTROPY = 5.5   # zgužvan/šumovit sken, rukopis
+
+_ROUTING_LOCK = threading.Lock()
+ROUTING_STATS = {
+    "docs": 0,
+    "easy": 0,
+    "normal": 0,
+    "hard": 0,
+    "escalations": 0,
+    "latency_s": {},        # provider → ukupno sekundi
+    "docs_by_provider": {},
+    "cost_routed_usd": 0.0,
+    "cost_baseline_usd": 0.0,
+}
+
+
+def _page_gray(page, dpi=36):
+    """Renderuje fitz stranicu u mali grayscale NumPy niz (za jeftine statistike)."""
+    # Namjerno u pozivajućoj niti, ne u render pool-u: na 36–72 dpi render traje
+    # par ms, a worker bi morao ponovo otvoriti PDF i vratiti niz kroz pickle —
+    # skuplje od samog rendera. Slike za AI idu kroz render_pages.
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+
+def _image_entropy(gray):
+    """Shannon entropija histograma sivih nivoa (0–8 bita)."""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    p = hist[hist > 0] / hist.sum()
+    return float(-(p * np.log2(p)).sum())
+
+
+@_per_document
+def classify_complexity(pdf_bytes):
+    """Procjenjuje složenost dokumenta iz lokalnih signala, bez AI poziva.
+
+    Returns:
+        dict: {"tier": "easy"|"normal"|"hard", "text_len", "entropy", "pages"}
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        pages = len(doc)
+        text_len = sum(len(p.get_text().strip()) for p in doc)
+        entropy = _image_entropy(_page_gray(doc[0])) if pages else 0.0
+    finally:
+        doc.close()
+
+    has_text = text_len >= MIN_TEXT_LENGTH
+    if has_text and pages == 1 and entropy <= EASY_MAX_ENTROPY:
+        tier = "easy"
+    elif (not has_text and entropy >= HARD_MIN_ENTROPY) or pages > 2:
+        tier = "hard"
     else:
-        # OpenAI
-        client = openai.OpenAI(api_key=api_key)
-        for attempt in range(5):
-            try:
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    temperature=0,
-                    max_tokens=max_tokens,
-                    messages=[{"role": "user", "content": content_parts}],
-                )
-                return response.choices[0].message.content.strip()
-            except openai.RateLimitError:
-                if attempt == 4:
-                    raise
-                time.sleep(min(2 ** attempt, 30))
+        tier = "normal"
+    return {"tier": tier, "text_len": text_len, "entropy": round(entropy, 2), "pages": pages}
+
+
+def route_provider(provider, tier):
+    """Bira provider za datu složenost: easy → brzi, hard → najjači, inače odabrani."""
+    if tier == "easy":
+        return _FAST_PROVIDER.get(provider, provider)
+    if tier == "hard":
+        return _STRONG_PROVIDER.get(provider, provider)
+    return provider
+
+
+def routing_stats():
+    """Kopija statistike rutiranja (broj dokumenata po nivou, eskalacije, latencija, procjena troška)."""
+    with _ROUTING_LOCK:
+        stats = dict(ROUTING_STATS)
+        stats["latency_s"] = dict(ROUTING_STATS["latency_s"])
+        stats["docs_by_provider"] = dict(ROUTING_STATS["docs_by_provider"])
+        return stats
+
+
+def _amount(val):
+    try:
+        return float(str(val).replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+
+
+def _kif_needs_escalation(data):
+    """KIF rezultat je sumnjiv: nema broja/datuma računa ili iznosi nemaju smisla."""
+    iznakft = _amount(data.get("IZNAKFT"))
+    iznosnov = _amount(data.get("IZNOSNOV"))
+    return (
+        not str(data.get("BRDOKFAKT", "")).strip()
+        or not re.match(r'\d{2}\.\d{2}\.\d{4}$', str(data.get("DATUMF", "")).strip())
+        or not iznakft
+        or iznosnov is None
+        or iznosnov > iznakft
+    )
+
+
+def _kuf_needs_escalation(data):
+    """KUF rezultat je sumnjiv: nema broja računa ili osnovica + PDV != ukupno."""
+    ukupno = _amount(data.get("IZNSAPDV"))
+    osnovica = _amount(data.get("IZNBEZPDV"))
+    pdv = _amount(data.get("IZNPDV")) or 0.0
+    return (
+        not str(data.get("BROJFAKT", "")).strip()
+        or not ukupno
+        or osnovica is None
+        or abs(osnovica + pdv - ukupno) > 0.05
+    )
+
 
+def _fiscal_needs_escalation(items):
+    """Fiskalni rezultat je sumnjiv: nijedan račun ili račun bez datuma/DI broja."""
+    return not items or any(not it.get("DATUMDOK") or not it.get("BROJKIFA") for it in items)
 
-def process_kuf_pdf(pdf_bytes, filename="", api_key=None, provider="openai"):
-    """Obrađuje PDF ulazne fakture i vraća dict sa KUF podacima."""
+
+def _routed(process_fn, needs_escalation, pdf_bytes, filename, api_key, provider):
+    """Obrađuje dokument modelom po složenosti; eskalira na najjači ako validacija padne."""
+    info = classify_complexity(pdf_bytes)
+    chosen = route_provider(provider, info["tier"])
+    strong = _STRONG_PROVIDER.get(provider, provider)
+
+    t0 = time.monotonic()
+    used = chosen
+    try:
+        result = process_fn(pdf_bytes, filename=filename, api_key=api_key, provider=chosen)
+        ok = not needs_escalation(result)
+    except ValueError:  # json.JSONDecodeError
+        if chosen == strong:
+            raise
+        result, ok = None, False
+    if not ok and chosen != strong:
+        print(f"  [ROUTE] {filename}: {chosen} nije prošao validaciju, eskaliram na {strong}")
+        used = strong
+        result = process_fn(pdf_bytes, filename=filename, api_key=api_key, provider=strong)
+    elapsed = time.monotonic() - t0
+
+    # Procjena input tokena: ~1600 po slici + tekst
+    est_tokens = info["pages"] * 1600 + info["text_len"] // 4
+    cost = est_tokens * _MODEL_PRICE_IN.get(chosen, 0) / 1e6
+    if used != chosen:
+        cost += est_tokens * _MODEL_PRICE_IN.get(used, 0) / 1e6
+    with _ROUTING_LOCK:
+        ROUTING_STATS["docs"] += 1
+        ROUTING_STATS[info["tier"]] += 1
+        ROUTING_STATS["escalations"] += used != chosen
+        ROUTING_STATS["latency_s"][used] = ROUTING_STATS["latency_s"].get(used, 0.0) + elapsed
+        ROUTING_STATS["docs_by_provider"][used] = ROUTING_STATS["docs_by_provider"].get(used, 0) + 1
+        ROUTING_STATS["cost_routed_usd"] += cost
+        ROUTING_STATS["cost_baseline_usd"] += est_tokens * _MODEL_PRICE_IN.get(provider, 0) / 1e6
+
+    route = f"{info['tier']}:{used}"
+    for item in (result if isinstance(result, list) else [result]):
+        item["_ROUTE"] = route
+    return result
+
+
+def process_kuf_pdf(pdf_bytes, filename="", api_key=None, provider="openai", routing=False):
+    """Obrađuje PDF ulazne fakture i vraća dict sa KUF podacima.
+
+    routing=True bira model po složenosti dokumenta (vidi classify_complexity).
+    """
+    with span("process_kuf_pdf", filename=filename, provider=provider, routing=routing, pdf_bytes=len(pdf_bytes)):
+        if routing and provider not in _PROVIDERS:
+            return _routed(_process_kuf_once, _kuf_needs_escalation, pdf_bytes, filename, api_key, provider)
+        return _process_kuf_once(pdf_bytes, filename=filename, api_key=api_key, provider=provider)
+
+
+def _process_kuf_once(pdf_bytes, filename="", api_key=None, provider="openai"):
+    """Jedna KUF ekstrakcija odabranim providerom."""
+    pdf_bytes, ocr_used = ocr_prepass(pdf_bytes)
     pdf_text = extract_text_from_bytes(pdf_bytes)
 
     content = []
     has_text = len(pdf_text) >= MIN_TEXT_LENGTH
-    images, is_multipage = pdf_bytes_to_images_base64(pdf_bytes)
+
+    # Dobavljač poznat po JIB-u iz teksta → ne tražimo njegove podatke od modela
+    registry = get_partner_registry("kuf")
+    known_party = registry.find_in_text(pdf_text) if has_text else None
+    current_span().set(partner_cache_hit=bool(known_party), ocr=ocr_used, text_chars=len(pdf_text))
+    prompt = KUF_PROMPT_KNOWN_PARTY if known_party else KUF_EXTRACTION_PROMPT
+    schema = KUF_SCHEMA_KNOWN_PARTY if known_party else KUF_SCHEMA
+    images, is_multipage = pdf_bytes_to_images(pdf_bytes, dpi=OCR_IMAGE_DPI if ocr_used else 150)
     mime = "image/jpeg" if is_multipage else "image/png"
 
     for img in images:
-        content.append({
-            "type": "image_url",
-            "image_url": {"url": f"data:{mime};base64,{img}"},
-        })
+        content.append(image_part(img, mime))
 
     if has_text:
         content.append({
@@ -352,23 +1838,20 @@ def process_kuf_pdf(pdf_bytes, filename="", api_key=None, provider="openai"):
                     f"DOBAVLJAČ/IZDAVAČ je firma čiji je logo/zaglavlje (firma koja ŠALJE račun) — TO JE FIRMA ČIJE PODATKE TREBAŠ.\n"
                     f"KUPAC/PRIMALAC je firma na koju glasi račun — to NE trebamo.\n\n"
                     f"Za TAČNE brojeve koristi ovaj tekst iz PDF-a:\n\n"
-                    f"---\n{pdf_text}\n---\n\n{KUF_EXTRACTION_PROMPT}",
+                    f"---\n{condense_pdf_text(pdf_bytes)}\n---\n\n{prompt}",
         })
     else:
-        content.append({"type": "text", "text": KUF_EXTRACTION_PROMPT})
-
-    raw = _ai_call(content, api_key, provider=provider, max_tokens=2000)
-
-    if raw.startswith("```"):
-        raw = raw.split("\n", 1)[1]
-        raw = raw.rsplit("```", 1)[0]
+        content.append({"type": "text", "text": prompt})
 
-    start = raw.find("{")
-    end = raw.rfind("}") + 1
-    if start >= 0 and end > start:
-        raw = raw[start:end]
-
-    data = json.loads(raw)
+    data = _extract_json(content, api_key, provider, schema, max_tokens=2000)
+    t_post = time.perf_counter()
+    if known_party:
+        registry.apply(data, *known_party)
+    else:
+        jib = str(data.get("IDPDVPP", "")).strip()
+        partner = registry.lookup(jib) if _JIB_RE.fullmatch(jib) else None
+        if partner:
+            registry.apply(data, jib, partner, only_empty=True)
 
     # Validacija ID/PDV (ista logika, ali polje se zove IDPDVPP)
     id_broj = str(data.get("IDPDVPP", "")).strip().replace(" ", "")
@@ -402,99 +1885,384 @@ def process_kuf_pdf(pdf_bytes, filename="", api_key=None, provider="openai"):
             moze_val = "0"
     data["Moze"] = moze_val
 
+    record_stage("post", time.perf_counter() - t_post)
     return data
 
 
-def split_pdf_to_pages(pdf_bytes):
-    """Razdvaja multi-page PDF na listu single-page PDF bajtova."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    pages = []
-    for page_num in range(len(doc)):
-        single = fitz.open()
-        single.insert_pdf(doc, from_page=page_num, to_page=page_num)
-        pages.append((page_num + 1, single.tobytes()))
-        single.close()
-    doc.close()
-    return pages
+def open_pdf(source):
+    """Otvara PDF iz bajtova ili iz putanje do fajla.
 
+    Sa putanjom fitz čita stranice sa diska po potrebi, pa ni veliki upload
+    ne mora biti cijeli u memoriji.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return fitz.open(source)
+    return fitz.open(stream=source, filetype="pdf")
 
-def count_pdf_pages(pdf_bytes):
-    """Vraća broj stranica u PDF-u bez čuvanja stranica u memoriji."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+def count_pdf_pages(source):
+    """Vraća broj stranica u PDF-u (bajtovi ili putanja) bez čuvanja stranica u memoriji."""
+    doc = open_pdf(source)
     n = len(doc)
     doc.close()
     return n
 
 
-def iter_pdf_pages(pdf_bytes):
-    """Generator koji vraća stranice jednu po jednu — ne drži sve u memoriji odjednom."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+# ── Planiranje grupa stranica iz text layera (bez AI poziva) ──
+_STRANA_RE = re.compile(r'Strana:\s*(\d+)(?:\s*(?:/|od)\s*(\d+))?', re.IGNORECASE)
+_TOTALS_ROW_RE = re.compile(
+    r'UKUPAN\s+IZNOS\s+ZA\s+NAPLATU|Ukupno\s+bez\s+PDV|Ukupno\s+PDV|ZA\s+UPLATU|UKUPNO\s+ZA\s+PLA[ĆC]',
+    re.IGNORECASE,
+)
+_DOC_NO_RE = re.compile(
+    r'(?:ra[čc]un|faktura|otpremnica)[^\n]{0,30}?\bbr(?:oj|\.)\s*:?\s*([A-Z0-9][\w/.-]*\d[\w/.-]*)',
+    re.IGNORECASE,
+)
+
+
+def _page_text_features(text):
+    """Jeftine osobine stranice iz text layera za odluku o spajanju."""
+    strana = _STRANA_RE.search(text)
+    doc_no = _DOC_NO_RE.search(text)
+    return {
+        "has_text": len(text.strip()) >= MIN_TEXT_LENGTH,
+        "strana": int(strana.group(1)) if strana else None,
+        "strana_of": int(strana.group(2)) if strana and strana.group(2) else None,
+        "has_totals": bool(_TOTALS_ROW_RE.search(text)),
+        "doc_no": doc_no.group(1).upper() if doc_no else None,
+    }
+
+
+# ── Klasifikacija stranica za trijažu batcha ──
+# Jedan prolaz kroz dokument: text layer regexi + NumPy statistike male sive
+# slike. Prazne poleđine duplex skenova, separatori i fiskalni računi u KIF
+# batchu preskaču se prije ikakvog AI poziva.
+
+PAGE_INVOICE_FIRST = "invoice-first"
+PAGE_CONTINUATION = "continuation"
+PAGE_FISCAL = "fiscal"
+PAGE_BLANK = "blank"
+PAGE_UNKNOWN = "unknown"
+
+_FISCAL_PAGE_RE = re.compile(r'PRESJEK\s+STANJA', re.IGNORECASE)
+INK_LEVEL = 160          # piksel tamniji od ovoga je "mastilo"
+BLANK_INK_RATIO = 0.003  # ispod ovog udjela mastila stranica je prazna
+BLANK_MAX_TEXT = 20      # separator/prazna stranica nema smislenog teksta
+
+
+def _is_continuation(f, prev):
+    """Spaja samo uz pozitivan dokaz: broj stranice ili isti broj računa.
+
+    Stranica bez prepoznatog zaglavlja nije dokaz — novi račun kojem regex
+    nije našao zaglavlje inače bi bio progutan u prethodni.
+    """
+    return bool(prev) and f["has_text"] and prev["has_text"] and bool(
+        (f["strana"] or 0) >= 2
+        or (prev["strana"] and prev["strana_of"] and prev["strana"] < prev["strana_of"])
+        or (not prev["has_totals"] and f["doc_no"] and f["doc_no"] == prev["doc_no"])
+    )
+
+
+def classify_page(page, prev_features=None):
+    """Klasifikuje jednu fitz stranicu bez AI poziva.
+
+    Returns:
+        dict sa "label" (invoice-first, continuation, fiscal, blank, unknown),
+        osobinama teksta i udjelom mastila "ink"
+    """
+    text = page.get_text()
+    f = _page_text_features(text)
+    gray = _page_gray(page)
+    f["ink"] = round(float((gray < INK_LEVEL).mean()), 4)
+    f["print"] = page_print(page, text)
+
+    if len(text.strip()) < BLANK_MAX_TEXT and f["ink"] < BLANK_INK_RATIO:
+        f["label"] = PAGE_BLANK
+    elif _FISCAL_PAGE_RE.search(text):
+        f["label"] = PAGE_FISCAL
+    elif _is_continuation(f, prev_features):
+        f["label"] = PAGE_CONTINUATION
+    elif f["has_text"]:
+        f["label"] = PAGE_INVOICE_FIRST
+    else:
+        f["label"] = PAGE_UNKNOWN
+    return f
+
+
+def classify_pages(source):
+    """Klasifikuje sve stranice dokumenta (bajtovi ili putanja) u jednom prolazu (lista dict-ova iz classify_page)."""
+    doc = open_pdf(source)
     try:
-        for page_num in range(len(doc)):
-            single = fitz.open()
-            single.insert_pdf(doc, from_page=page_num, to_page=page_num)
-            page_bytes = single.tobytes()
-            single.close()
-            yield (page_num + 1, page_bytes)
+        result = []
+        prev = None
+        for page in doc:
+            f = classify_page(page, prev)
+            result.append(f)
+            if f["label"] != PAGE_BLANK:
+                prev = f
+        return result
     finally:
         doc.close()
 
 
-def group_invoice_pages(pdf_bytes):
-    """Grupiše stranice PDF-a u fakture — spaja continuation stranice (Strana: 2, 3...) sa prethodnom."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    n = len(doc)
+def plan_pages(classified, merge_continuations=True):
+    """Od klasifikacije pravi grupe: [(page_indices, label), ...].
+
+    Continuation stranice se (ako merge_continuations) dodaju prethodnoj grupi;
+    prazne stranice ne prekidaju fakturu koja se nastavlja iza njih.
+    """
+    groups = []
+    last_doc_group = None
+    for i, f in enumerate(classified):
+        label = f["label"]
+        if label == PAGE_CONTINUATION and merge_continuations and last_doc_group is not None:
+            last_doc_group[0].append(i)
+            continue
+        group = ([i], label)
+        groups.append(group)
+        if label != PAGE_BLANK:
+            last_doc_group = group
+    return groups
 
-    if n == 0:
-        doc.close()
-        return []
 
-    if n == 1:
-        result = [(1, pdf_bytes)]
+def iter_page_groups(source, skip=(PAGE_BLANK,), merge_continuations=True):
+    """Generator za batch petlje: (page_indices, label, group_pdf_bytes, prints).
+
+    source su PDF bajtovi ili putanja; bajtovi grupe se prave tek kad je
+    grupa na redu. Za grupe čiji je label u `skip` vraća None umjesto
+    bajtova, pa se preskaču bez renderovanja i bez AI poziva. prints su
+    otisci stranica grupe (page_print) za DuplicateIndex.
+    """
+    classified = classify_pages(source)
+    groups = plan_pages(classified, merge_continuations=merge_continuations)
+    doc = open_pdf(source)
+    try:
+        for pages, label in groups:
+            prints = [classified[i]["print"] for i in pages]
+            if label in skip:
+                yield pages, label, None, prints
+            else:
+                yield pages, label, _pages_to_pdf(doc, pages), prints
+    finally:
         doc.close()
-        return result
 
-    # Grupiši stranice: continuation stranice (Strana: 2, 3...) idu uz prethodnu
-    groups = [[0]]
-    for i in range(1, n):
-        text = doc[i].get_text()
-        is_continuation = bool(re.search(r'Strana:\s*[2-9]', text))
-        if is_continuation:
-            groups[-1].append(i)
-        else:
-            groups.append([i])
 
-    # Kreiraj spojeni PDF za svaku grupu
-    results = []
-    for group in groups:
-        merged = fitz.open()
-        for page_idx in group:
-            merged.insert_pdf(doc, from_page=page_idx, to_page=page_idx)
-        results.append((group[0] + 1, merged.tobytes()))
-        merged.close()
+# ── Otisci stranica — skoro identični dokumenti prije ekstrakcije ──
+# Stranica sa tekstom ima otisak "t:<hash sabijenog teksta>" i poklapa se
+# samo sa istim tekstom. Sken bez teksta ima otisak "s:<maska mastila>":
+# stranica na 72 dpi, izravnata (nagib papira do 1°), mreža blokova od
+# gornjeg lijevog ugla mastila (poništava pomak papira); bit je 1 ako blok
+# ima mastila. Dva skena se poklapaju kad skoro svaki puni blok jednog ima
+# puni blok u 3x3 susjedstvu drugog — šum i pomak od jednog bloka ne
+# mijenjaju rezultat, a drugačiji red teksta (kupac, stavke, iznosi)
+# mijenja. Skenovi sa istog obrasca koji se razlikuju samo u par cifara
+# ostaju isti otisak — zato se preskakanje duplikata u aplikaciji može
+# isključiti.
+
+SCAN_PRINT_DPI = 72
+SCAN_PRINT_GRID = (192, 64)  # redovi x kolone blokova (pokriva 271 x 181 mm)
+SCAN_BLOCK_PX = (4, 8)       # blok 4x8 piksela na 72 dpi (~1.4 x 2.8 mm, pola reda teksta)
+SCAN_BLOCK_INK = 0.05        # udio mastila od kojeg je blok "pun"
+SCAN_MAX_DIFF = 2            # max punih blokova bez para u susjedstvu da su skenovi isti
+SCAN_MAX_SKEW = 1.0          # stepeni; izravnanje u koracima od 0.1°
+
+_SCAN_PRINT_BYTES = SCAN_PRINT_GRID[0] * SCAN_PRINT_GRID[1] // 8
+_POPCOUNT = bytes(bin(i).count("1") for i in range(256))
+
+
+def _deskew_ink(ink):
+    """Izravnaj masku mastila: ugao sa najoštrijim profilom redova (redovi teksta vodoravni)."""
+    h, w = ink.shape
+    ys, xs = np.nonzero(ink)
+    if not len(ys):
+        return ink
+    best_score, best_rows = -1.0, None
+    for deg in np.arange(-SCAN_MAX_SKEW, SCAN_MAX_SKEW + 1e-9, 0.1):
+        rows = np.round(ys + (xs - w / 2) * np.tan(np.radians(deg))).astype(np.int64)
+        ok = (rows >= 0) & (rows < h)
+        profile = np.bincount(rows[ok], minlength=h).astype(np.float64)
+        score = float((profile ** 2).sum())
+        if score > best_score:
+            best_score, best_rows = score, (rows, ok)
+    rows, ok = best_rows
+    out = np.zeros_like(ink)
+    out[rows[ok], xs[ok]] = True
+    return out
+
+
+def scan_mask(gray):
+    """Maska mastila skena (bool niz SCAN_PRINT_GRID) iz sive slike na SCAN_PRINT_DPI.
+
+    Mreža počinje u gornjem lijevom uglu okvira mastila, a blokovi imaju
+    fiksnu fizičku veličinu — duži red teksta mijenja samo svoje blokove.
+    """
+    ink = _deskew_ink(gray < INK_LEVEL)
+    # Okvir mastila: redovi/kolone sa bar 2 piksela mastila (pojedinačne tačke prašine ne računaju)
+    rows = np.flatnonzero(ink.sum(axis=1) >= 2)
+    cols = np.flatnonzero(ink.sum(axis=0) >= 2)
+    (gh, gw), (bh, bw) = SCAN_PRINT_GRID, SCAN_BLOCK_PX
+    grid = np.zeros((gh * bh, gw * bw), dtype=bool)
+    if len(rows) and len(cols):
+        ink = ink[rows[0]:rows[0] + grid.shape[0], cols[0]:cols[0] + grid.shape[1]]
+        grid[:ink.shape[0], :ink.shape[1]] = ink
+    blocks = grid.reshape(gh, bh, gw, bw).mean(axis=(1, 3))
+    return blocks > SCAN_BLOCK_INK
+
+
+def page_print(page, text):
+    """Otisak jedne fitz stranice: "t:<hash>" za tekst, "s:<base64 maske>" za sken."""
+    text = _collapse_ws(text)
+    if len(text) >= BLANK_MAX_TEXT:
+        return "t:" + hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+    mask = scan_mask(_page_gray(page, dpi=SCAN_PRINT_DPI))
+    return "s:" + base64.b64encode(np.packbits(mask).tobytes()).decode("ascii")
+
+
+def _dilate(mask):
+    """3x3 dilatacija bool maske."""
+    padded = np.pad(mask, 1)
+    out = np.zeros_like(mask)
+    h, w = mask.shape
+    for dy in range(3):
+        for dx in range(3):
+            out |= padded[dy:dy + h, dx:dx + w]
+    return out
+
+
+def _parse_print(p):
+    """Otisak stranice → oblik za poređenje: string za tekst, (maska, dilatacija) packbits za sken."""
+    if not p.startswith("s:"):
+        return p
+    packed = np.frombuffer(base64.b64decode(p[2:]), dtype=np.uint8)
+    mask = np.unpackbits(packed)[:SCAN_PRINT_GRID[0] * SCAN_PRINT_GRID[1]].reshape(SCAN_PRINT_GRID).astype(bool)
+    return packed, np.packbits(_dilate(mask))
+
+
+def _scan_diff(masks, dilated, scan):
+    """Broj punih blokova bez punog bloka u susjedstvu drugog skena, u oba smjera.
+
+    masks/dilated su packbits redovi (jedan sken ili matrica skenova), scan je
+    (maska, dilatacija) skena sa kojim se porede.
+    """
+    table = np.frombuffer(_POPCOUNT, dtype=np.uint8)
+    return (table[masks & ~scan[1]].sum(axis=-1, dtype=np.int64)
+            + table[scan[0] & ~dilated].sum(axis=-1, dtype=np.int64))
 
-    doc.close()
-    return results
 
+def _pages_match(a, b):
+    if isinstance(a, str) or isinstance(b, str):
+        return a == b
+    return _scan_diff(a[0], a[1], b) <= SCAN_MAX_DIFF
 
-def count_invoice_groups(pdf_bytes):
-    """Vraća broj faktura u PDF-u (continuation stranice se ne broje kao zasebne)."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    if len(doc) <= 1:
-        n = len(doc)
-        doc.close()
-        return n
 
-    count = 1
-    for i in range(1, len(doc)):
-        text = doc[i].get_text()
-        if not re.search(r'Strana:\s*[2-9]', text):
-            count += 1
+class DuplicateIndex:
+    """Indeks otisaka dokumenata — u batchu ili trajno na disku (path).
 
-    doc.close()
-    return count
+    Otisak dokumenta je lista otisaka stranica (page_print). Dokumenti se
+    poklapaju kad imaju isti broj stranica i svaka stranica se poklapa.
+    Prva stranica sa tekstom traži se u dict-u po hashu; prva stranica
+    skena poredi se sa svim skenovima odjednom kroz NumPy matrice maski.
+    """
+
+    def __init__(self, path=None, max_entries=50000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = []      # (prints, parsed, label)
+        self._by_text = {}     # hash prve stranice → indeksi u entries
+        self._scan_rows = []   # red u matricama maski → indeks u entries
+        self._masks = np.zeros((0, _SCAN_PRINT_BYTES), dtype=np.uint8)
+        self._dilated = np.zeros((0, _SCAN_PRINT_BYTES), dtype=np.uint8)
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for item in json.load(f)[-max_entries:]:
+                        self._add(item["pages"], item["label"])
+            except (OSError, ValueError, KeyError):
+                self.entries, self._by_text, self._scan_rows = [], {}, []
+
+    def _add(self, prints, label):
+        idx = len(self.entries)
+        parsed = [_parse_print(p) for p in prints]
+        self.entries.append((list(prints), parsed, label))
+        first = parsed[0]
+        if isinstance(first, str):
+            self._by_text.setdefault(first, []).append(idx)
+            return
+        n = len(self._scan_rows)
+        if n == len(self._masks):  # matrice rastu udvostručavanjem
+            extra = np.zeros((max(n, 16), _SCAN_PRINT_BYTES), dtype=np.uint8)
+            self._masks = np.concatenate([self._masks, extra])
+            self._dilated = np.concatenate([self._dilated, extra])
+        self._masks[n], self._dilated[n] = first
+        self._scan_rows.append(idx)
+
+    def _candidates(self, first):
+        if isinstance(first, str):
+            return self._by_text.get(first, [])
+        n = len(self._scan_rows)
+        if not n:
+            return []
+        diff = _scan_diff(self._masks[:n], self._dilated[:n], first)
+        return [self._scan_rows[row] for row in np.flatnonzero(diff <= SCAN_MAX_DIFF)]
+
+    def find(self, prints):
+        """Vraća labelu ranijeg skoro identičnog dokumenta, ili None."""
+        if not prints:
+            return None
+        parsed = [_parse_print(p) for p in prints]
+        with self._lock:
+            for idx in self._candidates(parsed[0]):
+                _, known, label = self.entries[idx]
+                if len(known) == len(parsed) and all(_pages_match(a, b) for a, b in zip(known[1:], parsed[1:])):
+                    return label
+        return None
+
+    def add(self, prints, label):
+        if prints:
+            with self._lock:
+                self._add(prints, label)
+
+    def save(self):
+        """Snima indeks na disk (atomski), zadnjih max_entries dokumenata."""
+        if not self.path:
+            return
+        with self._lock:
+            items = [{"pages": prints, "label": label}
+                     for prints, _, label in self.entries[-self.max_entries:]]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+_DUPLICATE_INDEXES = {}
+_DUPLICATE_INDEXES_LOCK = threading.Lock()
+
+
+def get_duplicate_index(mode):
+    """Trajni indeks dokumenata obrađenih u ranijim batchevima za dati modul (kif, kuf, dnevni...)."""
+    with _DUPLICATE_INDEXES_LOCK:
+        index = _DUPLICATE_INDEXES.get(mode)
+        if index is None:
+            index = DuplicateIndex(os.path.join(CACHE_DIR, f"prints_{mode}.json"))
+            _DUPLICATE_INDEXES[mode] = index
+        return index
+
+
+def _pages_to_pdf(doc, page_indices):
+    """Kreira PDF bajtove od datih stranica otvorenog fitz dokumenta."""
+    merged = fitz.open()
+    for page_idx in page_indices:
+        merged.insert_pdf(doc, from_page=page_idx, to_page=page_idx)
+    result = merged.tobytes()
+    merged.close()
+    return result
 
 
+@_per_document
+@stage("text")
 def extract_text_from_bytes(pdf_bytes):
     """Izvlači ugrađeni tekst iz PDF bajtova."""
     doc = fitz.open(stream=pdf_bytes, filetype="pdf")
@@ -505,110 +2273,513 @@ def extract_text_from_bytes(pdf_bytes):
     return text.strip()
 
 
-def _page_to_base64(pdf_bytes, fmt="PNG", quality=80):
-    """Konvertuje single-page PDF u jednu base64 sliku."""
+# ── Lokalni OCR (Tesseract) za skenove bez tekstualnog sloja ──
+# Opciono: radi samo ako je tesseract instaliran (packages.txt). Skenirane
+# stranice dobiju nevidljivi tekstualni sloj, pa regex fallbackovi i
+# condense_pdf_text rade kao za digitalne PDF-ove, a slika uz tekst može
+# biti manje rezolucije.
+
+OCR_ENABLED = shutil.which("tesseract") is not None
+OCR_LANGUAGE = "hrv+eng"
+OCR_DPI = 300
+OCR_IMAGE_DPI = 100   # rezolucija slike kad uz nju ide OCR tekst (inače 150)
+OCR_STATS = {"pages": 0, "seconds": 0.0, "errors": 0}
+_OCR_LOCK = threading.Lock()
+
+
+@_per_document
+@stage("text")
+def ocr_prepass(pdf_bytes):
+    """Stranice bez teksta zamjenjuje OCR verzijom sa tekstualnim slojem.
+
+    Returns:
+        (pdf_bytes, ocr_used) — originalni bajtovi ako OCR nije dostupan,
+        nije potreban ili nije uspio.
+    """
+    if not OCR_ENABLED:
+        return pdf_bytes, False
+    src = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        scanned = {i for i, page in enumerate(src) if len(page.get_text().strip()) < MIN_TEXT_LENGTH}
+        if not scanned:
+            return pdf_bytes, False
+        t0 = time.monotonic()
+        out = fitz.open()
+        try:
+            for i, page in enumerate(src):
+                if i not in scanned:
+                    out.insert_pdf(src, from_page=i, to_page=i)
+                    continue
+                pix = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+                pix.set_dpi(OCR_DPI, OCR_DPI)
+                ocr_doc = fitz.open("pdf", pix.pdfocr_tobytes(language=OCR_LANGUAGE))
+                out.insert_pdf(ocr_doc)
+                ocr_doc.close()
+            result = out.tobytes()
+        except Exception as e:  # nedostaje jezički paket, tesseract pao...
+            print(f"  [OCR] Greška, nastavljam bez OCR-a: {e}")
+            with _OCR_LOCK:
+                OCR_STATS["errors"] += 1
+            return pdf_bytes, False
+        finally:
+            out.close()
+        with _OCR_LOCK:
+            OCR_STATS["pages"] += len(scanned)
+            OCR_STATS["seconds"] += time.monotonic() - t0
+        current_span().set(ocr_pages=len(scanned))
+        return result, True
+    finally:
+        src.close()
+
+
+# ── Sažimanje pdf_text za prompt ──
+# Model treba zaglavlje (broj, datum, izdavač), blokove stranaka i zonu totala.
+# Redovi stavki u sredini višestraničnih računa troše tokene a model ih ignoriše.
+# Regex fallbackovi u process_pdf i dalje rade nad punim tekstom.
+
+_WS_RE = re.compile(r'[ \t\u00a0]+')
+_BLANK_LINES_RE = re.compile(r'\n\s*\n+')
+_PAGE_NUM_RE = re.compile(r'\b(strana|stranica|page)\s*:?\s*\d+(\s*(/|od|of)\s*\d+)?', re.IGNORECASE)
+_HEADER_RE = re.compile(r'ra[čc]un|faktur|otpremnic|broj|datum|dospije', re.IGNORECASE)
+_PARTY_RE = re.compile(
+    r'kupac|korisnik|primalac|dobavlja[čc]|izdava[čc]|\bjib\b|\bid\b|id\s*broj|pdv\s*broj|'
+    r'adresa|sjedi[šs]te|ulica|\bul\.',
+    re.IGNORECASE,
+)
+_TOTALS_RE = re.compile(
+    r'ukupn|za\s+naplatu|za\s+uplatu|iznos|\bpdv\b|rabat|popust|oslobo[dđ]|\bref\b',
+    re.IGNORECASE,
+)
+# Fiskalni presjeci: svaki red sa datumom, DI/BF brojevima i stanjem u kasi je bitan
+_FISCAL_KEEP_RE = re.compile(r'presjek|stanj|\bdi\b|\bbf\b|\bbnr\b|gotovin|kartic|depozit|\d{2}\.\d{2}\.\d{4}', re.IGNORECASE)
+FISCAL_TEXT_TOKENS = 3000
+HEADER_ZONE = 0.35   # gornji dio prve stranice = zaglavlje i stranke
+TOTALS_ZONE = 0.65   # donji dio zadnje stranice = totali
+
+
+def _collapse_ws(text):
+    text = _WS_RE.sub(" ", text)
+    text = "\n".join(line.strip() for line in text.splitlines())
+    return _BLANK_LINES_RE.sub("\n", text).strip()
+
+
+@_per_document
+@stage("text")
+def condense_pdf_text(pdf_bytes, max_tokens=PROMPT_TEXT_TOKENS, keep_re=None):
+    """Vraća sažet pdf_text za prompt, u granicama budžeta tokena.
+
+    Koristi fitz blokove sa koordinatama: zadržava zaglavlje i blokove stranaka,
+    zonu totala i blokove koji odgovaraju keep_re; izbacuje ponovljene blokove
+    (zaglavlja/podnožja na svakoj stranici) i sažima razmake. Ako cijeli tekst
+    stane u budžet, vraća ga samo očišćenog.
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    blocks = []   # (prioritet, redni broj, tekst)
+    seen = {}     # tekst bloka → stranica na kojoj se prvi put pojavio
+    n_pages = len(doc)
+    try:
+        for page_idx, page in enumerate(doc):
+            height = page.rect.height or 1
+            for b in page.get_text("blocks", sort=True):
+                if b[6] != 0:
+                    continue
+                text = _collapse_ws(b[4])
+                if not text:
+                    continue
+                # Page furniture: isti blok na više stranica, "Strana: 2/3"
+                key = _PAGE_NUM_RE.sub("", text).lower()
+                if not key.strip() or seen.setdefault(key, page_idx) != page_idx:
+                    continue
+
+                rel_top = b[1] / height
+                if keep_re is not None and keep_re.search(text):
+                    prio = 0
+                elif page_idx == 0 and (rel_top < HEADER_ZONE or _HEADER_RE.search(text)):
+                    prio = 0
+                elif _PARTY_RE.search(text) or _TOTALS_RE.search(text):
+                    prio = 1
+                elif page_idx == n_pages - 1 and rel_top > TOTALS_ZONE:
+                    prio = 1
+                else:
+                    prio = 2   # stavke i ostalo
+                blocks.append((prio, len(blocks), text))
+    finally:
+        doc.close()
+
+    budget = max_tokens * 4
+    full = "\n".join(t for _, _, t in blocks)
+    if len(full) <= budget:
+        return full
+
+    chosen = []
+    used = 0
+    for prio, order, text in sorted(blocks):
+        if used + len(text) + 1 > budget:
+            if prio == 2:
+                break
+            continue
+        chosen.append((order, text))
+        used += len(text) + 1
+    chosen.sort()
+    return "\n".join(t for _, t in chosen)
+
+
+# ── Renderovanje stranica u pool-u procesa ──
+# Rasterizacija i PNG/JPEG kodiranje drže GIL, pa ih niti (paralelni AI
+# pozivi) ne ubrzavaju. Worker procesi dobijaju samo referencu
+# (putanja, stranica, dpi, format) i sami otvaraju PDF sa diska; nazad idu
+# gotovi bajtovi slike. AI pozivi ostaju u nitima.
+
+def _default_render_workers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", _default_render_workers()))
+_RENDER_POOL = None
+_RENDER_POOL_LOCK = threading.Lock()
+
+
+def _render_page_worker(path, dpi, page_index, fmt, quality, clip=None):
+    """Radi u worker procesu: jedna stranica → (bajtovi slike, sekundi render, sekundi kodiranje).
+
+    Sa clip (x0, y0, x1, y1) renderuje samo taj isječak, u sivim tonovima.
+    """
+    t0 = time.perf_counter()
+    doc = fitz.open(path)
+    try:
+        page = doc[page_index]
+        if clip is None:
+            pix = page.get_pixmap(dpi=dpi, alpha=False)
+        else:
+            pix = page.get_pixmap(dpi=dpi, clip=fitz.Rect(clip), colorspace=fitz.csGRAY, alpha=False)
+    finally:
+        doc.close()
+    t1 = time.perf_counter()
+    data = pix.tobytes("jpeg", jpg_quality=quality) if fmt == "JPEG" else pix.tobytes("png")
+    return data, t1 - t0, time.perf_counter() - t1
+
+
+def configure_render_pool(workers):
+    """Mijenja broj worker procesa (0 = renderovanje u pozivajućoj niti)."""
+    global RENDER_WORKERS, _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        RENDER_WORKERS = workers
+        pool, _RENDER_POOL = _RENDER_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def _render_pool():
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is None and RENDER_WORKERS > 0:
+            # spawn: fork procesa sa nitima (Streamlit, server) nije siguran
+            _RENDER_POOL = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _RENDER_POOL
+
+
+def render_pages(path, jobs, dpi=150):
+    """Renderuje stranice PDF fajla u PNG/JPEG bajtove, paralelno u worker procesima.
+
+    Args:
+        path: putanja do PDF-a (worker ga otvara sam — bajtovi ne prelaze granicu procesa)
+        jobs: lista (page_index, fmt, quality) ili (page_index, fmt, quality, clip);
+              fmt je "PNG" ili "JPEG", clip je (x0, y0, x1, y1) u koordinatama stranice
+        dpi: rezolucija
+    Returns:
+        lista bajtova slika, istim redom kao jobs
+    """
+    with span("render", dpi=dpi, pages=len(jobs), render_workers=RENDER_WORKERS) as sp:
+        images = _render_jobs(path, jobs, dpi)
+        sp.set(image_bytes=sum(len(i) for i in images))
+    return images
+
+
+def _render_jobs(path, jobs, dpi):
+    pool = _render_pool()
+    results = None
+    if pool is not None:
+        try:
+            futures = [pool.submit(_render_page_worker, path, dpi, *job) for job in jobs]
+            results = [f.result() for f in futures]
+        except BrokenProcessPool as e:
+            print(f"  [RENDER] Pool procesa pao, renderujem u procesu: {e}")
+            configure_render_pool(0)
+    if results is None:
+        results = [_render_page_worker(path, dpi, *job) for job in jobs]
+
+    # Vrijeme workera (zbir po stranicama, ne zidno vrijeme)
+    record_stage("rasterize", sum(r for _, r, _ in results))
+    record_stage("encode", sum(e for _, _, e in results))
+    return [img for img, _, _ in results]
+
+
+@contextmanager
+def _temp_pdf(pdf_bytes):
+    """Privremeni PDF fajl na disku (za worker procese koji čitaju po putanji)."""
     with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
         tmp.write(pdf_bytes)
         tmp_path = tmp.name
     try:
-        pages = convert_from_path(tmp_path, dpi=150)
-        buffer = BytesIO()
-        if fmt == "JPEG":
-            pages[0].save(buffer, format="JPEG", quality=quality)
-        else:
-            pages[0].save(buffer, format="PNG")
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+        yield tmp_path
     finally:
         os.unlink(tmp_path)
 
 
-def prescan_invoice_number(page_bytes, api_key=None, provider="openai"):
-    """Brzi AI poziv — izvlači samo broj računa sa jedne stranice. Koristi malo tokena."""
-    img = _page_to_base64(page_bytes, fmt="JPEG", quality=50)
+# ── Regioni od interesa (zaglavlje, totali) ──
+# Pre-scan broja računa i zaseban poziv za totale trebaju samo dio stranice.
+# Sa tekstualnim slojem region se nalazi iz koordinata fitz blokova; za skenove
+# se koristi vertikalna zona naučena sa ranijih digitalnih stranica (početno
+# fiksna). Isječak ide u sivim tonovima, na rezoluciji dovoljnoj za cifre.
+
+ROI_DPI = 200
+ROI_PAD = 12              # pt iznad/ispod pronađenih blokova
+ROI_MAX_SHARE = 0.6       # region viši od ovog udjela stranice nije fokusiran
+ROI_ZONE_MARGIN = 0.05    # rezerva oko naučene zone (udio visine)
+ROI_LEARN_RATE = 0.2
+
+_INVOICE_NO_RE = re.compile(r'(\d{3,6}/\d{4})')
+_INVOICE_NO_BLOCK_RE = re.compile(
+    r'(ra[čc]un|faktur|otpremnic)[^\n]{0,40}?(broj|br\.|\bno\b)|\d{3,6}/\d{4}', re.IGNORECASE,
+)
+
+# vrsta → (regex bloka, raspon relativnog vrha bloka, početna zona (y0, y1))
+ROI_KINDS = {
+    "header": (_INVOICE_NO_BLOCK_RE, (0.0, 0.5), (0.0, HEADER_ZONE)),
+    "totals": (_TOTALS_RE, (0.4, 1.0), (TOTALS_ZONE - 0.05, 1.0)),
+}
+
+
+class RoiZones:
+    """Relativne vertikalne zone (y0, y1) po vrsti regiona, učene sa digitalnih stranica.
+
+    Klizni prosjek; snima se na disk svakih `save_every` učenja.
+    """
+
+    def __init__(self, path=None, save_every=20):
+        self.path = path
+        self.save_every = save_every
+        self.zones = {kind: list(spec[2]) for kind, spec in ROI_KINDS.items()}
+        self._pending = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for kind, (y0, y1) in json.load(f).items():
+                        if kind in self.zones:
+                            self.zones[kind] = [float(y0), float(y1)]
+            except (OSError, ValueError, TypeError):
+                pass
+
+    def zone(self, kind):
+        with self._lock:
+            y0, y1 = self.zones[kind]
+        return max(0.0, y0 - ROI_ZONE_MARGIN), min(1.0, y1 + ROI_ZONE_MARGIN)
+
+    def learn(self, kind, y0, y1):
+        with self._lock:
+            zone = self.zones[kind]
+            zone[0] += ROI_LEARN_RATE * (y0 - zone[0])
+            zone[1] += ROI_LEARN_RATE * (y1 - zone[1])
+            self._pending += 1
+            due = self._pending >= self.save_every
+        if due:
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {kind: [round(y0, 4), round(y1, 4)] for kind, (y0, y1) in self.zones.items()}
+            self._pending = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+
+_ROI_ZONES = None
+_ROI_ZONES_LOCK = threading.Lock()
+
+
+def get_roi_zones():
+    global _ROI_ZONES
+    with _ROI_ZONES_LOCK:
+        if _ROI_ZONES is None:
+            _ROI_ZONES = RoiZones(os.path.join(CACHE_DIR, "roi_zones.json"))
+        return _ROI_ZONES
+
+
+def find_roi(page, kind):
+    """Region stranice za "header" (broj računa) ili "totals" → (fitz.Rect, izvor).
+
+    izvor: "text" (fitz blokovi), "zone" (naučena/fiksna zona, za skenove)
+    ili "page" kad pronađeni blokovi nisu fokusiran region.
+    """
+    pattern, (top_min, top_max), _ = ROI_KINDS[kind]
+    rect = page.rect
+    height = rect.height or 1
+    zones = get_roi_zones()
+    hits = [
+        b for b in page.get_text("blocks")
+        if b[6] == 0 and top_min <= (b[1] - rect.y0) / height <= top_max and pattern.search(b[4])
+    ]
+    if hits:
+        y0 = max(rect.y0, min(b[1] for b in hits) - ROI_PAD)
+        y1 = min(rect.y1, max(b[3] for b in hits) + ROI_PAD)
+        if (y1 - y0) / height > ROI_MAX_SHARE:
+            return rect, "page"
+        zones.learn(kind, (y0 - rect.y0) / height, (y1 - rect.y0) / height)
+        return fitz.Rect(rect.x0, y0, rect.x1, y1), "text"
+    z0, z1 = zones.zone(kind)
+    return fitz.Rect(rect.x0, rect.y0 + z0 * height, rect.x1, rect.y0 + z1 * height), "zone"
+
+
+def roi_image(path, page, kind):
+    """PNG isječak regiona (sivi tonovi, ROI_DPI), ili None ako region nije fokusiran.
+
+    page je otvorena fitz stranica fajla `path` (za koordinate); renderuje worker.
+    """
+    clip, source = find_roi(page, kind)
+    if source == "page":
+        return None
+    with span("roi", kind=kind, source=source):
+        return render_pages(path, [(page.number, "PNG", 0, tuple(clip))], dpi=ROI_DPI)[0]
+
+
+def _prescan_image(img, mime, api_key, provider):
     content = [
-        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img}"}},
+        image_part(img, mime),
         {"type": "text", "text": (
             "Pronađi broj računa/otpremnice na ovoj slici. "
             "Traži tekst poput 'RAČUN - OTPREMNICA broj:' ili 'Račun broj:'. "
             "Vrati SAMO broj (npr. '0490/2026'). Ništa drugo."
         )},
     ]
-    raw = _ai_call(content, api_key, provider=provider, max_tokens=100)
+    return _ai_call(content, api_key, provider=provider, max_tokens=100, expect_json=False)
+
+
+def _prescan_page(path, page, api_key, provider):
+    """Broj računa sa stranice: prvo isječak zaglavlja, cijela stranica ako u njemu nema broja."""
+    crop = roi_image(path, page, "header")
+    if crop is not None:
+        m = _INVOICE_NO_RE.search(_prescan_image(crop, "image/png", api_key, provider))
+        if m:
+            return m.group(1)
+        print(f"  [ROI] Str. {page.number + 1}: broj računa nije u isječku zaglavlja, šaljem cijelu stranicu")
+    img = render_pages(path, [(page.number, "JPEG", 50)])[0]
+    raw = _prescan_image(img, "image/jpeg", api_key, provider)
     # Očisti — izvuci samo pattern koji liči na broj računa
-    m = re.search(r'(\d{3,6}/\d{4})', raw)
+    m = _INVOICE_NO_RE.search(raw)
     return m.group(1) if m else raw
 
 
-def group_pages_by_invoice(all_pages, api_key=None, provider="openai", progress_cb=None):
+def totals_image(pdf_bytes):
+    """PNG isječak zone totala zadnje stranice, ili None (region nije fokusiran)."""
+    with _temp_pdf(pdf_bytes) as path:
+        doc = open_pdf(path)
+        try:
+            return roi_image(path, doc[-1], "totals")
+        finally:
+            doc.close()
+
+
+class PageStore:
+    """Stranice batcha kao reference (file_id, page_index) na PDF-ove na disku.
+
+    Dokumenti se otvaraju po potrebi i drže otvoreni do close(); PDF bajtovi
+    se prave tek kad zatrebaju (merged_pdf) — ništa se ne kopira
+    unaprijed.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._docs = {}
+
+    def _doc(self, file_id):
+        doc = self._docs.get(file_id)
+        if doc is None:
+            doc = self._docs[file_id] = open_pdf(self.paths[file_id])
+        return doc
+
+    def page(self, ref):
+        """Otvorena fitz stranica za referencu."""
+        file_id, page_index = ref
+        return self._doc(file_id)[page_index]
+
+    def merged_pdf(self, refs):
+        """Jedan PDF od datih referenci (mogu biti iz različitih fajlova), redom."""
+        merged = fitz.open()
+        try:
+            for file_id, page_index in refs:
+                merged.insert_pdf(self._doc(file_id), from_page=page_index, to_page=page_index)
+            return merged.tobytes()
+        finally:
+            merged.close()
+
+    def close(self):
+        for doc in self._docs.values():
+            doc.close()
+        self._docs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def group_pages_by_invoice(page_refs, store, api_key=None, provider="openai", progress_cb=None):
     """Pre-skenira stranice i grupiše ih po broju računa.
 
     Args:
-        all_pages: lista (page_num, page_bytes) tuple-ova
+        page_refs: lista (file_id, page_index) referenci
+        store: PageStore iz kojeg se stranica renderuje za pre-scan
         api_key: API ključ
         provider: "openai" ili "claude"
         progress_cb: callback(i, total, label) za progress bar
 
     Returns:
-        lista grupa: [(invoice_number, [(page_num, page_bytes), ...]), ...]
+        lista grupa: [(invoice_number, [(file_id, page_index), ...]), ...]
     """
-    # Faza 1: pre-scan — izvuci broj računa sa svake stranice
-    page_invoices = []  # (invoice_number, page_num, page_bytes)
-    for i, (page_num, page_bytes) in enumerate(all_pages):
-        if progress_cb:
-            progress_cb(i, len(all_pages), f"Pre-scan str. {page_num}")
-        inv_num = prescan_invoice_number(page_bytes, api_key=api_key, provider=provider)
-        page_invoices.append((inv_num, page_num, page_bytes))
-
-    # Faza 2: grupiši po broju računa (čuvaj redosljed)
     groups = []
     seen_invoices = {}
-    for inv_num, page_num, page_bytes in page_invoices:
-        if inv_num in seen_invoices:
-            seen_invoices[inv_num].append((page_num, page_bytes))
-        else:
-            group = [(page_num, page_bytes)]
-            seen_invoices[inv_num] = group
-            groups.append((inv_num, group))
-
+    with span("group_pages_by_invoice", pages=len(page_refs), provider=provider) as sp:
+        for i, ref in enumerate(page_refs):
+            if progress_cb:
+                progress_cb(i, len(page_refs), f"Pre-scan str. {ref[1] + 1}")
+            # Worker renderuje direktno iz fajla na disku — bez single-page PDF kopije
+            inv_num = _prescan_page(store.paths[ref[0]], store.page(ref), api_key, provider)
+            # Grupiši po broju računa (čuvaj redosljed)
+            if inv_num in seen_invoices:
+                seen_invoices[inv_num].append(ref)
+            else:
+                group = [ref]
+                seen_invoices[inv_num] = group
+                groups.append((inv_num, group))
+        sp.set(groups=len(groups))
     return groups
 
 
-def merge_pages_to_pdf(page_list):
-    """Spaja listu (page_num, page_bytes) u jedan PDF."""
-    merged = fitz.open()
-    for _, page_bytes in page_list:
-        doc = fitz.open(stream=page_bytes, filetype="pdf")
-        merged.insert_pdf(doc)
-        doc.close()
-    result = merged.tobytes()
-    merged.close()
-    return result
-
-
-def pdf_bytes_to_images_base64(pdf_bytes, dpi=150):
-    """Konvertuje PDF bajtove u base64 slike. PNG za jednostraničke, JPEG za višestraničke."""
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-        tmp.write(pdf_bytes)
-        tmp_path = tmp.name
-
-    try:
-        pages = convert_from_path(tmp_path, dpi=dpi)
-        is_multipage = len(pages) > 1
-        images = []
-        for i, page in enumerate(pages):
-            buffer = BytesIO()
-            if is_multipage:
-                # Višestranični (Herbavital) → JPEG za manji payload
-                quality = 60 if i > 0 else 80
-                page.save(buffer, format="JPEG", quality=quality)
-            else:
-                # Jednostranični → PNG (originalni kvalitet)
-                page.save(buffer, format="PNG")
-            img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-            images.append(img_base64)
-        return images, is_multipage
-    finally:
-        os.unlink(tmp_path)
+@_per_document
+def pdf_bytes_to_images(pdf_bytes, dpi=150):
+    """Konvertuje PDF bajtove u slike (bajtovi). PNG za jednostraničke, JPEG za višestraničke."""
+    with _temp_pdf(pdf_bytes) as tmp_path:
+        n_pages = count_pdf_pages(tmp_path)
+        is_multipage = n_pages > 1
+        if is_multipage:
+            # Višestranični (Herbavital) → JPEG za manji payload
+            jobs = [(i, "JPEG", 60 if i > 0 else 80) for i in range(n_pages)]
+        else:
+            # Jednostranični → PNG (originalni kvalitet)
+            jobs = [(0, "PNG", 0)]
+        return render_pages(tmp_path, jobs, dpi=dpi), is_multipage
 
 
 def validate_id_pdv(data):
@@ -627,24 +2798,40 @@ def validate_id_pdv(data):
     return data
 
 
-def process_pdf(pdf_bytes, filename="", api_key=None, provider="openai"):
-    """Obrađuje PDF i vraća dict sa KIF podacima."""
+def process_pdf(pdf_bytes, filename="", api_key=None, provider="openai", routing=False):
+    """Obrađuje PDF i vraća dict sa KIF podacima.
+
+    routing=True bira model po složenosti dokumenta (vidi classify_complexity).
+    """
+    with span("process_pdf", filename=filename, provider=provider, routing=routing, pdf_bytes=len(pdf_bytes)):
+        if routing and provider not in _PROVIDERS:
+            return _routed(_process_pdf_once, _kif_needs_escalation, pdf_bytes, filename, api_key, provider)
+        return _process_pdf_once(pdf_bytes, filename=filename, api_key=api_key, provider=provider)
+
 
+def _process_pdf_once(pdf_bytes, filename="", api_key=None, provider="openai"):
+    """Jedna KIF ekstrakcija odabranim providerom."""
+
+    pdf_bytes, ocr_used = ocr_prepass(pdf_bytes)
     pdf_text = extract_text_from_bytes(pdf_bytes)
 
     content = []
     has_text = len(pdf_text) >= MIN_TEXT_LENGTH
 
+    # Partner poznat po JIB-u iz teksta → ne tražimo njegove podatke od modela
+    registry = get_partner_registry("kif")
+    known_party = registry.find_in_text(pdf_text) if has_text else None
+    current_span().set(partner_cache_hit=bool(known_party), ocr=ocr_used, text_chars=len(pdf_text))
+    prompt = KIF_PROMPT_KNOWN_PARTY if known_party else EXTRACTION_PROMPT
+    schema = KIF_SCHEMA_KNOWN_PARTY if known_party else KIF_SCHEMA
+
     # UVIJEK šalji sliku — OCR tekst je često pokvarjen i AI treba vidjeti raspored
-    images, is_multipage = pdf_bytes_to_images_base64(pdf_bytes)
+    images, is_multipage = pdf_bytes_to_images(pdf_bytes, dpi=OCR_IMAGE_DPI if ocr_used else 150)
     mime = "image/jpeg" if is_multipage else "image/png"
 
     # Za višestranične: šalji SAMO prvu stranicu za header/kupac info
     first_img = images[0]
-    content.append({
-        "type": "image_url",
-        "image_url": {"url": f"data:{mime};base64,{first_img}"},
-    })
+    content.append(image_part(first_img, mime))
 
     ref_instruction = (
         "\n\nPOSEBNO VAŽNO — REF polje:\n"
@@ -654,11 +2841,13 @@ def process_pdf(pdf_bytes, filename="", api_key=None, provider="openai"):
     )
 
     if is_multipage:
-        # Višestranični: traži samo header podatke sa prve stranice, iznose ćemo izvući zasebno
+        # Višestranični: JEDAN poziv sa prvom (zaglavlje, kupac) i zadnjom stranicom (totali)
+        content.append(image_part(images[-1], mime))
         content.append({"type": "text", "text": (
-            "Ovo je PRVA stranica višestraničnog računa. Izvuci podatke o kupcu i računu. "
-            "Za IZNAKFT, IZNOSNOV i IZNPDV upiši '0' — iznose ću izvući sa zadnje stranice zasebno.\n\n"
-            f"{EXTRACTION_PROMPT}{ref_instruction}"
+            "Ovo je višestranični račun. PRVA slika je PRVA stranica (zaglavlje, podaci o kupcu i računu), "
+            "DRUGA slika je ZADNJA stranica — na njenom dnu su ukupni iznosi.\n"
+            "Podatke o kupcu i računu uzmi sa prve stranice, a IZNAKFT, IZNOSNOV i IZNPDV sa zadnje.\n\n"
+            f"{prompt}{ref_instruction}"
         )})
     elif has_text:
         content.append({
@@ -667,73 +2856,65 @@ def process_pdf(pdf_bytes, filename="", api_key=None, provider="openai"):
                     f"DOBAVLJAČ/IZDAVAČ je firma čiji je logo/zaglavlje (firma koja ŠALJE račun).\n"
                     f"KUPAC je firma na koju glasi račun (piše 'Korisnik:', 'Kupac:' ili slično).\n\n"
                     f"Za TAČNE brojeve koristi ovaj tekst iz PDF-a:\n\n"
-                    f"---\n{pdf_text}\n---\n\n{EXTRACTION_PROMPT}{ref_instruction}",
+                    f"---\n{condense_pdf_text(pdf_bytes)}\n---\n\n{prompt}{ref_instruction}",
         })
     else:
-        content.append({"type": "text", "text": f"{EXTRACTION_PROMPT}{ref_instruction}"})
-
-    raw = _ai_call(content, api_key, provider=provider, max_tokens=2000)
-
-    if raw.startswith("```"):
-        raw = raw.split("\n", 1)[1]
-        raw = raw.rsplit("```", 1)[0]
-
-    start = raw.find("{")
-    end = raw.rfind("}") + 1
-    if start >= 0 and end > start:
-        raw = raw[start:end]
-
-    data = json.loads(raw)
-
-    # ── Za višestranične: drugi AI poziv — izvuci iznose sa ZADNJE stranice ──
-    if is_multipage and len(images) > 1:
-        last_img = images[-1]
-        amounts_content = [
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{last_img}"}},
-            {"type": "text", "text": (
-                "Ovo je ZADNJA stranica računa. Na dnu se nalaze ukupni iznosi.\n"
-                "Pronađi i vrati SAMO ova 3 broja kao JSON:\n"
-                "{\n"
-                '  "IZNAKFT": "UKUPAN IZNOS ZA NAPLATU KM (npr. 437.53)",\n'
-                '  "IZNOSNOV": "Ukupno bez PDV-a — ako ima rabat, koristi MANJI broj POSLIJE popusta (npr. 373.96)",\n'
-                '  "IZNPDV": "Ukupno PDV 17% (npr. 63.57)"\n'
-                "}\n"
-                "Koristi tačku kao decimalni separator. Vrati SAMO JSON, ništa drugo."
-            )},
-        ]
-        amounts_raw = _ai_call(amounts_content, api_key, provider=provider, max_tokens=200)
-        if amounts_raw.startswith("```"):
-            amounts_raw = amounts_raw.split("\n", 1)[1]
-            amounts_raw = amounts_raw.rsplit("```", 1)[0]
-        a_start = amounts_raw.find("{")
-        a_end = amounts_raw.rfind("}") + 1
-        if a_start >= 0 and a_end > a_start:
-            amounts_raw = amounts_raw[a_start:a_end]
-        try:
-            amounts = json.loads(amounts_raw)
+        content.append({"type": "text", "text": f"{prompt}{ref_instruction}"})
+
+    data = _extract_json(content, api_key, provider, schema, max_tokens=2000)
+
+    # ── Fallback za višestranične: ako kombinovani odgovor nema ispravne iznose,
+    #    zaseban AI poziv samo za iznose sa ZADNJE stranice ──
+    if is_multipage and len(images) > 1 and not _kif_amounts_ok(data):
+        print(f"  [TOTALS] {filename}: iznosi iz kombinovanog poziva nisu ispravni, zaseban poziv")
+        # Prvo samo isječak zone totala zadnje stranice; cijela stranica ako region
+        # nije fokusiran ili iznosi iz isječka nisu ispravni
+        attempts = []
+        crop = totals_image(pdf_bytes)
+        if crop is not None:
+            attempts.append((image_part(crop, "image/png"),
+                             "Ovo je isječak dna ZADNJE stranice računa, sa ukupnim iznosima.\n"))
+        attempts.append((image_part(images[-1], "image/jpeg"),
+                         "Ovo je ZADNJA stranica računa. Na dnu se nalaze ukupni iznosi.\n"))
+        for n, (totals_part, where) in enumerate(attempts, 1):
+            amounts_content = [
+                totals_part,
+                {"type": "text", "text": (
+                    where +
+                    "Pronađi i vrati SAMO ova 3 broja kao JSON:\n"
+                    "{\n"
+                    '  "IZNAKFT": "UKUPAN IZNOS ZA NAPLATU KM (npr. 437.53)",\n'
+                    '  "IZNOSNOV": "Ukupno bez PDV-a — ako ima rabat, koristi MANJI broj POSLIJE popusta (npr. 373.96)",\n'
+                    '  "IZNPDV": "Ukupno PDV 17% (npr. 63.57)"\n'
+                    "}\n"
+                    "Koristi tačku kao decimalni separator. Vrati SAMO JSON, ništa drugo."
+                )},
+            ]
+            try:
+                amounts = _extract_json(amounts_content, api_key, provider, TOTALS_SCHEMA, max_tokens=200)
+            except ValueError:
+                continue  # Ako parsiranje ne uspije, zadrži vrijednosti iz prvog poziva
+            if n < len(attempts) and not _kif_amounts_ok(amounts):
+                print(f"  [ROI] {filename}: iznosi iz isječka totala nisu ispravni, šaljem cijelu stranicu")
+                continue
             for key in ["IZNAKFT", "IZNOSNOV", "IZNPDV"]:
                 if amounts.get(key):
                     data[key] = str(amounts[key]).replace(",", ".")
-        except (json.JSONDecodeError, KeyError):
-            pass  # Ako parsiranje ne uspije, zadrži vrijednosti iz prvog poziva
-
-    # Dopuni iz poznatih partnera
-    full_text = (pdf_text + " " + json.dumps(data)).lower()
-    for partner in POZNATI_PARTNERI:
-        if any(kw.lower() in full_text for kw in partner["kljucne_rijeci"]):
-            if not data.get("NAZIVPP"):
-                data["NAZIVPP"] = partner["naziv"]
-            if not data.get("IDDVPP"):
-                data["IDDVPP"] = partner["id"]
-            if not data.get("JIBPUPP"):
-                data["JIBPUPP"] = partner["pdv"]
-            if not data.get("SJEDISTEPP"):
-                data["SJEDISTEPP"] = partner["adresa"]
             break
 
+    # Dopuni iz registra partnera (JIB iz teksta, ili JIB koji je model pročitao)
+    t_post = time.perf_counter()
+    if known_party:
+        registry.apply(data, *known_party)
+    else:
+        jib = str(data.get("IDDVPP", "")).strip()
+        partner = registry.lookup(jib) if _JIB_RE.fullmatch(jib) else None
+        if partner:
+            registry.apply(data, jib, partner, only_empty=True)
+
     # Korekcija naziva iz mape kupaca
-    if data.get("NAZIVPP") and KUPCI_NAMES:
-        data["NAZIVPP"] = match_kupac_name(data["NAZIVPP"], KUPCI_NAMES)
+    if data.get("NAZIVPP") and len(_CUSTOMER_MASTER):
+        data["NAZIVPP"] = match_kupac_name(data["NAZIVPP"], _CUSTOMER_MASTER)
 
     # Validacija ID/PDV
     data = validate_id_pdv(data)
@@ -902,143 +3083,474 @@ def process_pdf(pdf_bytes, filename="", api_key=None, provider="openai"):
     except (ValueError, TypeError):
         pass
 
+    record_stage("post", time.perf_counter() - t_post)
     return data
 
 
-def _merge_pdf_pages(page_bytes_list):
-    """Spaja listu single-page PDF bajtova u jedan PDF."""
-    merged = fitz.open()
-    for pb in page_bytes_list:
-        doc = fitz.open(stream=pb, filetype="pdf")
-        merged.insert_pdf(doc)
-        doc.close()
-    result = merged.tobytes()
-    merged.close()
-    return result
+def _kif_amounts_ok(data):
+    """Da li KIF iznosi postoje i slažu se: IZNOSNOV + IZNPDV ≈ IZNAKFT."""
+    iznakft = _amount(data.get("IZNAKFT"))
+    iznosnov = _amount(data.get("IZNOSNOV"))
+    iznpdv = _amount(data.get("IZNPDV")) or 0.0
+    if not iznakft or not iznosnov:
+        return False
+    return abs(iznosnov + iznpdv - iznakft) <= 0.05
 
 
-def _is_incomplete(data):
-    """Provjerava da li rezultatu fale ključni iznosi (druga stranica računa)."""
-    iznakft = str(data.get("IZNAKFT", "")).strip()
-    iznosnov = str(data.get("IZNOSNOV", "")).strip()
-    # Ako nema ukupnog iznosa i nema osnove — vjerovatno nepotpun
-    return (not iznakft or iznakft == "0" or iznakft == "0.00") and \
-           (not iznosnov or iznosnov == "0" or iznosnov == "0.00")
-
-
-def process_multi_page_pdf(pdf_bytes, filename="", api_key=None):
-    """Razdvaja PDF po stranicama. Ako stranica nema iznose, spaja sa sljedećom."""
-    pages = split_pdf_to_pages(pdf_bytes)
-    results = []
-    i = 0
-    while i < len(pages):
-        page_num, page_bytes = pages[i]
-        data = process_pdf(page_bytes, filename=f"{filename} (str. {page_num})", api_key=api_key)
-
-        # Ako fale iznosi i postoji sljedeća stranica — spoji i probaj ponovo
-        if _is_incomplete(data) and i + 1 < len(pages):
-            next_page_num, next_page_bytes = pages[i + 1]
-            merged_bytes = _merge_pdf_pages([page_bytes, next_page_bytes])
-            print(f"  [MERGE] Stranica {page_num} nepotpuna, spajam sa {next_page_num}")
-            data = process_pdf(merged_bytes, filename=f"{filename} (str. {page_num}-{next_page_num})", api_key=api_key)
-            data["_page_num"] = page_num
-            data["_page_bytes"] = merged_bytes
-            results.append(data)
-            i += 2  # Preskoči obje stranice
+def process_fiscal_pdf(pdf_bytes, filename="", api_key=None, provider="openai", routing=False):
+    """Obrađuje stranicu sa fiskalnim računima i vraća listu dict-ova.
+
+    Stranice sa tekstualnim slojem iz fiskalnog softvera parsiraju se lokalno
+    (parse_fiscal_text); AI se zove samo za stranice bez upotrebljivog teksta.
+    routing=True bira model po složenosti dokumenta (vidi classify_complexity).
+    """
+    with span("process_fiscal_pdf", filename=filename, provider=provider, routing=routing, pdf_bytes=len(pdf_bytes)) as sp:
+        items, rest = _parse_fiscal_pages(pdf_bytes)
+        sp.set(text_items=len(items), ai_needed=rest is not None)
+        if items:
+            print(f"  [FISKAL] {filename}: {len(items)} računa iz teksta, bez AI poziva")
+        if rest is None:
+            return items
+        if routing and provider not in _PROVIDERS:
+            return items + _routed(_process_fiscal_once, _fiscal_needs_escalation, rest, filename, api_key, provider)
+        return items + _process_fiscal_once(rest, filename=filename, api_key=api_key, provider=provider)
+
+
+# ── Segmentacija fiskalnih računa na papiru ──
+# Na jedan papir se lijepi do 5 presjeka stanja. Umjesto jedne ogromne slike
+# i dugog niza u odgovoru, svaki račun se izreže (projekcijski profili
+# mastila) i šalje kao zaseban, manji zahtjev — paralelno.
+
+MAX_RECEIPTS_PER_SHEET = 5
+RECEIPT_SEG_DPI = 50       # rezolucija za segmentaciju (samo profili)
+RECEIPT_MIN_GAP_MM = 6     # praznina između računa (redovi unutar računa su bliže)
+RECEIPT_MIN_SIZE_MM = 25   # manji segmenti su šum (mrlje, rub skena)
+RECEIPT_PAD_MM = 2
+FISCAL_CROP_DPI = 200
+
+FISCAL_CROP_PROMPT = "Na slici je isječak sa papira, obično JEDAN fiskalni račun — vrati niz sa po jednim objektom za svaki račun koji se cijeli vidi.\n\n"
+
+
+def _ink_runs(profile, min_gap):
+    """(start, end) raspona sa mastilom u 1D profilu, razdvojenih prazninom >= min_gap."""
+    idx = np.flatnonzero(profile)
+    if idx.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > min_gap)
+    starts = np.concatenate(([idx[0]], idx[breaks + 1]))
+    ends = np.concatenate((idx[breaks], [idx[-1]])) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def segment_receipts(page, dpi=RECEIPT_SEG_DPI):
+    """Pronalazi pojedinačne račune na stranici (XY rez po prazninama).
+
+    Prvo dijeli stranicu na kolone, pa svaku kolonu na redove. Vraća listu
+    fitz.Rect za clip, ili [] ako nađe manje od 2 ili više od
+    MAX_RECEIPTS_PER_SHEET računa — tada se šalje cijela stranica.
+    """
+    ink = _page_gray(page, dpi=dpi) < INK_LEVEL
+    px_per_mm = dpi / 25.4
+    gap = max(1, int(RECEIPT_MIN_GAP_MM * px_per_mm))
+    min_size = RECEIPT_MIN_SIZE_MM * px_per_mm
+
+    boxes = []
+    for x0, x1 in _ink_runs(ink.sum(axis=0) > 1, gap):
+        for y0, y1 in _ink_runs(ink[:, x0:x1].sum(axis=1) > 1, gap):
+            if x1 - x0 >= min_size and y1 - y0 >= min_size:
+                boxes.append((x0, y0, x1, y1))
+    if not 2 <= len(boxes) <= MAX_RECEIPTS_PER_SHEET:
+        return []
+
+    scale = 72 / dpi
+    pad = RECEIPT_PAD_MM * 72 / 25.4
+    rects = []
+    for x0, y0, x1, y1 in boxes:
+        r = fitz.Rect(x0 * scale - pad, y0 * scale - pad, x1 * scale + pad, y1 * scale + pad) & page.rect
+        rects.append(r * page.derotation_matrix)
+    return rects
+
+
+def _normalize_fiscal_item(data):
+    """DI broj iz PRESCAN_LINES/BROJKIFA i iznosi GOTOVINA/KARTICNO/DEPOZIT sa zarezom."""
+    # ── Izvuci DI broj iz PRESCAN_LINES teksta (pouzdanije od direktnog AI čitanja) ──
+    di_num = ""
+    prescan = str(data.get("PRESCAN_LINES", "")).strip()
+    if prescan:
+        # Traži pattern: DI: BROJ / BROJ ili samo BROJ / 2000
+        di_match = re.search(r'[Dd][Ii][:\s]+(\d+)\s*/\s*\d+', prescan)
+        if di_match:
+            di_num = di_match.group(1)
         else:
-            data["_page_num"] = page_num
-            data["_page_bytes"] = page_bytes
-            results.append(data)
-            i += 1
+            # Fallback: traži bilo koji "BROJ / 2000" pattern
+            slash_match = re.search(r'(\d+)\s*/\s*2000', prescan)
+            if slash_match:
+                di_num = slash_match.group(1)
+
+    # Ako PRESCAN nije dao rezultat, probaj iz BROJKIFA
+    if not di_num:
+        raw_kifa = str(data.get("BROJKIFA", "")).strip()
+        raw_kifa = re.sub(r'^[Dd][Ii][:\s-]*', '', raw_kifa).strip()
+        raw_kifa = raw_kifa.split("/")[0].strip()
+        kifa_match = re.match(r'(\d+)', raw_kifa)
+        di_num = kifa_match.group(1) if kifa_match else ""
+
+    data["BROJKIFA"] = di_num
+    data["SADRZAJ"] = f"DI-{di_num}" if di_num else ""
+    data.pop("PRESCAN_LINES", None)  # Ukloni pomoćno polje
+    # Konvertuj brojeve u string sa zarezom (decimalni separator)
+    for key in ["GOTOVINA", "KARTICNO", "DEPOZIT"]:
+        val = data.get(key, "")
+        if isinstance(val, (int, float)):
+            data[key] = f"{val:.2f}".replace(".", ",")
+        elif isinstance(val, str) and val:
+            # Očisti hiljadarke: "5,062,00" ili "5.062,00" → "5062,00"
+            val = val.strip()
+            # Ako ima više zareza (npr. "5,062,00"), zadnji je decimalni
+            if val.count(",") > 1:
+                parts = val.rsplit(",", 1)
+                val = parts[0].replace(",", "") + "," + parts[1]
+            # Ako ima tačku kao hiljadarku (npr. "5.062,00")
+            if "," in val and "." in val:
+                val = val.replace(".", "")
+            # Ako nema zareza, zamijeni tačku
+            elif "." in val and "," not in val:
+                val = val.replace(".", ",")
+            data[key] = val
+    return data
+
+
+# ── Deterministički parser tekstualnog sloja (PDF iz softvera fiskalnog printera) ──
+
+_PRESJEK_RE = re.compile(r'PRESJEK\s+STANJA', re.IGNORECASE)
+_FISCAL_DATE_RE = re.compile(r'\b(\d{1,2})\.(\d{1,2})\.(\d{4})\b')
+_FISCAL_COUNTER_RE = re.compile(r'^\s*(?:BF|RF|DI|BNR)\s*:.*$', re.IGNORECASE | re.MULTILINE)
+_FISCAL_DI_RE = re.compile(r'\bDI\s*:\s*\d+\s*/\s*\d+', re.IGNORECASE)
+_STANJE_KASE_RE = re.compile(r'STANJE\s+U\s+KASI', re.IGNORECASE)
+_FISCAL_AMOUNT = r'\s*:?\s*(-?\d[\d.,]*[.,]\d{2})(?!\d)'
+_FISCAL_AMOUNT_RES = {
+    "GOTOVINA": re.compile(r'GOTOVINA\w*' + _FISCAL_AMOUNT, re.IGNORECASE),
+    "KARTICNO": re.compile(r'KARTIC\w*' + _FISCAL_AMOUNT, re.IGNORECASE),
+    "DEPOZIT": re.compile(r'DEPOZIT\w*' + _FISCAL_AMOUNT, re.IGNORECASE),
+}
+
+
+def parse_fiscal_text(text):
+    """Parsira presjeke stanja iz tekstualnog sloja, bez AI poziva.
 
-    return results
+    Svaki blok od 'PRESJEK STANJA' do sljedećeg daje datum, DI brojač i
+    iznose iz sekcije 'STANJE U KASI'. Vraća listu dict-ova kao AI put
+    (nakon _normalize_fiscal_item), ili None ako ijedan blok nije potpun —
+    tada stranica ide AI-ju.
+    """
+    blocks = _PRESJEK_RE.split(text)[1:]
+    if not blocks:
+        return None
+    items = []
+    for block in blocks:
+        date = _FISCAL_DATE_RE.search(block)
+        counters = _FISCAL_COUNTER_RE.findall(block)
+        kasa = _STANJE_KASE_RE.search(block)
+        if not date or not kasa or not any(_FISCAL_DI_RE.search(c) for c in counters):
+            return None
+        section = block[kasa.end():]
+        amounts = {key: rx.search(section) for key, rx in _FISCAL_AMOUNT_RES.items()}
+        if not amounts["GOTOVINA"] or not amounts["KARTICNO"]:
+            return None
+        day, month, year = date.groups()
+        item = {
+            "DATUMDOK": f"{int(day):02d}.{int(month):02d}.{year}",
+            "BROJKIFA": "",
+            "SADRZAJ": "",
+            "PRESCAN_LINES": "\n".join(c.strip() for c in counters),
+        }
+        for key, m in amounts.items():
+            item[key] = m.group(1) if m else ""
+        items.append(_normalize_fiscal_item(item))
+    return items
+
+
+@_per_document
+@stage("text")
+def _parse_fiscal_pages(pdf_bytes):
+    """Vraća (stavke parsirane iz teksta, PDF sa preostalim stranicama ili None).
+
+    Preostale su stranice bez upotrebljivog teksta (sken, nepotpun presjek).
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        items, rest = [], []
+        for i, page in enumerate(doc):
+            parsed = parse_fiscal_text(page.get_text())
+            if parsed:
+                items.extend(parsed)
+            else:
+                rest.append(i)
+        if not rest:
+            return items, None
+        if not items:
+            return [], pdf_bytes
+        return items, _pages_to_pdf(doc, rest)
+    finally:
+        doc.close()
 
 
-def process_fiscal_pdf(pdf_bytes, filename="", api_key=None, provider="openai"):
-    """Obrađuje stranicu sa fiskalnim računima i vraća listu dict-ova."""
+@_per_document
+def _segment_fiscal_pdf(pdf_bytes):
+    """Izrezani računi kao lista (png_bajtovi, tekst_isječka), ili None ako neka stranica nije segmentirana.
+
+    Segmentacija (mali sivi render) je u procesu; isječci na FISCAL_CROP_DPI
+    renderuju se u render pool-u kao i ostale slike za AI.
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        jobs, texts = [], []
+        for page in doc:
+            with stage("rasterize"):
+                rects = segment_receipts(page)
+            if not rects:
+                return None
+            for clip in rects:
+                jobs.append((page.number, "PNG", 0, tuple(clip)))
+                texts.append(_collapse_ws(page.get_text(clip=clip)))
+    finally:
+        doc.close()
+    with _temp_pdf(pdf_bytes) as path:
+        images = render_pages(path, jobs, dpi=FISCAL_CROP_DPI)
+    return list(zip(images, texts))
+
+
+def _extract_fiscal_crop(img, text, api_key, provider):
+    """Jedan izrezani račun → lista dict-ova (prazna ako model ništa ne nađe).
+
+    Isječak obično ima jedan račun, ali ako segmentacija spoji dva susjedna,
+    vraćaju se oba.
+    """
+    content = [image_part(img, "image/png")]
+    prompt = FISCAL_CROP_PROMPT + FISCAL_EXTRACTION_PROMPT
+    if len(text) >= MIN_TEXT_LENGTH:
+        prompt = f"Za TAČNE brojeve koristi ovaj tekst iz PDF-a:\n\n---\n{text}\n---\n\n{prompt}"
+    content.append({"type": "text", "text": prompt})
+    items = _extract_json(content, api_key, provider, FISCAL_SCHEMA, max_tokens=800, expect="array")
+    return items or []
+
+
+def _process_fiscal_once(pdf_bytes, filename="", api_key=None, provider="openai"):
+    """Jedna ekstrakcija fiskalne stranice odabranim providerom.
+
+    Ako se papir može segmentirati, svaki račun ide kao zaseban paralelni
+    zahtjev; inače cijela stranica kao jedan zahtjev sa nizom računa. Ako
+    nijedan isječak ne da račun, segmentacija je vjerovatno promašila i
+    stranica ide cijela.
+    """
+    crops = _segment_fiscal_pdf(pdf_bytes)
+    if crops:
+        print(f"  [FISKAL] {filename}: {len(crops)} računa izrezano, paralelna ekstrakcija")
+        with ThreadPoolExecutor(max_workers=len(crops)) as pool:
+            # copy_context: hedging(...) iz pozivaoca važi i u worker nitima
+            futures = [
+                pool.submit(contextvars.copy_context().run, _extract_fiscal_crop, img, text, api_key, provider)
+                for img, text in crops
+            ]
+            results = [f.result() for f in futures]
+        for n, items in enumerate(results, 1):
+            if not items:
+                print(f"  [FISKAL] {filename}: isječak {n}/{len(crops)} bez računa")
+        if any(results):
+            with stage("post"):
+                return [_normalize_fiscal_item(item) for items in results for item in items if item]
+        print(f"  [FISKAL] {filename}: nijedan isječak nije dao račun — ekstrakcija cijele stranice")
+
     pdf_text = extract_text_from_bytes(pdf_bytes)
-    images, is_multipage = pdf_bytes_to_images_base64(pdf_bytes, dpi=300)
+    images, is_multipage = pdf_bytes_to_images(pdf_bytes, dpi=300)
     mime = "image/png"
 
     content = []
     for img in images:
-        content.append({
-            "type": "image_url",
-            "image_url": {"url": f"data:{mime};base64,{img}"},
-        })
+        content.append(image_part(img, mime))
 
     has_text = len(pdf_text) >= MIN_TEXT_LENGTH
     if has_text:
         content.append({
             "type": "text",
             "text": f"Za TAČNE brojeve koristi ovaj tekst iz PDF-a:\n\n"
-                    f"---\n{pdf_text}\n---\n\n{FISCAL_EXTRACTION_PROMPT}",
+                    f"---\n{condense_pdf_text(pdf_bytes, max_tokens=FISCAL_TEXT_TOKENS, keep_re=_FISCAL_KEEP_RE)}\n---\n\n{FISCAL_EXTRACTION_PROMPT}",
         })
     else:
         content.append({"type": "text", "text": FISCAL_EXTRACTION_PROMPT})
 
-    raw = _ai_call(content, api_key, provider=provider, max_tokens=4000)
+    # Parsiranje — očekujemo JSON niz
+    items = _extract_json(content, api_key, provider, FISCAL_SCHEMA, max_tokens=4000, expect="array")
+    with stage("post"):
+        return [_normalize_fiscal_item(data) for data in items]
+
+
+# ── Pipeline obrade (CPU i mreža se preklapaju) ──
+# Reader → prepare (OCR, tekst, render/encode) → AI dispatch → post (pozivalac).
+# Faze su povezane ograničenim redovima, pa se sljedeći dokumenti renderuju
+# dok su prethodni na AI pozivu; max_in_flight ograničava koliko dokumenata
+# (PDF bajtovi + slike) je istovremeno u memoriji.
+
+PIPELINE_PREPARE_WORKERS = int(os.environ.get("PIPELINE_PREPARE_WORKERS", "2"))
+PIPELINE_AI_WORKERS = int(os.environ.get("PIPELINE_AI_WORKERS", "4"))
+_PIPELINE_DONE = object()
+
+
+def prepare_invoice(pdf_bytes, routing=False):
+    """Prepare faza za KIF/KUF: isto što _process_pdf_once / _process_kuf_once traže, unaprijed."""
+    if routing:
+        classify_complexity(pdf_bytes)
+    pdf_bytes, ocr_used = ocr_prepass(pdf_bytes)
+    if len(extract_text_from_bytes(pdf_bytes)) >= MIN_TEXT_LENGTH:
+        condense_pdf_text(pdf_bytes)
+    pdf_bytes_to_images(pdf_bytes, dpi=OCR_IMAGE_DPI if ocr_used else 150)
+
+
+def prepare_fiscal(pdf_bytes, routing=False):
+    """Prepare faza za dnevni prihod: parsiranje teksta, pa isječci ili cijele stranice za AI."""
+    _, rest = _parse_fiscal_pages(pdf_bytes)
+    if rest is None:
+        return
+    if routing:
+        classify_complexity(rest)
+    if _segment_fiscal_pdf(rest):
+        return
+    if len(extract_text_from_bytes(rest)) >= MIN_TEXT_LENGTH:
+        condense_pdf_text(rest, max_tokens=FISCAL_TEXT_TOKENS, keep_re=_FISCAL_KEEP_RE)
+    pdf_bytes_to_images(rest, dpi=300)
+
+
+def _put(q, item, stop):
+    """put koji odustaje kad je pipeline zaustavljen (potrošač prekinuo)."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
-    if raw.startswith("```"):
-        raw = raw.split("\n", 1)[1]
-        raw = raw.rsplit("```", 1)[0]
 
-    # Parsiranje — očekujemo JSON niz
-    start = raw.find("[")
-    end = raw.rfind("]") + 1
-    if start >= 0 and end > start:
-        raw = raw[start:end]
-
-    items = json.loads(raw)
-    if isinstance(items, dict):
-        items = [items]
-
-    results = []
-    for data in items:
-        # ── Izvuci DI broj iz PRESCAN_LINES teksta (pouzdanije od direktnog AI čitanja) ──
-        di_num = ""
-        prescan = str(data.get("PRESCAN_LINES", "")).strip()
-        if prescan:
-            # Traži pattern: DI: BROJ / BROJ ili samo BROJ / 2000
-            di_match = re.search(r'[Dd][Ii][:\s]+(\d+)\s*/\s*\d+', prescan)
-            if di_match:
-                di_num = di_match.group(1)
-            else:
-                # Fallback: traži bilo koji "BROJ / 2000" pattern
-                slash_match = re.search(r'(\d+)\s*/\s*2000', prescan)
-                if slash_match:
-                    di_num = slash_match.group(1)
-
-        # Ako PRESCAN nije dao rezultat, probaj iz BROJKIFA
-        if not di_num:
-            raw_kifa = str(data.get("BROJKIFA", "")).strip()
-            raw_kifa = re.sub(r'^[Dd][Ii][:\s-]*', '', raw_kifa).strip()
-            raw_kifa = raw_kifa.split("/")[0].strip()
-            kifa_match = re.match(r'(\d+)', raw_kifa)
-            di_num = kifa_match.group(1) if kifa_match else ""
-
-        data["BROJKIFA"] = di_num
-        data["SADRZAJ"] = f"DI-{di_num}" if di_num else ""
-        data.pop("PRESCAN_LINES", None)  # Ukloni pomoćno polje
-        # Konvertuj brojeve u string sa zarezom (decimalni separator)
-        for key in ["GOTOVINA", "KARTICNO", "DEPOZIT"]:
-            val = data.get(key, "")
-            if isinstance(val, (int, float)):
-                data[key] = f"{val:.2f}".replace(".", ",")
-            elif isinstance(val, str) and val:
-                # Očisti hiljadarke: "5,062,00" ili "5.062,00" → "5062,00"
-                val = val.strip()
-                # Ako ima više zareza (npr. "5,062,00"), zadnji je decimalni
-                if val.count(",") > 1:
-                    parts = val.rsplit(",", 1)
-                    val = parts[0].replace(",", "") + "," + parts[1]
-                # Ako ima tačku kao hiljadarku (npr. "5.062,00")
-                if "," in val and "." in val:
-                    val = val.replace(".", "")
-                # Ako nema zareza, zamijeni tačku
-                elif "." in val and "," not in val:
-                    val = val.replace(".", ",")
-                data[key] = val
-        results.append(data)
+def _get(q, stop):
+    """get koji vraća kraj reda kad je pipeline zaustavljen."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _PIPELINE_DONE
+
+
+def run_pipeline(items, process, prepare=None, prepare_workers=None, ai_workers=None, max_in_flight=None):
+    """Obrađuje dokumente u fazama sa ograničenim redovima između njih.
 
-    return results
+    Args:
+        items: iterable (meta, pdf_bytes) — čita ga zasebna reader nit, pa ne smije
+               dirati UI; pdf_bytes=None prolazi bez obrade (preskočena grupa)
+        process: process(meta, pdf_bytes) → rezultat (AI faza, u nitima)
+        prepare: opciono prepare(pdf_bytes) — OCR/tekst/render unaprijed (prepare_invoice,
+                 prepare_fiscal); greške se ignorišu, AI faza ih ponovi i prijavi
+        prepare_workers, ai_workers: broj niti po fazi (default PIPELINE_*_WORKERS)
+        max_in_flight: max dokumenata između readera i pozivaoca (default ai + 2×prepare)
+    Yields:
+        (meta, pdf_bytes, rezultat, greška) istim redom kao items — pozivalac je
+        post faza (validacija, duplikati, UI).
+    """
+    prepare_workers = prepare_workers or PIPELINE_PREPARE_WORKERS
+    ai_workers = ai_workers or PIPELINE_AI_WORKERS
+    max_in_flight = max_in_flight or ai_workers + 2 * prepare_workers
+    prepare_q = queue.Queue(maxsize=prepare_workers)
+    ai_q = queue.Queue(maxsize=ai_workers)
+    done_q = queue.Queue()
+    slots = threading.Semaphore(max_in_flight)
+    stop = threading.Event()
+    reader_error = []
+
+    def reader():
+        try:
+            for idx, (meta, pdf_bytes) in enumerate(items):
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if not _put(prepare_q, (idx, meta, pdf_bytes), stop):
+                    return
+        except Exception as e:
+            reader_error.append(e)
+        finally:
+            for _ in range(prepare_workers):
+                _put(prepare_q, _PIPELINE_DONE, stop)
+
+    def stage_worker(in_q, out_q, n_out, remaining, work):
+        while True:
+            job = _get(in_q, stop)
+            if job is _PIPELINE_DONE:
+                with remaining[1]:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    for _ in range(n_out):
+                        _put(out_q, _PIPELINE_DONE, stop)
+                return
+            _put(out_q, work(job), stop)
+
+    def prepare_job(job):
+        idx, meta, pdf_bytes = job
+        memo = {}
+        if pdf_bytes is not None and prepare is not None:
+            token = _PREPARED.set(memo)
+            try:
+                prepare(pdf_bytes)
+            except Exception as e:
+                print(f"  [PIPELINE] Priprema nije uspjela, AI faza ponavlja: {e}")
+            finally:
+                _PREPARED.reset(token)
+        return idx, meta, pdf_bytes, memo
+
+    def ai_job(job):
+        idx, meta, pdf_bytes, memo = job
+        if pdf_bytes is None:
+            return idx, meta, pdf_bytes, None, None
+        token = _PREPARED.set(memo)
+        try:
+            return idx, meta, pdf_bytes, process(meta, pdf_bytes), None
+        except Exception as e:
+            return idx, meta, pdf_bytes, None, e
+        finally:
+            _PREPARED.reset(token)
+            memo.clear()
+
+    # copy_context po niti: hedging(...) i span pozivaoca važe i u fazama
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(reader,),
+                                name="pipeline-reader", daemon=True)]
+    remaining_prepare = [prepare_workers, threading.Lock()]
+    for n in range(prepare_workers):
+        threads.append(threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(stage_worker, prepare_q, ai_q, ai_workers, remaining_prepare, prepare_job),
+            name=f"pipeline-prepare-{n}", daemon=True))
+    remaining_ai = [ai_workers, threading.Lock()]
+    for n in range(ai_workers):
+        threads.append(threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(stage_worker, ai_q, done_q, 1, remaining_ai, ai_job),
+            name=f"pipeline-ai-{n}", daemon=True))
+    for t in threads:
+        t.start()
+
+    # Post faza: rezultate vraćamo redom ulaza (bafer je ograničen sa max_in_flight)
+    pending, next_idx = {}, 0
+    try:
+        while True:
+            job = done_q.get()
+            if job is _PIPELINE_DONE:
+                break
+            pending[job[0]] = job[1:]
+            while next_idx in pending:
+                yield pending.pop(next_idx)
+                next_idx += 1
+                slots.release()
+        if reader_error:
+            raise reader_error[0]
+    finally:
+        stop.set()
+        threads[0].join()
@@ -0,0 +1,351 @@
+"""Lokalni HTTP servis za programsko slanje dokumenata (ERP, skener softver).
+
+Pokretanje:
+    python server.py --port 8765 --workers 2 --queue-size 16
+    python server.py --trace traces.jsonl   # spanovi obrade, jedan JSON red po spanu
+
+Endpointi:
+    POST /extract/kif|kuf|dnevni   PDF kao tijelo zahtjeva (application/pdf)
+                                   ili multipart/form-data polje "file".
+                                   Query: provider, filename, wait=1, timeout, routing=1
+    GET  /jobs/<job_id>            status i rezultat posla
+    GET  /health                   stanje reda, workeri i protok (JSON)
+    GET  /metrics                  iste metrike u Prometheus text formatu
+
+API ključ se šalje u headeru X-Api-Key; ako ga nema, koristi se
+ANTHROPIC_API_KEY / OPENAI_API_KEY iz okruženja.
+"""
+import argparse
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import processor
+
+# mod → ime funkcije u processor modulu (traži se pri pozivu, pa se može zamijeniti)
+MODES = {
+    "kif": "process_pdf",
+    "kuf": "process_kuf_pdf",
+    "dnevni": "process_fiscal_pdf",
+}
+
+JOB_TTL = 3600          # sekundi koliko se čuva završen posao
+MAX_JOBS = 1000         # max broj završenih poslova u memoriji
+THROUGHPUT_WINDOW = 60  # sekundi za računanje protoka
+
+
+def _public_result(result):
+    """Rezultat bez internih ključeva processor-a (npr. _ROUTE iz rutiranja)."""
+    if isinstance(result, list):
+        return [_public_result(item) for item in result]
+    if isinstance(result, dict):
+        return {k: v for k, v in result.items() if not k.startswith("_")}
+    return result
+
+
+class QueueFullError(Exception):
+    """Red poslova je pun — klijent treba pokušati kasnije (HTTP 429)."""
+
+
+class Job:
+    """Jedan posao obrade PDF-a."""
+
+    def __init__(self, mode, pdf_bytes, filename, provider, api_key, options=None):
+        self.id = uuid.uuid4().hex
+        self.mode = mode
+        self.pdf_bytes = pdf_bytes
+        self.filename = filename
+        self.provider = provider
+        self.api_key = api_key
+        self.options = options or {}
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        d = {
+            "job_id": self.id,
+            "mode": self.mode,
+            "filename": self.filename,
+            "status": self.status,
+        }
+        if self.started and self.finished:
+            d["duration_s"] = round(self.finished - self.started, 3)
+        if self.status == "done":
+            d["result"] = self.result
+        elif self.status == "error":
+            d["error"] = self.error
+        return d
+
+
+class ExtractionService:
+    """Ograničen red + pool workera oko process_pdf / process_kuf_pdf / process_fiscal_pdf.
+
+    Args:
+        workers: broj paralelnih workera
+        queue_size: kapacitet reda — kad je pun, submit baca QueueFullError
+        handlers: opcioni dict mod → funkcija (za testove); inače MODES iz processor modula
+    """
+
+    def __init__(self, workers=2, queue_size=16, handlers=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.handlers = handlers or {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._finish_times = deque()
+        self._started_at = time.time()
+
+    def start(self):
+        for n in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"extract-worker-{n}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _handler(self, mode):
+        if mode in self.handlers:
+            return self.handlers[mode]
+        return getattr(processor, MODES[mode])
+
+    def submit(self, mode, pdf_bytes, filename="", provider="claude-sonnet", api_key=None, **options):
+        """Stavlja posao u red i vraća Job. Baca QueueFullError ako je red pun.
+
+        Dodatni keyword argumenti (npr. routing=True) prosljeđuju se funkciji obrade.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Nepoznat mod: {mode}")
+        job = Job(mode, pdf_bytes, filename, provider, api_key, options)
+        with self._lock:
+            self._evict_old_jobs()
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+                self._rejected += 1
+            raise QueueFullError("Red je pun")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _evict_old_jobs(self):
+        now = time.time()
+        finished = [j for j in self._jobs.values() if j.finished]
+        for j in finished:
+            if now - j.finished > JOB_TTL:
+                del self._jobs[j.id]
+        finished = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.finished)
+        for j in finished[:max(0, len(finished) - MAX_JOBS)]:
+            del self._jobs[j.id]
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            with self._lock:
+                self._in_flight += 1
+            job.status = "running"
+            job.started = time.time()
+            try:
+                job.result = _public_result(self._handler(job.mode)(
+                    job.pdf_bytes, filename=job.filename,
+                    api_key=job.api_key, provider=job.provider, **job.options,
+                ))
+                job.status = "done"
+            except Exception as e:
+                job.error = str(e)
+                job.status = "error"
+            finally:
+                job.finished = time.time()
+                job.pdf_bytes = None
+                with self._lock:
+                    self._in_flight -= 1
+                    if job.status == "done":
+                        self._completed += 1
+                    else:
+                        self._failed += 1
+                    self._finish_times.append(job.finished)
+                job.done.set()
+                self._queue.task_done()
+
+    def metrics(self):
+        now = time.time()
+        with self._lock:
+            while self._finish_times and now - self._finish_times[0] > THROUGHPUT_WINDOW:
+                self._finish_times.popleft()
+            recent = len(self._finish_times)
+            return {
+                "status": "ok",
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self.queue_size,
+                "workers": self.workers,
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "throughput_per_min": round(recent * 60 / THROUGHPUT_WINDOW, 2),
+                "uptime_s": round(now - self._started_at, 1),
+            }
+
+
+def _default_api_key(provider):
+    name = "ANTHROPIC_API_KEY" if provider.startswith("claude") else "OPENAI_API_KEY"
+    return os.environ.get(name, "")
+
+
+def _read_pdf_body(headers, body):
+    """Vraća (pdf_bytes, filename) iz raw ili multipart/form-data tijela."""
+    ctype = headers.get("Content-Type", "")
+    if not ctype.startswith("multipart/form-data"):
+        return body, ""
+    msg = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {ctype}\r\n\r\n".encode("latin-1") + body
+    )
+    for part in msg.iter_parts():
+        if part.get_param("name", header="content-disposition") == "file":
+            return part.get_payload(decode=True), part.get_filename() or ""
+    return b"", ""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None  # postavlja make_server
+
+    def _send_json(self, status, payload, extra_headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (extra_headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send_json(200, self.service.metrics())
+        elif path == "/metrics":
+            lines = []
+            for k, v in self.service.metrics().items():
+                if isinstance(v, (int, float)):
+                    lines.append(f"bsbiro_{k} {v}")
+            body = ("\n".join(lines) + "\n").encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path.startswith("/jobs/"):
+            job = self.service.get(path[len("/jobs/"):])
+            if not job:
+                self._send_json(404, {"error": "Posao ne postoji"})
+            else:
+                self._send_json(200, job.to_dict())
+        else:
+            self._send_json(404, {"error": "Nepoznat endpoint"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        m = re.fullmatch(r"/extract/(\w+)", url.path)
+        if not m or m.group(1) not in MODES:
+            self._send_json(404, {"error": "Nepoznat endpoint"})
+            return
+        mode = m.group(1)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        length = int(self.headers.get("Content-Length") or 0)
+        pdf_bytes, part_name = _read_pdf_body(self.headers, self.rfile.read(length))
+        if not pdf_bytes.startswith(b"%PDF"):
+            self._send_json(400, {"error": "Tijelo zahtjeva nije PDF"})
+            return
+
+        provider = params.get("provider", "claude-sonnet")
+        api_key = self.headers.get("X-Api-Key") or _default_api_key(provider)
+        filename = params.get("filename") or part_name
+        options = {}
+        if params.get("routing") in ("1", "true"):
+            options["routing"] = True
+        try:
+            job = self.service.submit(mode, pdf_bytes, filename=filename, provider=provider, api_key=api_key, **options)
+        except QueueFullError:
+            self._send_json(429, {"error": "Red je pun, pokušaj kasnije"}, {"Retry-After": "5"})
+            return
+
+        if params.get("wait") in ("1", "true"):
+            timeout = float(params.get("timeout", 300))
+            if job.done.wait(timeout):
+                self._send_json(200 if job.status == "done" else 500, job.to_dict())
+                return
+        self._send_json(202, job.to_dict(), {"Location": f"/jobs/{job.id}"})
+
+    def log_message(self, fmt, *args):
+        print(f"[server] {self.address_string()} {fmt % args}")
+
+
+def make_server(host="127.0.0.1", port=8765, service=None):
+    """Kreira HTTP server vezan za dati ExtractionService (ne pokreće ga)."""
+    service = service or ExtractionService()
+    handler = type("Handler", (_Handler,), {"service": service})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.service = service
+    return httpd
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BS BIRO — lokalni servis za obradu PDF računa")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=16)
+    parser.add_argument("--trace", metavar="FILE", help="upisuj spanove obrade u JSON-lines fajl")
+    args = parser.parse_args()
+
+    if args.trace:
+        processor.configure_tracing(processor.JsonLinesExporter(args.trace))
+
+    service = ExtractionService(workers=args.workers, queue_size=args.queue_size)
+    service.start()
+    httpd = make_server(args.host, args.port, service)
+    print(f"[server] Slušam na http://{args.host}:{args.port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
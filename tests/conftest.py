@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Moduli su u korijenu repozitorija (app.py, processor.py, server.py...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
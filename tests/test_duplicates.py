@@ -0,0 +1,74 @@
+import fitz
+import numpy as np
+
+from processor import DuplicateIndex, classify_pages
+
+TEMPLATE = "RACUN broj: {n}\nKupac: Firma d.o.o.\nJIB 4200000000000\nUKUPAN IZNOS ZA NAPLATU {total}\n"
+
+
+def _pdf(text):
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 72), text, fontsize=11)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _invoice(n, customer, items):
+    lines = [f"RACUN broj: {n}", f"Kupac: {customer}", "JIB 4200000000000", "R.br  Opis  Kol  Cijena  Iznos"]
+    lines += [f"{i}  {desc}  {kol}  {price:.2f}  {kol * price:.2f}" for i, (desc, kol, price) in enumerate(items, 1)]
+    lines.append(f"UKUPAN IZNOS ZA NAPLATU {sum(k * c for _, k, c in items) * 1.17:.2f}")
+    return _pdf("\n".join(lines))
+
+
+def _scan(pdf, seed):
+    """Sken bez text layera: 150 dpi, pomak papira do 3 px, šum i promjena svjetline."""
+    rng = np.random.default_rng(seed)
+    src = fitz.open(stream=pdf, filetype="pdf")
+    pix = src[0].get_pixmap(dpi=150, colorspace=fitz.csGRAY)
+    src.close()
+    gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width).astype(np.float64)
+    gray = np.roll(gray, tuple(rng.integers(-3, 4, 2)), axis=(0, 1))
+    gray = gray * rng.uniform(0.9, 1.0) + rng.normal(0, 10, gray.shape)
+    samples = np.clip(gray, 0, 255).astype(np.uint8).tobytes()
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_image(page.rect, pixmap=fitz.Pixmap(fitz.csGRAY, pix.width, pix.height, samples, False))
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _prints(pdf):
+    return [f["print"] for f in classify_pages(pdf)]
+
+
+def test_same_template_different_invoice_is_not_duplicate():
+    first = _prints(_pdf(TEMPLATE.format(n="101/24", total="117,00")))
+    second = _prints(_pdf(TEMPLATE.format(n="102/24", total="234,00")))
+    index = DuplicateIndex()
+    index.add(first, "a.pdf")
+    assert index.find(second) is None
+
+
+def test_same_document_is_possible_duplicate(tmp_path):
+    pdf = _pdf(TEMPLATE.format(n="101/24", total="117,00"))
+    path = str(tmp_path / "history.json")
+    index = DuplicateIndex(path)
+    index.add(_prints(pdf), "a.pdf")
+    index.save()
+    assert DuplicateIndex(path).find(_prints(pdf)) == "a.pdf"
+
+
+def test_noisy_rescan_is_duplicate_but_other_invoice_on_template_is_not():
+    items = [("Usluga knjigovodstva", 1, 100.0), ("Obracun plata", 2, 50.0)]
+    index = DuplicateIndex()
+    index.add(_prints(_scan(_invoice("101/24", "Firma d.o.o.", items), seed=1)), "a.pdf")
+
+    rescan = _prints(_scan(_invoice("101/24", "Firma d.o.o.", items), seed=2))
+    assert rescan[0].startswith("s:")
+    assert index.find(rescan) == "a.pdf"
+
+    other = _invoice("102/24", "Trgovina Alfa", [("Revizija", 3, 150.0)])
+    assert index.find(_prints(_scan(other, seed=3))) is None
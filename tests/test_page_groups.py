@@ -0,0 +1,36 @@
+import fitz
+
+from processor import PAGE_CONTINUATION, PAGE_INVOICE_FIRST, classify_pages, plan_pages
+
+FILLER = "Opis stavke artikla kolicina cijena iznos " * 4
+
+
+def _pdf(pages):
+    doc = fitz.open()
+    for text in pages:
+        page = doc.new_page()
+        page.insert_text((50, 72), text, fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_page_without_header_is_not_merged_without_evidence():
+    # Druga stranica je novi račun kome zaglavlje nije prepoznato
+    pdf = _pdf([
+        f"Racun broj: 101/24\n{FILLER}\n{FILLER}",
+        f"{FILLER}\nUKUPAN IZNOS ZA NAPLATU 117,00\n{FILLER}",
+    ])
+    labels = [f["label"] for f in classify_pages(pdf)]
+    assert labels == [PAGE_INVOICE_FIRST, PAGE_INVOICE_FIRST]
+
+
+def test_same_invoice_number_merges():
+    pdf = _pdf([
+        f"Racun broj: 101/24\n{FILLER}\n{FILLER}",
+        f"Racun broj: 101/24\n{FILLER}\nUKUPAN IZNOS ZA NAPLATU 117,00",
+        f"Racun broj: 102/24\n{FILLER}\nUKUPAN IZNOS ZA NAPLATU 50,00",
+    ])
+    classified = classify_pages(pdf)
+    assert classified[1]["label"] == PAGE_CONTINUATION
+    assert [pages for pages, _ in plan_pages(classified)] == [[0, 1], [2]]
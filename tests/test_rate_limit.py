@@ -0,0 +1,62 @@
+import pytest
+
+import processor
+
+
+def test_burst_of_429_halves_concurrency_once():
+    limiter = processor.RateLimiter(rpm=1000, tpm=100000, concurrency=8)
+    for _ in range(5):
+        limiter.acquire()
+    for _ in range(5):
+        limiter.release(rate_limited=True, headers={"retry-after": "0"})
+    assert limiter.limit == 4.0
+    assert limiter.stats["rate_limited"] == 5
+
+
+
+class _Raw:
+    headers = {}
+
+    def parse(self):
+        return "ok"
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+class APITimeoutError(APIConnectionError):
+    pass
+
+
+class APIStatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.status_code = status_code
+
+
+def _failing(errors):
+    def create():
+        if errors:
+            raise errors.pop(0)
+        return _Raw()
+    return create
+
+
+def test_transient_errors_retry_through_limiter(monkeypatch):
+    monkeypatch.setattr(processor.time, "sleep", lambda s: None)
+    errors = [APIConnectionError(), APITimeoutError(), APIStatusError(500), APIStatusError(529)]
+    limiter = processor.RateLimiter(rpm=1000, tpm=100000, concurrency=8)
+    assert processor._call_with_limiter(limiter, _failing(errors), 0, lambda r: None) == "ok"
+    assert limiter.stats["requests"] == 5
+    assert limiter.stats["rate_limited"] == 1  # samo 529 smanjuje konkurentnost
+    assert limiter.limit < 8
+    assert limiter.in_flight == 0
+
+
+def test_client_errors_are_not_retried():
+    limiter = processor.RateLimiter(rpm=1000, tpm=100000)
+    with pytest.raises(APIStatusError):
+        processor._call_with_limiter(limiter, _failing([APIStatusError(400)]), 0, lambda r: None)
+    assert limiter.stats["requests"] == 1
+    assert limiter.in_flight == 0
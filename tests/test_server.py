@@ -0,0 +1,108 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import fitz
+import pytest
+
+import processor
+import server
+
+KIF_REPLY = {
+    "BRDOKFAKT": "101/24", "DATUMF": "01.02.2024", "NAZIVPP": "Kupac d.o.o.", "SJEDISTEPP": "Sarajevo",
+    "IDDVPP": "200000000000", "JIBPUPP": "4200000000000", "IZNOSNOV": "100.00", "IZNPDV": "17.00",
+    "IZNAKFT": "117.00", "REF": "", "OSL": "", "NAZIV_IZDAVACA": "Izdavač d.o.o.",
+    "KUPAC_SIFRA": "", "NAZIV_USLUGE": "",
+}
+FISCAL_REPLY = {"racuni": [{
+    "DATUMDOK": "01.02.2024", "BROJKIFA": "15", "SADRZAJ": "", "PRESCAN_LINES": "DI: 15 / 2000",
+    "GOTOVINA": "50.00", "KARTICNO": "0", "DEPOZIT": "0",
+}]}
+
+
+def fake_provider(content, api_key, max_tokens=2000, schema=None):
+    return json.dumps(FISCAL_REPLY if schema and schema["name"] == "fiskalni_racuni" else KIF_REPLY)
+
+
+def _pdf(text=None):
+    doc = fitz.open()
+    page = doc.new_page()
+    if text:
+        page.insert_text((50, 72), text, fontsize=11)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+@pytest.fixture
+def service_url():
+    processor.register_provider("fake", fake_provider)
+    service = server.ExtractionService(workers=1, queue_size=4)
+    service.start()
+    httpd = server.make_server(port=0, service=service)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+    service.stop()
+    processor.unregister_provider("fake")
+
+
+def _post(url, pdf_bytes):
+    req = urllib.request.Request(url, data=pdf_bytes, headers={"Content-Type": "application/pdf"})
+    try:
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_extract_kif_and_dnevni(service_url):
+    status, job = _post(f"{service_url}/extract/kif?provider=fake&wait=1&routing=1", _pdf("Racun broj 101/24"))
+    assert status == 200, job
+    assert job["status"] == "done"
+    assert job["result"]["BRDOKFAKT"] == "101/24"
+    assert job["result"]["IZNAKFT"] == "117.00"
+    assert not any(k.startswith("_") for k in job["result"])
+
+    status, job = _post(f"{service_url}/extract/dnevni?provider=fake&wait=1", _pdf())
+    assert status == 200, job
+    assert job["result"][0]["BROJKIFA"] == "15"
+    assert job["result"][0]["GOTOVINA"] == "50,00"
+
+    with urllib.request.urlopen(f"{service_url}/metrics", timeout=10) as resp:
+        metrics = resp.read().decode()
+    assert "bsbiro_completed 2" in metrics
+    assert "bsbiro_failed 0" in metrics
+
+
+def test_full_queue_returns_429():
+    release = threading.Event()
+    service = server.ExtractionService(workers=1, queue_size=1, handlers={
+        "kif": lambda pdf_bytes, **kwargs: release.wait(10) and {"BRDOKFAKT": "1", "_ROUTE": "easy:fake"},
+    })
+    service.start()
+    httpd = server.make_server(port=0, service=service)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}/extract/kif"
+    try:
+        first = _post(url, _pdf())
+        # Worker uzima prvi posao; drugi popuni red, treći dobija 429
+        for _ in range(100):
+            if service.metrics()["in_flight"] == 1:
+                break
+            threading.Event().wait(0.02)
+        assert _post(url, _pdf())[0] == 202
+        status, body = _post(url, _pdf())
+        assert status == 429
+        assert "error" in body
+        release.set()
+        job = service.get(first[1]["job_id"])
+        assert job.done.wait(10)
+        assert job.to_dict()["result"] == {"BRDOKFAKT": "1"}
+    finally:
+        release.set()
+        httpd.shutdown()
+        httpd.server_close()
+        service.stop()
@@ -0,0 +1,36 @@
+import pandas as pd
+
+from processor import KIF_HEADERS, KUF_HEADERS
+from validation import STATUS_OK, validate_results_df
+
+
+def _row(headers, **values):
+    row = {h: "" for h in headers}
+    row.update(values)
+    return row
+
+
+def test_kif_empty_amount_row_does_not_crash():
+    # Novi prazan red iz st.data_editor: bez iznosa nema ni razlike iznosa
+    df = pd.DataFrame([
+        _row(KIF_HEADERS, BRDOKFAKT="1/24", DATUMF="01.02.2024", NAZIVPP="Firma",
+             IZNOSNOV="100.00", IZNPDV="17.00", IZNAKFT="117.00"),
+        _row(KIF_HEADERS),
+        _row(KIF_HEADERS, BRDOKFAKT="2/24", DATUMF="01.02.2024", NAZIVPP="Firma", IZNOSNOV="100.00"),
+    ])
+    _, status = validate_results_df(df, "kif")
+    assert status[0] == STATUS_OK
+    assert "≠" not in status[1]
+    assert status[2] == STATUS_OK
+
+
+def test_kuf_amount_mismatch_is_flagged():
+    df = pd.DataFrame([
+        _row(KUF_HEADERS, BROJFAKT="7", DATUMF="01.02.2024", NAZIVPP="Dobavljač",
+             IZNBEZPDV="100,00", IZNPDV="17,00", IZNSAPDV="120,00"),
+        _row(KUF_HEADERS, BROJFAKT="8", DATUMF="01.02.2024", NAZIVPP="Dobavljač", IZNSAPDV=""),
+    ])
+    out, status = validate_results_df(df, "kuf")
+    assert status[0] == "IZNBEZPDV + IZNPDV ≠ IZNSAPDV"
+    assert out.loc[0, "IZNSAPDV"] == "120.00"
+    assert status[1] == STATUS_OK
@@ -0,0 +1,126 @@
+"""Batch validacija i usklađivanje tabele rezultata (KIF, KUF, dnevni prihod).
+
+Ista pravila kao pojedinačni hardening u process_pdf / process_kuf_pdf
+(JIB 13 cifara, PDV broj 12 cifara, decimalni separator, IZNOSNOV + IZNPDV
+= IZNAKFT), ali kao kolonske operacije nad cijelim DataFrame-om. Ponovna
+validacija nakon edita u st.data_editor zato traje milisekunde i na
+velikim tabelama.
+"""
+import re
+from decimal import Decimal, InvalidOperation
+
+import pandas as pd
+
+STATUS_OK = "OK"
+AMOUNT_TOLERANCE = Decimal("0.05")
+_CENT = Decimal("0.01")
+
+_SPACES_RE = re.compile(r'\s+')
+_DIGITS_RE = re.compile(r'\d+')
+_PDV_RE = re.compile(r'\d{12}')
+_DATE_RE = re.compile(r'\d{2}\.\d{2}\.\d{4}')
+_THOUSANDS_DOT_RE = re.compile(r'\.(?=\d{3}(?:[.,]|$))')
+
+# Pravila po modulu: ID/PDV kolone, iznosi (osnovica, PDV, ukupno), decimalni
+# separator u izvozu, obavezne kolone i kolone sa datumom.
+RULES = {
+    "kif": {
+        "id": ("IDDVPP", "JIBPUPP"),
+        "amounts": ("IZNOSNOV", "IZNPDV", "IZNAKFT"),
+        "decimal": ".",
+        "required": ("BRDOKFAKT", "DATUMF", "NAZIVPP"),
+        "dates": ("DATUMF",),
+    },
+    "kuf": {
+        "id": ("IDPDVPP", "JIBPUPP"),
+        "amounts": ("IZNBEZPDV", "IZNPDV", "IZNSAPDV"),
+        "decimal": ".",
+        "required": ("BROJFAKT", "DATUMF", "NAZIVPP"),
+        "dates": ("DATUMF",),
+    },
+    "dnevni": {
+        "id": None,
+        "amounts": ("GOTOVINA", "KARTICNO", "DEPOZIT"),
+        "decimal": ",",
+        "required": ("DATUMDOK", "BROJKIFA"),
+        "dates": ("DATUMDOK",),
+    },
+}
+
+
+def _to_decimal(val):
+    if not val:
+        return None
+    try:
+        d = Decimal(val)
+    except InvalidOperation:
+        return None
+    return d.quantize(_CENT) if d.is_finite() else None
+
+
+def _text(df, col):
+    return df[col].fillna("").astype(str).str.strip()
+
+
+def _normalize_amounts(col):
+    """'1.234,56' / '1234,56' / '1234.56' → '1234.56' (kolonski)."""
+    both = col.str.contains(",", regex=False) & col.str.contains(".", regex=False)
+    col = col.where(~both, col.str.replace(_THOUSANDS_DOT_RE, "", regex=True))
+    return col.str.replace(_SPACES_RE, "", regex=True).str.replace(",", ".", regex=False)
+
+
+def validate_results_df(df, mode):
+    """Normalizuje i validira tabelu rezultata.
+
+    Args:
+        df: DataFrame sa kolonama KIF_HEADERS / KUF_HEADERS / DNEVNI_HEADERS
+        mode: "kif", "kuf" ili "dnevni" (herbavital koristi "kif")
+    Returns:
+        (normalizovan DataFrame, Series sa statusom po redu — "OK" ili opis problema)
+    """
+    rules = RULES[mode]
+    out = df.copy()
+    issues = pd.DataFrame(index=out.index)
+
+    for col in rules["required"]:
+        issues[f"fali {col}"] = _text(out, col) == ""
+    for col in rules["dates"]:
+        dates = _text(out, col)
+        issues[f"{col} nije DD.MM.GGGG"] = (dates != "") & ~dates.str.fullmatch(_DATE_RE)
+
+    if rules["id"]:
+        id_col, pdv_col = rules["id"]
+        ids = _text(out, id_col).str.replace(_SPACES_RE, "", regex=True)
+        ids = ids.where(~((ids.str.len() == 12) & ~ids.str.startswith("4")), "4" + ids)
+        valid_id = (ids.str.len() == 13) & ids.str.startswith("4") & ids.str.fullmatch(_DIGITS_RE)
+        pdv = _text(out, pdv_col)
+        pdv = pdv.where(~(valid_id & (pdv.str.len() != 12)), ids.str[1:])
+        out[id_col] = ids
+        out[pdv_col] = pdv
+        issues[f"{id_col} nije 13 cifara"] = (ids != "") & ~valid_id
+        issues[f"{pdv_col} nije 12 cifara"] = (pdv != "") & ~pdv.str.fullmatch(_PDV_RE)
+
+    values = {}
+    for col in rules["amounts"]:
+        raw = _normalize_amounts(_text(out, col))
+        values[col] = raw.map(_to_decimal)
+        issues[f"{col} nije broj"] = (raw != "") & values[col].isna()
+        formatted = values[col].map(lambda d: f"{d:.2f}" if d is not None else None)
+        if rules["decimal"] == ",":
+            formatted = formatted.str.replace(".", ",", regex=False)
+        out[col] = formatted.where(values[col].notna(), _text(out, col))
+
+    if mode in ("kif", "kuf"):
+        base, vat, total = (values[c] for c in rules["amounts"])
+        known = base.notna() & total.notna()
+        label = f"{rules['amounts'][0]} + {rules['amounts'][1]} ≠ {rules['amounts'][2]}"
+        # Samo redovi sa oba iznosa — prazan iznos (npr. novi red u editoru) nije razlika
+        issues[label] = False
+        diff = total[known] - base[known] - vat[known].fillna(Decimal("0"))
+        issues.loc[known, label] = diff.map(lambda d: abs(d) > AMOUNT_TOLERANCE)
+
+    status = pd.Series("", index=out.index, dtype=object)
+    for label, mask in issues.items():
+        status = status.where(~mask, status + f"{label}; ")
+    status = status.str.rstrip("; ").replace("", STATUS_OK)
+    return out, status